@@ -0,0 +1,82 @@
+import sys
+
+import parser
+import synthetic
+import visitor
+
+
+class StatementCounter(visitor.Visitor):
+
+  def __init__(self):
+    self.calls = 0
+    self.foreign_code_blocks = 0
+
+  def visit_function_call(self, node, code, indent_level):
+    self.calls += 1
+
+  def visit_foreign_code_block(self, node, code, indent_level):
+    self.foreign_code_blocks += 1
+
+
+def dispatch_by_if_chain(counter, statements, code):
+  # The way the converters picked a method before they were visitors.
+  for member in statements:
+    if member.node_type == 'FUNCTION_CALL':
+      counter.visit_function_call(member, code, 2)
+    elif member.node_type == 'FOREIGN_CODE_BLOCK':
+      counter.visit_foreign_code_block(member, code, 2)
+
+
+def dispatch_by_long_if_chain(counter, statements, code):
+  # The same with the tests for six more constructs in front.
+  for member in statements:
+    node_type = member.node_type
+    if node_type == 'ASSIGNMENT':
+      pass
+    elif node_type == 'DECLARATION':
+      pass
+    elif node_type == 'FUNCTION_DECLARATION':
+      pass
+    elif node_type == 'CODE_BLOCK':
+      pass
+    elif node_type == 'IDENTIFIER_CHAIN':
+      pass
+    elif node_type == 'NUMBER_LITERAL':
+      pass
+    elif node_type == 'FUNCTION_CALL':
+      counter.visit_function_call(member, code, 2)
+    elif node_type == 'FOREIGN_CODE_BLOCK':
+      counter.visit_foreign_code_block(member, code, 2)
+
+
+def dispatch_by_visit(counter, statements, code):
+  visit = counter.visit
+  for member in statements:
+    visit(member, code, 2)
+
+
+def dispatch_by_table(counter, statements, code):
+  # The way the converters use a visitor.
+  dispatch = counter.dispatch
+  for member in statements:
+    dispatch[member.node_type](member, code, 2)
+
+
+def benchmark_dispatch(source_code):
+  tree = parser.parse_source(source_code)
+  statements = []
+  for function in tree.symbols.functions.values():
+    statements.extend(function.body.statements)
+  print('Picking the method for each of %d statements' % len(statements))
+  for name, dispatch in (('If chain', dispatch_by_if_chain),
+                         ('Long chain', dispatch_by_long_if_chain),
+                         ('visit()', dispatch_by_visit),
+                         ('dispatch[]', dispatch_by_table)):
+    counter = StatementCounter()
+    seconds = synthetic.best_time(lambda: dispatch(counter, statements, []), repeat=10)
+    print('  %-12s %8.3f s %8.1f ns per node' % (name, seconds, seconds * 1e9 / len(statements)))
+
+
+if __name__ == '__main__':
+  size_in_bytes = int(sys.argv[1]) if len(sys.argv) > 1 else 4 * 1024 * 1024
+  benchmark_dispatch(synthetic.generate_module_of_size(size_in_bytes))
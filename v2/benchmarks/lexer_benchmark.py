@@ -0,0 +1,97 @@
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import lexer
+import synthetic
+
+
+def benchmark_engines(size_in_bytes):
+  source_code = synthetic.generate_module_of_size(size_in_bytes)
+  print('Lexing %d bytes of generated Headspace code' % len(source_code))
+  for engine in lexer.ENGINES:
+    # Compile the pattern outside of the timed region.
+    lexer.tokenize('warm up', engine=engine)
+    seconds = synthetic.best_time(lambda: lexer.tokenize(source_code, engine=engine))
+    print('  %-8s %8.3f s %8.2f MB/s' % (
+        engine, seconds, synthetic.megabytes_per_second(source_code, seconds)))
+  encoded = source_code.encode('utf-8')
+  seconds = synthetic.best_time(lambda: lexer.tokenize_bytes(encoded))
+  print('  %-8s %8.3f s %8.2f MB/s' % (
+      'bytes', seconds, synthetic.megabytes_per_second(source_code, seconds)))
+
+
+def benchmark_numpy_crossover(sizes):
+  if 'numpy' not in lexer.ENGINES:
+    print('NumPy is not installed, skipping the numpy engine crossover')
+    return
+  print('numpy engine against the pure Python engines, tokenize_buffer')
+  for size_in_bytes in sizes:
+    source_code = synthetic.generate_module_of_size(size_in_bytes)
+    lexer.tokenize_buffer('warm up', engine='numpy')
+    times = [synthetic.best_time(lambda: lexer.tokenize_buffer(source_code, engine=engine))
+             for engine in ('python', 'regex', 'numpy')]
+    print('  %9d bytes: python %9.3f ms, regex %9.3f ms, numpy %9.3f ms' % (
+        len(source_code), times[0] * 1000, times[1] * 1000, times[2] * 1000))
+
+
+def peak_memory(function):
+  tracemalloc.start()
+  function()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return peak
+
+
+def benchmark_streaming(size_in_bytes):
+  source_code = synthetic.generate_module_of_size(size_in_bytes)
+  with tempfile.NamedTemporaryFile('w', suffix='.hs', delete=False) as source_file:
+    source_file.write(source_code)
+  try:
+    def whole_file():
+      with open(source_file.name) as fileobj:
+        len(lexer.tokenize(fileobj.read(), engine='regex'))
+
+    def streamed():
+      with open(source_file.name) as fileobj:
+        for _ in lexer.iter_tokens(fileobj, engine='regex'):
+          pass
+
+    def mapped():
+      len(lexer.tokenize_file(source_file.name))
+
+    print('Peak memory lexing a %d byte file' % len(source_code))
+    for name, function in (('tokenize', whole_file), ('iter_tokens', streamed),
+                           ('tokenize_file', mapped)):
+      print('  %-14s %8.2f MB' % (name, peak_memory(function) / (1024 * 1024)))
+  finally:
+    os.remove(source_file.name)
+
+
+def benchmark_incremental(sizes, edit_count=200):
+  print('Average cost of typing one character')
+  engines = [engine for engine in ('regex', 'numpy') if engine in lexer.ENGINES]
+  for size_in_bytes in sizes:
+    source_code = synthetic.generate_module_of_size(size_in_bytes)
+    # Type inside a string literal in the middle of the module.
+    offset = source_code.index('Message number', len(source_code) // 2)
+    for engine in engines:
+      incremental = lexer.IncrementalLexer(source_code, engine)
+
+      def type_characters():
+        for count in range(edit_count):
+          incremental.edit(offset + count, 0, 'x')
+
+      seconds = synthetic.best_time(type_characters, repeat=1)
+      full_seconds = synthetic.best_time(
+          lambda: lexer.tokenize_buffer(incremental.source_code, engine=engine), repeat=1)
+      print('  %9d bytes %-6s edit %8.3f ms, full lex %8.3f ms' % (
+          len(source_code), engine, seconds / edit_count * 1000, full_seconds * 1000))
+
+if __name__ == '__main__':
+  size_in_bytes = int(sys.argv[1]) if len(sys.argv) > 1 else 4 * 1024 * 1024
+  benchmark_engines(size_in_bytes)
+  benchmark_numpy_crossover([size_in_bytes >> shift for shift in range(14, -1, -2)])
+  benchmark_streaming(size_in_bytes)
+  benchmark_incremental((size_in_bytes // 16, size_in_bytes // 4, size_in_bytes))
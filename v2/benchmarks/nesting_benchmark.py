@@ -0,0 +1,116 @@
+import contextlib
+import os
+import sys
+
+import converter
+import dump
+import parser
+import synthetic
+import visitor
+from tests.parser_test import nested_calls
+
+# Nesting depths of the stress trees, far past the recursion limit.
+DEPTHS = (1000, 10000, 50000)
+
+
+class StringCounter(visitor.Visitor):
+
+  def __init__(self):
+    self.strings = 0
+
+  def visit_string_literal(self, node):
+    self.strings += 1
+
+
+class RecursiveStringCounter(StringCounter):
+  # How generic_visit walked the tree before it kept a stack of its own.
+
+  def generic_visit(self, node):
+    for child in node.children():
+      self.visit(child)
+
+
+def print_recursively(node, indent_level=0):
+  # How SyntaxNode.print walked the tree before it kept a stack of its own.
+  if node.leaf:
+    print(' ' * indent_level, node.node_type, ':')
+    for member in node.members:
+      print(' ' * (indent_level + 2), member)
+  else:
+    print(' ' * indent_level, node.node_type, ':')
+    for member in node.members:
+      print_recursively(member, indent_level + 2)
+
+
+def nested_code_blocks(depth):
+  # A main function whose body is a block in a block, depth blocks deep,
+  # around a print.
+  tree = parser.parse_source('moduleName = "nested"\nmain: function[][\n  os.print["x"]\n]\n')
+  body = tree.items[1].body
+  for _ in range(depth):
+    body.statements = [parser.CodeBlock(body.statements)]
+    body = body.statements[0]
+  return tree
+
+
+def benchmark_walks(depths):
+  print('Walking trees of nested calls')
+  for depth in depths:
+    tree = nested_calls(depth)
+    node_count = sum(1 for _ in tree.walk())
+    # print() indents each line by its depth, its output grows with the
+    # square of the depth, so it is only timed on shallow trees below.
+    with open(os.devnull, 'w') as output_file:
+      dump_seconds = synthetic.best_time(lambda: dump.dump_tree(tree, output_file))
+    visit_seconds = synthetic.best_time(lambda: StringCounter().visit(tree))
+    shift_seconds = synthetic.best_time(lambda: tree.shift(1))
+    print('  depth %6d: dump %7.3f s, visit %7.3f s, shift %7.3f s (%d nodes)' % (
+        depth, dump_seconds, visit_seconds, shift_seconds, node_count))
+
+
+def benchmark_per_node(source_code):
+  # Shallow trees, where recursion works, show what a node costs either way.
+  tree = parser.parse_source(source_code)
+  node_count = sum(1 for _ in tree.walk())
+  print('Cost per node of %d nodes, recursive against a stack' % node_count)
+  with open(os.devnull, 'w') as output_file:
+    with contextlib.redirect_stdout(output_file):
+      recursive = synthetic.best_time(lambda: print_recursively(tree))
+      iterative = synthetic.best_time(tree.print)
+  print('  %-10s %8.1f ns, %8.1f ns' % ('print', recursive * 1e9 / node_count,
+                                          iterative * 1e9 / node_count))
+  recursive = synthetic.best_time(lambda: RecursiveStringCounter().visit(tree))
+  iterative = synthetic.best_time(lambda: StringCounter().visit(tree))
+  print('  %-10s %8.1f ns, %8.1f ns' % ('visit', recursive * 1e9 / node_count,
+                                          iterative * 1e9 / node_count))
+
+
+def benchmark_emit(depths):
+  print('Converting code blocks nested in code blocks')
+  for depth in depths:
+    tree = nested_code_blocks(depth)
+    # The other targets indent closing braces, their output grows with the
+    # square of the depth.
+    for language in ('c', 'python'):
+      seconds = synthetic.best_time(lambda: converter.convert(tree, language))
+      print('  depth %6d %-8s %8.3f s' % (depth, language, seconds))
+
+
+def benchmark_parse(lengths):
+  # The grammar nests nothing yet, long chains and blocks are its deepest input.
+  print('Parsing long identifier chains and long code blocks')
+  for length in lengths:
+    chain = 'main: function[][\n  %s["x"]\n]\n' % '.'.join(['name'] * length)
+    block = 'main: function[][\n%s]\n' % ('  os.print["x"]\n' * length)
+    chain_seconds = synthetic.best_time(lambda: parser.parse_source(chain))
+    block_seconds = synthetic.best_time(lambda: parser.parse_source(block))
+    print('  %6d names in a chain %7.3f s, %6d statements in a block %7.3f s' % (
+        length, chain_seconds, length, block_seconds))
+
+
+if __name__ == '__main__':
+  size_in_bytes = int(sys.argv[1]) if len(sys.argv) > 1 else 1024 * 1024
+  benchmark_walks(DEPTHS)
+  benchmark_per_node(synthetic.generate_module_of_size(size_in_bytes))
+  benchmark_emit(DEPTHS)
+  benchmark_parse(DEPTHS)
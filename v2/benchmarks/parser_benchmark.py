@@ -0,0 +1,252 @@
+import concurrent.futures
+import contextlib
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import cache
+import converter
+import dump
+import lexer
+import parser
+import synthetic
+
+
+def allocated_by(function):
+  # Returns the result of function and the bytes it left allocated.
+  tracemalloc.start()
+  result = function()
+  allocated = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return result, allocated
+
+
+def peak_allocated_by(function):
+  # Returns the result of function and the most bytes allocated while it ran.
+  tracemalloc.start()
+  result = function()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return result, peak
+
+
+def benchmark_token_storage(source_code):
+  print('Token storage for %d bytes of generated Headspace code' % len(source_code))
+  token_list, list_bytes = allocated_by(lambda: lexer.tokenize(source_code, engine='regex'))
+  token_buffer, buffer_bytes = allocated_by(lambda: lexer.tokenize_buffer(source_code))
+  token_count = len(token_list)
+  print('  %d tokens' % token_count)
+  print('  Token list   %8.1f bytes/token' % (list_bytes / token_count))
+  print('  TokenBuffer  %8.1f bytes/token' % (buffer_bytes / token_count))
+  return token_list, token_buffer
+
+
+def benchmark_parse(token_list, token_buffer):
+  print('Parsing')
+  for name, tokens in (('Token list', token_list), ('TokenBuffer', token_buffer)):
+    seconds = synthetic.best_time(lambda: parser.parse_tokens(tokens))
+    print('  %-12s %8.3f s %10.0f tokens/s' % (name, seconds, len(tokens) / seconds))
+
+
+def benchmark_trivia(source_code):
+  print('Trivia set aside by the lexer')
+  trivia = lexer.TriviaTable(source_code)
+  tokens = lexer.tokenize_buffer(source_code, trivia=trivia)
+  print('  %d significant tokens, %d trivia tokens' % (len(tokens), len(trivia)))
+  seconds = synthetic.best_time(lambda: parser.parse_tokens(tokens, trivia))
+  print('  %-12s %8.3f s %10.0f tokens/s' % ('Significant', seconds, len(tokens) / seconds))
+
+
+def benchmark_whitespace_heavy(function_count=5000):
+  source_code = synthetic.generate_indented_module(function_count)
+  tokens = lexer.tokenize_buffer(source_code)
+  trivia = lexer.TriviaTable(source_code)
+  significant = lexer.tokenize_buffer(source_code, trivia=trivia)
+  print('Parsing %d bytes of indented and commented code, %d of %d tokens are trivia' % (
+      len(source_code), len(trivia), len(tokens)))
+  for name, parse in (('With trivia', lambda: parser.parse_tokens(tokens)),
+                      ('Set aside', lambda: parser.parse_tokens(significant, trivia))):
+    seconds = synthetic.best_time(parse)
+    print('  %-12s %8.3f s %8.2f MB/s' % (
+        name, seconds, synthetic.megabytes_per_second(source_code, seconds)))
+
+
+def benchmark_symbols(source_code, file_count=4):
+  print('Parse trees of %d files' % file_count)
+  for name, symbols in (('Plain', None), ('SymbolTable', lexer.SymbolTable())):
+    trees, tree_bytes = allocated_by(
+        lambda: [parser.parse_source(source_code, symbols) for _ in range(file_count)])
+    seconds = synthetic.best_time(lambda: parser.parse_source(source_code, symbols))
+    print('  %-12s %8.1f MB %8.3f s/file' % (name, tree_bytes / 1e6, seconds))
+
+
+def benchmark_node_access(source_code):
+  print('Reading the first argument of every function call')
+  tree = parser.parse_source(source_code)
+  calls = [statement for function in tree.items if isinstance(function, parser.FunctionDeclaration)
+           for statement in function.body.statements if isinstance(statement, parser.FunctionCall)]
+  def typed_fields():
+    return [call.args[0] for call in calls]
+  def members_view():
+    return [call.members[1].members[1].members[0] for call in calls]
+  for name, read in (('Typed fields', typed_fields), ('Members view', members_view)):
+    seconds = synthetic.best_time(read)
+    print('  %-12s %8.3f s %10.0f calls/s' % (name, seconds, len(calls) / seconds))
+
+
+def benchmark_arena(source_code):
+  print('Node objects and Arena columns')
+  for name, parse, count_nodes in (
+      ('Nodes', lambda: parser.parse_source(source_code),
+       lambda tree: sum(1 for _ in tree.walk())),
+      ('Arena', lambda: parser.parse_source_arena(source_code),
+       lambda tree: len(tree.arena))):
+    tree, tree_bytes = allocated_by(parse)
+    node_count = count_nodes(tree)
+    del tree
+    seconds = synthetic.best_time(lambda: converter.convert(parse(), 'c'))
+    print('  %-12s %8d nodes %8.1f bytes/node %8.3f s parse+convert' % (
+        name, node_count, tree_bytes / node_count, seconds))
+
+
+def benchmark_reparse(source_code):
+  print('Parsing again after a one character edit in the middle')
+  start = source_code.index('\n', len(source_code) // 2)
+  new_source_code = source_code[:start] + ' ' + source_code[start:]
+  seconds = synthetic.best_time(lambda: parser.parse_source(new_source_code))
+  print('  %-12s %8.3f s' % ('Full parse', seconds))
+  trees = [parser.parse_source(source_code) for _ in range(3)]
+  seconds = synthetic.best_time(
+      lambda: parser.reparse(trees.pop(), new_source_code, start, start, start + 1))
+  print('  %-12s %8.3f s' % ('Reparse', seconds))
+
+
+def benchmark_bodies(source_code):
+  print('Parsing with function bodies eager, lazy and in an outline')
+  trivia = lexer.TriviaTable(source_code)
+  tokens = lexer.tokenize_buffer(source_code, trivia=trivia)
+  for bodies in parser.FUNCTION_BODIES:
+    seconds = synthetic.best_time(lambda: parser.parse_source(source_code, bodies=bodies))
+    parse_seconds = synthetic.best_time(lambda: parser.parse_tokens(tokens, trivia, bodies=bodies))
+    print('  %-12s %8.3f s, %.3f s without tokenizing' % (bodies, seconds, parse_seconds))
+
+
+def benchmark_streaming(source_code):
+  print('Parsing a file whole and streaming its top-level items')
+  with tempfile.NamedTemporaryFile('w', suffix='.hs', delete=False) as source_file:
+    source_file.write(source_code)
+
+  def parse_whole():
+    with open(source_file.name) as source:
+      return len(parser.parse_source(source.read()).items)
+
+  def parse_streaming():
+    with open(source_file.name) as source:
+      return sum(1 for _ in parser.iter_top_level(lexer.iter_tokens(source, engine='regex')))
+
+  try:
+    for name, function in (('Whole', parse_whole), ('Streaming', parse_streaming)):
+      seconds = synthetic.best_time(function)
+      _, peak = peak_allocated_by(function)
+      print('  %-12s %8.3f s %10.1f MB peak' % (name, seconds, peak / 1e6))
+  finally:
+    os.remove(source_file.name)
+
+
+def benchmark_index(source_code):
+  print('Finding the os.print calls and the function around the last one')
+  seconds = synthetic.best_time(lambda: parser.parse_source(source_code))
+  print('  %-12s %8.3f s' % ('Parse', seconds))
+  seconds = synthetic.best_time(lambda: parser.parse_source(source_code, index=True))
+  print('  %-12s %8.3f s' % ('Indexed', seconds))
+  tree = parser.parse_source(source_code, index=True)
+
+  def walk():
+    calls = [node for node in tree.walk()
+             if node.node_type == 'FUNCTION_CALL' and node.callee.text() == 'os.print']
+    return next(item for item in tree.items
+                if item.node_type == 'FUNCTION_DECLARATION' and calls[-1] in item.walk())
+
+  def look_up():
+    calls = tree.index.function_calls('os.print')
+    return tree.index.enclosing(calls[-1], 'FUNCTION_DECLARATION')
+
+  for name, function in (('Walk', walk), ('Index', look_up)):
+    seconds = synthetic.best_time(function)
+    print('  %-12s %8.3f ms' % (name, seconds * 1000))
+
+
+def benchmark_sharing(source_code):
+  print('Sharing equal statements between their occurrences')
+  repetitive = ''.join(
+      'helper%d: function[][\n  os.print["Done\\n"]\n  os.print[greeting]\n]\n' % index
+      for index in range(len(source_code) // 64))
+  for name, module_source in (('Synthetic', source_code), ('Repetitive', repetitive)):
+    _, allocated = allocated_by(lambda: parser.parse_source(module_source))
+    builder = parser.SharingBuilder()
+    _, shared_allocated = allocated_by(lambda: parser.parse_source(module_source, builder=builder))
+    print('  %-12s %8.1f MB, %.1f MB shared, %.2f nodes asked for per node created' % (
+        name, allocated / 1e6, shared_allocated / 1e6, builder.dedup_ratio()))
+
+
+def benchmark_dump(source_code):
+  print('Writing the parse tree out')
+  tree = parser.parse_source(source_code)
+  with open(os.devnull, 'w') as output_file:
+    with contextlib.redirect_stdout(output_file):
+      seconds = synthetic.best_time(tree.print)
+    print('  %-12s %8.3f s' % ('print()', seconds))
+    for format in dump.FORMATS:
+      seconds = synthetic.best_time(lambda: dump.dump_tree(tree, output_file, format))
+      print('  %-12s %8.3f s' % (format, seconds))
+
+
+def benchmark_cache(source_code):
+  print('Parse cache')
+  seconds = synthetic.best_time(lambda: parser.parse_source_arena(source_code))
+  print('  %-12s %8.3f s' % ('Cold parse', seconds))
+  with tempfile.TemporaryDirectory() as directory:
+    parse_cache = cache.ParseCache(directory)
+    parse_cache.parse(source_code)
+    seconds = synthetic.best_time(lambda: parse_cache.parse(source_code))
+    print('  %-12s %8.3f s' % ('Cache load', seconds))
+    seconds = synthetic.best_time(lambda: converter.convert(parse_cache.parse(source_code), 'c'))
+    print('  %-12s %8.3f s' % ('Load+convert', seconds))
+    cache_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    print('  %-12s %8.1f MB on disk' % ('Cache file', cache_bytes / 1e6))
+
+
+def benchmark_parallel(source_code):
+  print('Parallel parse on %d cores' % (os.cpu_count() or 1))
+  seconds = synthetic.best_time(lambda: parser.parse_source(source_code), repeat=1)
+  print('  %-12s %8.3f s' % ('Serial', seconds))
+  split_seconds = synthetic.best_time(lambda: parser.find_split_points(source_code, 8), repeat=1)
+  print('  %-12s %8.3f s' % ('Split points', split_seconds))
+  workers = 1
+  while workers <= max(2, os.cpu_count() or 1):
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+      seconds = synthetic.best_time(lambda: parser.parse_source_parallel(
+          source_code, workers, executor, min_chunk_size=1), repeat=1)
+    print('  %-12s %8.3f s' % ('%d workers' % workers, seconds))
+    workers *= 2
+
+
+if __name__ == '__main__':
+  size_in_bytes = int(sys.argv[1]) if len(sys.argv) > 1 else 4 * 1024 * 1024
+  source_code = synthetic.generate_module_of_size(size_in_bytes)
+  token_list, token_buffer = benchmark_token_storage(source_code)
+  benchmark_parse(token_list, token_buffer)
+  benchmark_trivia(source_code)
+  benchmark_whitespace_heavy()
+  benchmark_symbols(source_code)
+  benchmark_node_access(source_code)
+  benchmark_arena(source_code)
+  benchmark_reparse(source_code)
+  benchmark_bodies(source_code)
+  benchmark_streaming(source_code)
+  benchmark_index(source_code)
+  benchmark_sharing(source_code)
+  benchmark_dump(source_code)
+  benchmark_cache(source_code)
+  benchmark_parallel(source_code)
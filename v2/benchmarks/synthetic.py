@@ -0,0 +1,64 @@
+import time
+
+
+FUNCTION_TEMPLATE = """
+helper%(index)d: function[][
+  os.print["Message number %(index)d from a generated helper\\n"]
+  os.print[greeting]
+BEGIN_FOREIGN_CODE_C
+  /* Generated C code for helper %(index)d. */
+  int value_%(index)d = %(index)d * 3.5;
+  printf("%%d\\n", value_%(index)d);
+END_FOREIGN_CODE_C
+BEGIN_FOREIGN_CODE_PYTHON
+  value_%(index)d = %(index)d * 3.5  # generated
+  print('value', value_%(index)d)
+END_FOREIGN_CODE_PYTHON
+]
+counter%(index)d: int32
+"""
+
+
+def generate_module(function_count):
+  """Builds a Headspace module with the given number of helper functions."""
+  parts = ['moduleName = "synthetic"\n']
+  for index in range(function_count):
+    parts.append(FUNCTION_TEMPLATE % {'index': index})
+  parts.append('\nmain: function[][\n  os.print["Hello World\\n"]\n]\n')
+  return ''.join(parts)
+
+
+def generate_indented_module(function_count, indent=24):
+  """Builds a module with deeply indented, commented function bodies."""
+  padding = ' ' * indent
+  parts = ['moduleName = "indented"\n']
+  for index in range(function_count):
+    parts.append('\n\n// Helper %d.\nhelper%d:   function[][\n' % (index, index))
+    for line in range(4):
+      parts.append('%s/* Line %d. */ /* of */ /* helper %d. */\n%s\n%s// Print it.\n' % (
+          padding, line, index, padding, padding))
+      parts.append('%sos.print["Line %d of helper %d\\n"]   \n' % (padding, line, index))
+    parts.append(']\n')
+  return ''.join(parts)
+
+
+def generate_module_of_size(size_in_bytes):
+  """Builds a module of at least the given size in bytes."""
+  sample_size = len(FUNCTION_TEMPLATE % {'index': 1000})
+  return generate_module(max(1, size_in_bytes // sample_size))
+
+
+def best_time(function, repeat=3):
+  """Runs function repeat times and returns the fastest wall time in seconds."""
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def megabytes_per_second(source_code, seconds):
+  return len(source_code.encode('utf-8')) / seconds / (1024 * 1024)
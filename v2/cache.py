@@ -0,0 +1,172 @@
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+import lexer
+import parser
+
+
+# Binary parse tree format, laid out so that a loaded file is read in place:
+#
+#   header      MAGIC, then the fields of _HEADER
+#   node table  kinds, first child, next sibling, starts and ends columns of
+#               an Arena, then the offset of each node's text in the pool
+#   string pool UTF-8 text of every leaf, literals and foreign code included
+#
+# Sections start at multiples of 8 bytes. Numbers are in the byte order of
+# the machine that wrote the file, the header records it.
+MAGIC = b'HSPARSE\0'
+FORMAT_VERSION = 1
+_HEADER = struct.Struct('<IBBxxIiQ')
+_ALIGNMENT = 8
+
+
+def _aligned(size):
+  return -size % _ALIGNMENT
+
+
+class CacheFormatError(Exception):
+  """A cache file that is not in this version of the format."""
+
+
+def dump_arena(arena, output_file):
+  """Writes the parse tree in an Arena to a binary file."""
+  leaf_kind = parser._FIRST_LEAF_KIND
+  pool = []
+  text_offsets = array('I', [0])
+  size = 0
+  for index, kind in enumerate(arena.kinds):
+    if kind >= leaf_kind:
+      text = arena.text(index).encode('utf-8')
+      pool.append(text)
+      size += len(text)
+    text_offsets.append(size)
+  pool = b''.join(pool)
+  output_file.write(MAGIC)
+  output_file.write(_HEADER.pack(FORMAT_VERSION, sys.byteorder == 'little',
+                                 ord(arena.starts.typecode), len(arena), arena.root, len(pool)))
+  written = len(MAGIC) + _HEADER.size
+  for column in (arena.kinds, arena.first_child, arena.next_sibling, arena.starts, arena.ends,
+                 text_offsets):
+    padding = _aligned(written)
+    output_file.write(b'\0' * padding)
+    output_file.write(column.tobytes())
+    written += padding + len(column) * column.itemsize
+  output_file.write(pool)
+
+
+def load_arena(buffer):
+  """Returns an ArenaView of a parse tree written by dump_arena.
+
+  Nothing is copied out of the buffer, usually an mmap, so loading takes the
+  same time for any size of tree. Raises CacheFormatError if the buffer does
+  not hold a tree in this format.
+  """
+  view = memoryview(buffer)
+  header_end = len(MAGIC) + _HEADER.size
+  if len(view) < header_end or view[:len(MAGIC)] != MAGIC:
+    raise CacheFormatError('Not a parse tree file')
+  version, little_endian, offset_type, node_count, root, pool_size = _HEADER.unpack(
+      view[len(MAGIC):header_end])
+  if version != FORMAT_VERSION or little_endian != (sys.byteorder == 'little'):
+    raise CacheFormatError('Parse tree file in another format')
+  offset = header_end
+  columns = []
+  for typecode, count in (('B', node_count), ('i', node_count), ('i', node_count),
+                          (chr(offset_type), node_count), (chr(offset_type), node_count),
+                          ('I', node_count + 1)):
+    offset += _aligned(offset)
+    size = count * array(typecode).itemsize
+    if offset + size > len(view):
+      raise CacheFormatError('Truncated parse tree file')
+    columns.append(view[offset:offset + size].cast(typecode))
+    offset += size
+  if offset + pool_size != len(view):
+    raise CacheFormatError('Truncated parse tree file')
+  return ArenaView(columns, root, view[offset:])
+
+
+class ArenaView(parser.Arena):
+  """A read-only Arena over the columns of a loaded parse tree file.
+
+  Leaf text comes from the string pool of the file, the source code is not
+  needed. ArenaNode walks it like any Arena.
+  """
+
+  def __init__(self, columns, root, pool):
+    (self.kinds, self.first_child, self.next_sibling, self.starts, self.ends,
+     self._text_offsets) = columns
+    self.root = root
+    self._pool = pool
+    self.source_code = None
+    self.symbols = None
+
+  def text(self, index):
+    return str(self._pool[self._text_offsets[index]:self._text_offsets[index + 1]], 'utf-8')
+
+
+def compiler_version():
+  """Hash of the lexer and parser code, trees they built are cached under it."""
+  global _compiler_version
+  if _compiler_version is None:
+    version = hashlib.sha256(b'%d' % FORMAT_VERSION)
+    for module in (lexer, parser, sys.modules[__name__]):
+      with open(module.__file__, 'rb') as module_file:
+        version.update(module_file.read())
+    _compiler_version = version.hexdigest()
+  return _compiler_version
+
+
+_compiler_version = None
+
+
+class ParseCache:
+  """Parse trees on disk, keyed by the source code and the compiler version.
+
+  A module whose source code was parsed before by the same compiler is
+  loaded from its file, without tokenizing or parsing it. Trees come back as
+  the ArenaNode of the module, or None for a module with no tokens.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+
+  def path(self, source_bytes):
+    key = hashlib.sha256(compiler_version().encode('ascii'))
+    key.update(source_bytes)
+    return os.path.join(self.directory, key.hexdigest() + '.ast')
+
+  def parse(self, source_code):
+    return self._parse(source_code.encode('utf-8'), lambda: source_code)
+
+  def parse_file(self, path):
+    source_bytes = lexer.map_file(path)
+    return self._parse(source_bytes, lambda: str(source_bytes, 'utf-8'))
+
+  def _parse(self, source_bytes, decode):
+    cache_path = self.path(source_bytes)
+    try:
+      tree = self.load(cache_path)
+    except (OSError, CacheFormatError):
+      tree = None
+    else:
+      return None if tree.root == -1 else tree.node(tree.root)
+    source_code = decode()
+    arena = parser.Arena(source_code)
+    module = parser.parse_source(source_code, builder=arena)
+    self.store(cache_path, arena)
+    return module
+
+  def load(self, cache_path):
+    # An empty file, which cannot be mapped, is no tree either.
+    return load_arena(lexer.map_file(cache_path))
+
+  def store(self, cache_path, arena):
+    # Written to a temporary file first, so that readers never see half of it.
+    with tempfile.NamedTemporaryFile('wb', dir=self.directory, delete=False) as cache_file:
+      dump_arena(arena, cache_file)
+    os.replace(cache_file.name, cache_path)
@@ -1,6 +1,5 @@
-import parser
-import sys
 import os
+import visitor
 
 # Checklist for converting headspace parse trees to target languages:
 # Converting to C
@@ -36,64 +35,98 @@ class SourceCodeFile:
 
 
 def find_module_name(parse_tree):
-  module_name = None
-  for top_node in parse_tree.members:
-    if (top_node.node_type == 'ASSIGNMENT' and
-        top_node.members[0].node_type == 'ASSIGNMENT_TARGET' and
-        top_node.members[0].members[0] == 'moduleName' and
-        top_node.members[2].node_type == 'STRING_LITERAL' and
-        top_node.members[2].members[0][0] == '"'):
-      module_name = top_node.members[2].members[0][1:-1]
-      return module_name
-  return module_name
+  assignment = parse_tree.symbols.assignments.get('moduleName')
+  if (assignment is not None and
+      assignment.value is not None and
+      assignment.value.node_type == 'STRING_LITERAL' and
+      assignment.value.value[0] == '"'):
+    return assignment.value.value[1:-1]
+  return None
 
 
 def find_main_function(parse_tree):
-  for top_node in parse_tree.members:
-    if (top_node.node_type == 'FUNCTION_DECLARATION' and
-        top_node.members[0].node_type == 'IDENTIFIER' and
-        top_node.members[0].members[0] == 'main'):
-      return top_node
-  return None
+  return parse_tree.symbols.functions.get('main')
+
+
+def is_print_call(function_call_node):
+  names = function_call_node.callee.names
+  return len(names) == 2 and names[0].value == 'os' and names[1].value == 'print'
+
+
+def argument_text(argument):
+  # Source text of a string literal or identifier chain argument.
+  if argument.node_type == 'STRING_LITERAL':
+    return argument.value
+  if argument.node_type == 'IDENTIFIER_CHAIN':
+    return argument.text()
+  return ''
+
+
+class Converter(visitor.Visitor):
+  """Emits target code for the nodes of a parse tree, through emit_ methods.
+
+  Each method takes the node, the list of code strings and the indent level.
+  Nodes with no method for their type emit nothing. The code of a foreign
+  code block is one slice of the source, written out as it is.
 
+  emit_code_block emits the statements of a block indent_step deeper than
+  the block, between what begin_code_block and end_code_block emit. Blocks
+  nested in it wait on a stack rather than in nested calls.
+  """
 
-class ConverterToC:
+  method_prefix = 'emit_'
+  indent_step = 2
 
   def __init__(self, parse_tree):
     self.tree = parse_tree
 
+  def generic_visit(self, node, code, indent_level):
+    pass
+
+  def begin_code_block(self, code_block_node, code, indent_level):
+    pass
+
+  def end_code_block(self, code_block_node, code, indent_level):
+    pass
+
+  def emit_code_block(self, code_block_node, code, indent_level):
+    dispatch = self.dispatch
+    indent_step = self.indent_step
+    self.begin_code_block(code_block_node, code, indent_level)
+    # The blocks being emitted, with iterators over the statements left in each.
+    stack = [(code_block_node, iter(code_block_node.statements), indent_level)]
+    while stack:
+      block, statements, block_indent = stack[-1]
+      for member in statements:
+        if member.node_type == 'CODE_BLOCK':
+          self.begin_code_block(member, code, block_indent + indent_step)
+          stack.append((member, iter(member.statements), block_indent + indent_step))
+          break
+        dispatch[member.node_type](member, code, block_indent + indent_step)
+      else:
+        stack.pop()
+        self.end_code_block(block, code, block_indent)
+
+
+class ConverterToC(Converter):
+
   def emit_function_call(self, function_call_node, c_code, indent_level):
-    if function_call_node.members[0].node_type == 'IDENTIFIER_CHAIN':
-      # Handle a print function.
-      if (function_call_node.members[0].members[0].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[0].members[0] == 'os' and
-          function_call_node.members[0].members[2].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[2].members[0] == 'print'):
-        c_code.append(' ' * (indent_level))
-        c_code.append('printf')
-    if function_call_node.members[1].node_type == 'FUNCTION_CALL_ARGUMENTS':
-      c_code.append('("%s", ')
-      if (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-          function_call_node.members[1].members[1].members[0].node_type == 'STRING_LITERAL'):
-        c_code.append(function_call_node.members[1].members[1].members[0].members[0])
-      elif (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-            function_call_node.members[1].members[1].members[0].node_type == 'IDENTIFIER_CHAIN'):
-        for chain_entry in function_call_node.members[1].members[1].members[0].members:
-          c_code.append(chain_entry.members[0])
-      c_code.append(');\n')
+    if is_print_call(function_call_node):
+      c_code.append(' ' * (indent_level))
+      c_code.append('printf')
+    c_code.append('("%s", ')
+    for argument in function_call_node.args:
+      c_code.append(argument_text(argument))
+    c_code.append(');\n')
 
   def emit_foreign_code_block(self, foreign_code_block_node, c_code, indent_level):
-    if foreign_code_block_node.members[0] and foreign_code_block_node.members[0].node_type == 'C':
-      for c_token in foreign_code_block_node.members[0].members:
-        c_code.append(c_token)
+    if foreign_code_block_node.language == 'C':
+      c_code.append(foreign_code_block_node.code)
 
-  def emit_code_block(self, code_block_node, c_code, indent_level):
+  def begin_code_block(self, code_block_node, c_code, indent_level):
     c_code.append('\n{\n')
-    for member in code_block_node.members:
-      if member.node_type == 'FUNCTION_CALL':
-        self.emit_function_call(member, c_code, indent_level + 2)
-      elif member.node_type == 'FOREIGN_CODE_BLOCK':
-        self.emit_foreign_code_block(member, c_code, indent_level + 2)
+
+  def end_code_block(self, code_block_node, c_code, indent_level):
     c_code.append('}\n')
 
   def emit_code(self):
@@ -106,54 +139,30 @@ class ConverterToC:
       # TODO: gather the includes needed to express before source code.
       c_code.append('#include<stdio.h>\n')
       c_code.append('int main(void) ')
-      for member in main_function_declaration.members:
-        if member.node_type == 'FUNCTION_DEFINITION':
-          for def_member in member.members:
-            if def_member.node_type == 'CODE_BLOCK':
-              self.emit_code_block(def_member, c_code, 0)
-              # Append a return statement before the closing } in the main
-              # function's code block.
-              c_code.insert(-1, '  return 0;\n')
+      self.visit(main_function_declaration.body, c_code, 0)
+      # Append a return statement before the closing } in the main
+      # function's code block.
+      c_code.insert(-1, '  return 0;\n')
     return [SourceCodeFile(module_name_c, ''.join(c_code)), SourceCodeFile(module_name_h, '')]
 
 
-class ConverterToPython:
-
-  def __init__(self, parse_tree):
-    self.tree = parse_tree
+class ConverterToPython(Converter):
 
   def emit_function_call(self, function_call_node, py_code, indent_level):
-    if function_call_node.members[0].node_type == 'IDENTIFIER_CHAIN':
-      # Handle a print function.
-      if (function_call_node.members[0].members[0].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[0].members[0] == 'os' and
-          function_call_node.members[0].members[2].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[2].members[0] == 'print'):
-        py_code.append(' ' * (indent_level))
-        py_code.append('print')
-    if function_call_node.members[1].node_type == 'FUNCTION_CALL_ARGUMENTS':
-      py_code.append('(')
-      if (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-          function_call_node.members[1].members[1].members[0].node_type == 'STRING_LITERAL'):
-        py_code.append(function_call_node.members[1].members[1].members[0].members[0])
-      elif (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-            function_call_node.members[1].members[1].members[0].node_type == 'IDENTIFIER_CHAIN'):
-        for chain_entry in function_call_node.members[1].members[1].members[0].members:
-          py_code.append(chain_entry.members[0])
+    if is_print_call(function_call_node):
+      py_code.append(' ' * (indent_level))
+      py_code.append('print')
+    py_code.append('(')
+    for argument in function_call_node.args:
+      py_code.append(argument_text(argument))
       # TODO: only append this special end argument in a print function call.
-      py_code.append(', end="")')
+    py_code.append(', end="")')
 
   def emit_foreign_code_block(self, foreign_code_block_node, py_code, indent_level):
-    if foreign_code_block_node.members[0] and foreign_code_block_node.members[0].node_type == 'PYTHON':
-      for py_token in foreign_code_block_node.members[0].members:
-        py_code.append(py_token)
-
-  def emit_code_block(self, code_block_node, py_code, indent_level):
-    for member in code_block_node.members:
-      if member.node_type == 'FUNCTION_CALL':
-        self.emit_function_call(member, py_code, indent_level + 2)
-      elif member.node_type == 'FOREIGN_CODE_BLOCK':
-        self.emit_foreign_code_block(member, py_code, indent_level + 2)
+    if foreign_code_block_node.language == 'PYTHON':
+      py_code.append(foreign_code_block_node.code)
+
+  def end_code_block(self, code_block_node, py_code, indent_level):
     py_code.append('\n')
 
   def emit_code(self):
@@ -163,52 +172,32 @@ class ConverterToPython:
     main_function_declaration = find_main_function(self.tree)
     if main_function_declaration:
       py_code.append('def main():\n')
-      for member in main_function_declaration.members:
-        if member.node_type == 'FUNCTION_DEFINITION':
-          for def_member in member.members:
-            if def_member.node_type == 'CODE_BLOCK':
-              self.emit_code_block(def_member, py_code, 0)
+      self.visit(main_function_declaration.body, py_code, 0)
       py_code.append('\nif __name__ == \'__main__\':\n  main()\n')
     return [SourceCodeFile(module_name_py, ''.join(py_code))]
 
 
-class ConverterToGo:
+class ConverterToGo(Converter):
 
-  def __init__(self, parse_tree):
-    self.tree = parse_tree
+  indent_step = 1
 
   def emit_function_call(self, function_call_node, go_code, indent_level):
-    if function_call_node.members[0].node_type == 'IDENTIFIER_CHAIN':
-      # Handle a print function.
-      if (function_call_node.members[0].members[0].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[0].members[0] == 'os' and
-          function_call_node.members[0].members[2].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[2].members[0] == 'print'):
-        go_code.append('\t' * (indent_level))
-        go_code.append('fmt.Print')
-    if function_call_node.members[1].node_type == 'FUNCTION_CALL_ARGUMENTS':
-      go_code.append('(')
-      if (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-          function_call_node.members[1].members[1].members[0].node_type == 'STRING_LITERAL'):
-        go_code.append(function_call_node.members[1].members[1].members[0].members[0])
-      elif (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-            function_call_node.members[1].members[1].members[0].node_type == 'IDENTIFIER_CHAIN'):
-        for chain_entry in function_call_node.members[1].members[1].members[0].members:
-          go_code.append(chain_entry.members[0])
-      go_code.append(')')
+    if is_print_call(function_call_node):
+      go_code.append('\t' * (indent_level))
+      go_code.append('fmt.Print')
+    go_code.append('(')
+    for argument in function_call_node.args:
+      go_code.append(argument_text(argument))
+    go_code.append(')')
 
   def emit_foreign_code_block(self, foreign_code_block_node, go_code, indent_level):
-    if foreign_code_block_node.members[0] and foreign_code_block_node.members[0].node_type == 'GO':
-      for go_token in foreign_code_block_node.members[0].members:
-        go_code.append(go_token)
+    if foreign_code_block_node.language == 'GO':
+      go_code.append(foreign_code_block_node.code)
 
-  def emit_code_block(self, code_block_node, go_code, indent_level):
+  def begin_code_block(self, code_block_node, go_code, indent_level):
     go_code.append('{\n')
-    for member in code_block_node.members:
-      if member.node_type == 'FUNCTION_CALL':
-        self.emit_function_call(member, go_code, indent_level + 1)
-      elif member.node_type == 'FOREIGN_CODE_BLOCK':
-        self.emit_foreign_code_block(member, go_code, indent_level + 1)
+
+  def end_code_block(self, code_block_node, go_code, indent_level):
     go_code.append('\n')
     if indent_level > 0:
       go_code.append('\t' * indent_level)
@@ -222,53 +211,31 @@ class ConverterToGo:
       go_code.append('package main\n\n')
       go_code.append('import "fmt"\n\n')
       go_code.append('func main() ')
-      for member in main_function_declaration.members:
-        if member.node_type == 'FUNCTION_DEFINITION':
-          for def_member in member.members:
-            if def_member.node_type == 'CODE_BLOCK':
-              self.emit_code_block(def_member, go_code, 0)
+      self.visit(main_function_declaration.body, go_code, 0)
       # Create file name with a main.go module.
       main_module_filename = os.path.join(module_name, 'main.go')
       return [SourceCodeFile(main_module_filename, ''.join(go_code))]
 
 
-class ConverterToJavaScript:
-
-  def __init__(self, parse_tree):
-    self.tree = parse_tree
+class ConverterToJavaScript(Converter):
 
   def emit_function_call(self, function_call_node, js_code, indent_level):
-    if function_call_node.members[0].node_type == 'IDENTIFIER_CHAIN':
-      # Handle a print function.
-      if (function_call_node.members[0].members[0].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[0].members[0] == 'os' and
-          function_call_node.members[0].members[2].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[2].members[0] == 'print'):
-        js_code.append(' ' * (indent_level))
-        js_code.append('process.stdout.write')
-    if function_call_node.members[1].node_type == 'FUNCTION_CALL_ARGUMENTS':
-      js_code.append('(')
-      if (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-          function_call_node.members[1].members[1].members[0].node_type == 'STRING_LITERAL'):
-        js_code.append(function_call_node.members[1].members[1].members[0].members[0])
-      elif (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-            function_call_node.members[1].members[1].members[0].node_type == 'IDENTIFIER_CHAIN'):
-        for chain_entry in function_call_node.members[1].members[1].members[0].members:
-          js_code.append(chain_entry.members[0])
-      js_code.append(');')
+    if is_print_call(function_call_node):
+      js_code.append(' ' * (indent_level))
+      js_code.append('process.stdout.write')
+    js_code.append('(')
+    for argument in function_call_node.args:
+      js_code.append(argument_text(argument))
+    js_code.append(');')
 
   def emit_foreign_code_block(self, foreign_code_block_node, js_code, indent_level):
-    if foreign_code_block_node.members[0] and foreign_code_block_node.members[0].node_type == 'JS':
-      for js_token in foreign_code_block_node.members[0].members:
-        js_code.append(js_token)
+    if foreign_code_block_node.language == 'JS':
+      js_code.append(foreign_code_block_node.code)
 
-  def emit_code_block(self, code_block_node, js_code, indent_level):
+  def begin_code_block(self, code_block_node, js_code, indent_level):
     js_code.append('{\n')
-    for member in code_block_node.members:
-      if member.node_type == 'FUNCTION_CALL':
-        self.emit_function_call(member, js_code, indent_level + 2)
-      elif member.node_type == 'FOREIGN_CODE_BLOCK':
-        self.emit_foreign_code_block(member, js_code, indent_level + 2)
+
+  def end_code_block(self, code_block_node, js_code, indent_level):
     js_code.append('\n')
     if indent_level > 0:
       js_code.append(' ' * indent_level)
@@ -280,56 +247,34 @@ class ConverterToJavaScript:
     main_function_declaration = find_main_function(self.tree)
     if main_function_declaration:
       js_code.append('function main() ')
-      for member in main_function_declaration.members:
-        if member.node_type == 'FUNCTION_DEFINITION':
-          for def_member in member.members:
-            if def_member.node_type == 'CODE_BLOCK':
-              self.emit_code_block(def_member, js_code, 0)
+      self.visit(main_function_declaration.body, js_code, 0)
       js_code.append('\nmain();\n')
       module_filename = module_name + '.js'
       return [SourceCodeFile(module_filename, ''.join(js_code))]
 
 
-class ConverterToJava:
-
-  def __init__(self, parse_tree):
-    self.tree = parse_tree
+class ConverterToJava(Converter):
 
   def emit_function_call(self, function_call_node, java_code, indent_level):
-    if function_call_node.members[0].node_type == 'IDENTIFIER_CHAIN':
-      # Handle a print function.
-      if (function_call_node.members[0].members[0].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[0].members[0] == 'os' and
-          function_call_node.members[0].members[2].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[2].members[0] == 'print'):
-        java_code.append(' ' * (indent_level))
-        java_code.append('System.out.print')
-    if function_call_node.members[1].node_type == 'FUNCTION_CALL_ARGUMENTS':
-      java_code.append('(')
-      if (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-          function_call_node.members[1].members[1].members[0].node_type == 'STRING_LITERAL'):
-        java_code.append(function_call_node.members[1].members[1].members[0].members[0])
-      elif (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-            function_call_node.members[1].members[1].members[0].node_type == 'IDENTIFIER_CHAIN'):
-        for chain_entry in function_call_node.members[1].members[1].members[0].members:
-          java_code.append(chain_entry.members[0])
-      java_code.append(');')
+    if is_print_call(function_call_node):
+      java_code.append(' ' * (indent_level))
+      java_code.append('System.out.print')
+    java_code.append('(')
+    for argument in function_call_node.args:
+      java_code.append(argument_text(argument))
+    java_code.append(');')
 
   def emit_foreign_code_block(self, foreign_code_block_node, java_code, indent_level):
-    if foreign_code_block_node.members[0] and foreign_code_block_node.members[0].node_type == 'JAVA':
-      for java_token in foreign_code_block_node.members[0].members:
-        java_code.append(java_token)
+    if foreign_code_block_node.language == 'JAVA':
+      java_code.append(foreign_code_block_node.code)
 
-  def emit_code_block(self, code_block_node, java_code, indent_level):
+  def begin_code_block(self, code_block_node, java_code, indent_level):
     java_code.append('\n')
     if indent_level > 0:
       java_code.append(' ' * indent_level)
     java_code.append('{\n')
-    for member in code_block_node.members:
-      if member.node_type == 'FUNCTION_CALL':
-        self.emit_function_call(member, java_code, indent_level + 2)
-      elif member.node_type == 'FOREIGN_CODE_BLOCK':
-        self.emit_foreign_code_block(member, java_code, indent_level + 2)
+
+  def end_code_block(self, code_block_node, java_code, indent_level):
     java_code.append('\n')
     if indent_level > 0:
       java_code.append(' ' * indent_level)
@@ -344,54 +289,32 @@ class ConverterToJava:
       java_code.append('public class ' + java_class_name + '\n')
       java_code.append('{\n')
       java_code.append('  public static void main(String[] args)')
-      for member in main_function_declaration.members:
-        if member.node_type == 'FUNCTION_DEFINITION':
-          for def_member in member.members:
-            if def_member.node_type == 'CODE_BLOCK':
-              self.emit_code_block(def_member, java_code, 2)
+      self.visit(main_function_declaration.body, java_code, 2)
       java_code.append('}\n')
       # Create file name with a .java class file.
       java_class_filename = java_class_name + '.java'
       return [SourceCodeFile(java_class_filename, ''.join(java_code))]
 
 
-class ConverterToDotNet:
-
-  def __init__(self, parse_tree):
-    self.tree = parse_tree
+class ConverterToDotNet(Converter):
 
   def emit_function_call(self, function_call_node, dotnet_code, indent_level):
-    if function_call_node.members[0].node_type == 'IDENTIFIER_CHAIN':
-      # Handle a print function.
-      if (function_call_node.members[0].members[0].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[0].members[0] == 'os' and
-          function_call_node.members[0].members[2].node_type == 'IDENTIFIER' and
-          function_call_node.members[0].members[2].members[0] == 'print'):
-        dotnet_code.append(' ' * (indent_level))
-        dotnet_code.append('Console.Write')
-    if function_call_node.members[1].node_type == 'FUNCTION_CALL_ARGUMENTS':
-      dotnet_code.append('(')
-      if (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-          function_call_node.members[1].members[1].members[0].node_type == 'STRING_LITERAL'):
-        dotnet_code.append(function_call_node.members[1].members[1].members[0].members[0])
-      elif (function_call_node.members[1].members[1].node_type == 'ARGUMENTS' and
-            function_call_node.members[1].members[1].members[0].node_type == 'IDENTIFIER_CHAIN'):
-        for chain_entry in function_call_node.members[1].members[1].members[0].members:
-          dotnet_code.append(chain_entry.members[0])
-      dotnet_code.append(');')
+    if is_print_call(function_call_node):
+      dotnet_code.append(' ' * (indent_level))
+      dotnet_code.append('Console.Write')
+    dotnet_code.append('(')
+    for argument in function_call_node.args:
+      dotnet_code.append(argument_text(argument))
+    dotnet_code.append(');')
 
   def emit_foreign_code_block(self, foreign_code_block_node, dotnet_code, indent_level):
-    if foreign_code_block_node.members[0] and foreign_code_block_node.members[0].node_type == 'DOTNET':
-      for dotnet_token in foreign_code_block_node.members[0].members:
-        dotnet_code.append(dotnet_token)
+    if foreign_code_block_node.language == 'DOTNET':
+      dotnet_code.append(foreign_code_block_node.code)
 
-  def emit_code_block(self, code_block_node, dotnet_code, indent_level):
+  def begin_code_block(self, code_block_node, dotnet_code, indent_level):
     dotnet_code.append('{\n')
-    for member in code_block_node.members:
-      if member.node_type == 'FUNCTION_CALL':
-        self.emit_function_call(member, dotnet_code, indent_level + 2)
-      elif member.node_type == 'FOREIGN_CODE_BLOCK':
-        self.emit_foreign_code_block(member, dotnet_code, indent_level + 2)
+
+  def end_code_block(self, code_block_node, dotnet_code, indent_level):
     dotnet_code.append('\n')
     if indent_level > 0:
       dotnet_code.append(' ' * indent_level)
@@ -408,11 +331,7 @@ class ConverterToDotNet:
       dotnet_code.append('namespace ' + dotnet_class_name + ' {\n')
       dotnet_code.append('  class MainProgram {\n')
       dotnet_code.append('    static void Main(string[] args) ')
-      for member in main_function_declaration.members:
-        if member.node_type == 'FUNCTION_DEFINITION':
-          for def_member in member.members:
-            if def_member.node_type == 'CODE_BLOCK':
-              self.emit_code_block(def_member, dotnet_code, 4)
+      self.visit(main_function_declaration.body, dotnet_code, 4)
       dotnet_code.append('  }\n')
       dotnet_code.append('}\n')
       # Create file name with a .cs (C#) module.
@@ -434,7 +353,6 @@ def convert(parse_tree, target_langauge):
   elif target_langauge == 'dotnet':
     converter = ConverterToDotNet(parse_tree)
   else:
-    print('invalid language selected for output')
-    sys.exit(1)
+    raise ValueError('invalid language selected for output: %r' % target_langauge)
   return converter.emit_code()
 
@@ -0,0 +1,156 @@
+import argparse
+import json.encoder
+import sys
+
+import lexer
+import parser
+
+
+# Output formats: one JSON object per line, or S-expressions.
+FORMATS = ('jsonl', 'sexp')
+
+# Pieces of output collected before each write to the output file.
+_BUFFERED_PARTS = 4096
+
+
+# Quotes and escapes a string the way json.dumps(ensure_ascii=False) does,
+# without the cost of going through the encoder for each value.
+_json_string = json.encoder.encode_basestring
+
+
+def _offset(offset, none):
+  return none if offset is None else str(offset)
+
+
+def dump_tree(tree, output_file, format='jsonl'):
+  """Writes a parse tree to a text file as it walks it, in preorder.
+
+  jsonl writes a line per node: its type, id and the id of its parent,
+  offsets, and the value of leaves and the language and code of foreign
+  code blocks. sexp writes (TYPE start end children...) with one node per
+  line, leaf values as JSON strings. Offsets a node does not have are null
+  or nil. Typed nodes and ArenaNodes are written the same.
+  """
+  if format not in FORMATS:
+    raise ValueError('format must be one of %s' % ', '.join(FORMATS))
+  if tree is None:
+    return
+  if format == 'jsonl':
+    _dump_tree_jsonl(tree, output_file)
+  else:
+    _dump_tree_sexp(tree, output_file)
+
+
+def _dump_tree_jsonl(tree, output_file):
+  parts = []
+  next_id = 0
+  stack = [(tree, -1)]
+  while stack:
+    node, parent_id = stack.pop()
+    node_type = node.node_type
+    parts.append('{"id": %d, "parent": %d, "type": "%s", "start": %s, "end": %s' % (
+        next_id, parent_id, node_type, _offset(node.start, 'null'), _offset(node.end, 'null')))
+    if node_type == 'FOREIGN_CODE_BLOCK':
+      parts.append(', "language": "%s", "value": %s}\n' % (node.language,
+                                                            _json_string(node.code)))
+    elif node.leaf:
+      parts.append(', "value": %s}\n' % _json_string(node.value))
+    else:
+      parts.append('}\n')
+      children = node.children()
+      children.reverse()
+      stack.extend((child, next_id) for child in children)
+    next_id += 1
+    if len(parts) >= _BUFFERED_PARTS:
+      output_file.write(''.join(parts))
+      parts.clear()
+  output_file.write(''.join(parts))
+
+
+# Marks the end of a node's children on the stack of _dump_tree_sexp.
+_CLOSE = object()
+
+
+def _dump_tree_sexp(tree, output_file):
+  parts = []
+  stack = [(tree, 0)]
+  while stack:
+    node, depth = stack.pop()
+    if node is _CLOSE:
+      parts.append(')')
+      continue
+    if parts:
+      parts.append('\n')
+    node_type = node.node_type
+    parts.append('%s(%s %s %s' % (' ' * depth, node_type, _offset(node.start, 'nil'),
+                                  _offset(node.end, 'nil')))
+    if node_type == 'FOREIGN_CODE_BLOCK':
+      parts.append(' %s %s)' % (node.language, _json_string(node.code)))
+    elif node.leaf:
+      parts.append(' %s)' % _json_string(node.value))
+    else:
+      stack.append((_CLOSE, None))
+      children = node.children()
+      children.reverse()
+      stack.extend((child, depth + 2) for child in children)
+    if len(parts) >= _BUFFERED_PARTS:
+      output_file.write(''.join(parts))
+      parts.clear()
+  parts.append('\n')
+  output_file.write(''.join(parts))
+
+
+def dump_tokens(tokens, output_file, format='jsonl'):
+  """Writes tokens, any iterable of lexer.Token, to a text file as they come.
+
+  Each token goes on a line, as {"type": ..., "start": ..., "content": ...}
+  in jsonl or (TYPE start "content") in sexp.
+  """
+  if format not in FORMATS:
+    raise ValueError('format must be one of %s' % ', '.join(FORMATS))
+  if format == 'jsonl':
+    line = '{"type": "%s", "start": %s, "content": %s}\n'
+    none = 'null'
+  else:
+    line = '(%s %s %s)\n'
+    none = 'nil'
+  parts = []
+  for token in tokens:
+    parts.append(line % (token.token_type, _offset(token.start, none),
+                         _json_string(token.content)))
+    if len(parts) >= _BUFFERED_PARTS:
+      output_file.write(''.join(parts))
+      parts.clear()
+  output_file.write(''.join(parts))
+
+
+def main(argv=None):
+  argument_parser = argparse.ArgumentParser(
+      description='Writes the parse tree or the tokens of a Headspace source file.')
+  argument_parser.add_argument('source_file')
+  argument_parser.add_argument('--format', choices=FORMATS, default='jsonl')
+  argument_parser.add_argument('--tokens', action='store_true',
+                               help='write the tokens, spaces and comments included')
+  argument_parser.add_argument('-o', '--output', help='file to write to instead of stdout')
+  args = argument_parser.parse_args(argv)
+  diagnostics = []
+  output_file = sys.stdout if args.output is None else open(args.output, 'w', encoding='utf-8')
+  try:
+    with open(args.source_file, encoding='utf-8') as source_file:
+      if args.tokens:
+        # Read in chunks, the whole source is never in memory.
+        dump_tokens(lexer.iter_tokens(source_file), output_file, args.format)
+      else:
+        dump_tree(parser.parse_source(source_file.read(), diagnostics=diagnostics),
+                  output_file, args.format)
+  finally:
+    if output_file is not sys.stdout:
+      output_file.close()
+  # The tree of what did parse is written, errors go to stderr.
+  for error in diagnostics:
+    print('%s: %s' % (args.source_file, error), file=sys.stderr)
+  return 1 if diagnostics else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
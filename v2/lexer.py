@@ -9,11 +9,52 @@
 #    single-line done
 # symbol - done
 # space - done
+# foreign code block - done
+
+import bisect
+import enum
+import importlib
+import importlib.util
+import mmap
+import os
+import re
+import sys
+from array import array
+
+# Imported by the first NumpyTokenizer, importing it takes longer than
+# tokenizing most sources. The numpy engine is only available with NumPy
+# installed.
+numpy = None
+
+
+class TokenKind(enum.IntEnum):
+  IDENTIFIER = 1
+  NUMBER = 2
+  SPACE = 3
+  STRING = 4
+  COMMENT = 5
+  SYMBOL = 6
+  # A whole BEGIN_FOREIGN_CODE_<LANG> ... END_FOREIGN_CODE_<LANG> block.
+  FOREIGN_CODE = 7
+
+
+# Token kinds that carry no meaning for the parser.
+TRIVIA_KINDS = (TokenKind.SPACE, TokenKind.COMMENT)
+TRIVIA_TYPES = ('SPACE', 'COMMENT')
+
+# Token kinds whose contents go through a SymbolTable.
+INTERNED_KINDS = (TokenKind.IDENTIFIER, TokenKind.NUMBER, TokenKind.STRING, TokenKind.SYMBOL)
+INTERNED_TYPES = ('IDENTIFIER', 'NUMBER', 'STRING', 'SYMBOL')
+# Symbol ID of tokens that are not interned.
+NO_SYMBOL = -1
+
 
 class Token:
-  def __init__(self, content, token_type):
+  def __init__(self, content, token_type, start=None):
     self.content = content
     self.token_type = token_type
+    # Offset of the token's first character in the source code.
+    self.start = start
 
   def print(self, indent_level=0):
     if self.token_type == 'SPACE':
@@ -49,6 +90,7 @@ class Tokenizer:
     return None
 
   def next_identifier(self):
+    start = self.index
     self.buffer.append(self.current_char())
     next_char = self.next_char()
     while next_char is not None and (next_char.isalnum() or next_char == '_'):
@@ -58,9 +100,14 @@ class Tokenizer:
     self.index += 1
     contents = ''.join(self.buffer)
     self.buffer = []
-    return Token(contents, 'IDENTIFIER')
+    if contents.startswith(FOREIGN_CODE_BEGIN):
+      # The code up to the end marker is kept as it is.
+      self.index = find_foreign_code_end(self._source_code, self.index)
+      return Token(self._source_code[start:self.index], 'FOREIGN_CODE', start)
+    return Token(contents, 'IDENTIFIER', start)
 
   def next_number(self):
+    start = self.index
     self.buffer.append(self.current_char())
     next_char = self.next_char()
     has_encountered_dot = False
@@ -73,9 +120,10 @@ class Tokenizer:
     self.index += 1
     contents = ''.join(self.buffer)
     self.buffer = []
-    return Token(contents, 'NUMBER')
+    return Token(contents, 'NUMBER', start)
 
   def next_space(self):
+    start = self.index
     self.buffer.append(self.current_char())
     next_char = self.next_char()
     while next_char is not None and next_char.isspace():
@@ -85,9 +133,10 @@ class Tokenizer:
     self.index += 1
     contents = ''.join(self.buffer)
     self.buffer = []
-    return Token(contents, 'SPACE')
+    return Token(contents, 'SPACE', start)
 
   def next_string(self):
+    start = self.index
     self.buffer.append(self.current_char())
     next_char = self.next_char()
     quote_char = self.current_char()
@@ -106,9 +155,10 @@ class Tokenizer:
       self.index += 1
     contents = ''.join(self.buffer)
     self.buffer = []
-    return Token(contents, 'STRING')
+    return Token(contents, 'STRING', start)
 
   def next_comment(self):
+    start = self.index
     # Adds the opening /
     self.buffer.append(self.current_char())
     next_char = self.next_char()
@@ -117,7 +167,7 @@ class Tokenizer:
     single_line_comment = next_char == '/'
     self.index += 1
     next_char = self.next_char()
-    if single_line_comment: # This part is broken.
+    if single_line_comment:
       while next_char is not None and next_char != '\n' and next_char != '\r':
         self.index += 1
         self.buffer.append(self.current_char())
@@ -126,7 +176,8 @@ class Tokenizer:
         self.index += 1
         # Append the closing newline as part of the comment.
         self.buffer.append(self.current_char())
-        self.index += 1
+      # Step past the last character of the comment, even at the end of input.
+      self.index += 1
     else:
       about_to_close = False
       while next_char is not None:
@@ -142,9 +193,12 @@ class Tokenizer:
           break
         elif about_to_close:
           about_to_close = False
+      else:
+        # Unterminated comment, it runs to the end of the input.
+        self.index += 1
     contents = ''.join(self.buffer)
     self.buffer = []
-    return Token(contents, 'COMMENT')
+    return Token(contents, 'COMMENT', start)
 
   def next_line(self):
     line_content = []
@@ -159,10 +213,11 @@ class Tokenizer:
     return ''.join(line_content)
 
   def next_symbol(self):
+    start = self.index
     # Always a single character.
     contents = self.current_char()
     self.index += 1
-    return Token(contents, 'SYMBOL')
+    return Token(contents, 'SYMBOL', start)
 
   def next_token(self):
     if self.current_char() is None:
@@ -180,13 +235,1042 @@ class Tokenizer:
     else:
       return self.next_symbol()
 
+  def scan(self):
+    # Yields (kind, start, end) for each token.
+    current_token = self.next_token()
+    while current_token is not None:
+      yield TokenKind[current_token.token_type], current_token.start, self.index
+      current_token = self.next_token()
+
+
+FOREIGN_CODE_BEGIN = 'BEGIN_FOREIGN_CODE_'
+FOREIGN_CODE_END = 'END_FOREIGN_CODE_'
+# The end marker counts only as a whole identifier.
+_FOREIGN_CODE_END = re.compile(r'(?<!\w)END_FOREIGN_CODE_\w*')
+_FOREIGN_CODE_BEGIN = re.compile(r'BEGIN_FOREIGN_CODE_\w*')
+
+
+def find_foreign_code_end(source_code, index):
+  # Returns the end of the foreign code block whose begin marker ends at index.
+  match = _FOREIGN_CODE_END.search(source_code, index)
+  if match is None:
+    return len(source_code)
+  return match.end()
+
+
+def split_foreign_code(source_code, start=0, end=None):
+  """Splits a FOREIGN_CODE token found between start and end in source_code.
+
+  Returns the language named by the begin marker and the offsets of the code
+  between the markers. The block may run to the end of the source without an
+  end marker.
+  """
+  if end is None:
+    end = len(source_code)
+  code_start = _FOREIGN_CODE_BEGIN.match(source_code, start).end()
+  language = source_code[start + len(FOREIGN_CODE_BEGIN):code_start]
+  code_end = end
+  # The end marker, if any, closes the token.
+  end_marker = source_code.rfind(FOREIGN_CODE_END, code_start, end)
+  if end_marker != -1:
+    match = _FOREIGN_CODE_END.match(source_code, end_marker, end)
+    if match is None or match.end() != end:
+      match = _FOREIGN_CODE_END.search(source_code, code_start, end)
+    if match is not None and match.end() == end:
+      code_end = match.start()
+  return language, code_start, code_end
+
+
+def _character_class(chars):
+  # Collapses a sorted run of code points into a regex character class body.
+  ranges = []
+  for char in chars:
+    if ranges and ord(char) == ord(ranges[-1][1]) + 1:
+      ranges[-1][1] = char
+    else:
+      ranges.append([char, char])
+  parts = []
+  for first, last in ranges:
+    if first == last:
+      parts.append(re.escape(first))
+    else:
+      parts.append(re.escape(first) + '-' + re.escape(last))
+  return ''.join(parts)
+
+
+# Compiled token_pattern() by whether it is the ASCII only one.
+_token_patterns = {}
+
+
+def token_pattern(ascii=False):
+  """Returns the master pattern used by RegexTokenizer, compiled on first use.
+
+  Each token type is a named group, tried in the same order as the checks in
+  Tokenizer.next_token. Foreign code blocks come first since their begin
+  marker would otherwise match as an identifier. Tokenizer relies on
+  str.isalpha() and str.isnumeric(), which do not line up with \\d and \\w,
+  so the numeric code points outside of ASCII are collected once to build
+  matching character classes.
+
+  Collecting them takes a pass over all of Unicode. With ascii, the pattern
+  returned is only right for ASCII text and skips that pass.
+  """
+  pattern = _token_patterns.get(ascii)
+  if pattern is None:
+    numeric = []
+    numeric_alpha = []
+    if not ascii:
+      for char in map(chr, range(0x80, sys.maxunicode + 1)):
+        if char.isnumeric():
+          if char.isalpha():
+            numeric_alpha.append(char)
+          else:
+            numeric.append(char)
+    digit = '0-9' + _character_class(numeric)
+    digit_or_alpha = digit + _character_class(numeric_alpha)
+    pattern = _token_patterns[ascii] = re.compile('|'.join((
+        r'(?P<FOREIGN_CODE>BEGIN_FOREIGN_CODE_\w*(?:[\s\S]*?(?<!\w)END_FOREIGN_CODE_\w*|[\s\S]*))',
+        # \w is exactly str.isalnum() plus _, removing digits leaves isalpha().
+        r'(?P<IDENTIFIER>[^\W_%s]\w*)' % digit,
+        r'(?P<NUMBER>[%s][%s]*(?:\.[%s]*)?)' % (digit, digit_or_alpha, digit_or_alpha),
+        r'(?P<SPACE>\s+)',
+        r'(?P<STRING>\'(?:[^\'\\]+|\\[\s\S]?)*\'?|"(?:[^"\\]+|\\[\s\S]?)*"?)',
+        r'(?P<COMMENT>//[^\n\r]*[\n\r]?|/\*(?:[\s\S]*?\*/|[\s\S]*))',
+        r'(?P<SYMBOL>[\s\S])',
+    )))
+  return pattern
+
+
+# Token kinds by group number in token_pattern().
+_GROUP_KINDS = (
+  None,
+  TokenKind.FOREIGN_CODE,
+  TokenKind.IDENTIFIER,
+  TokenKind.NUMBER,
+  TokenKind.SPACE,
+  TokenKind.STRING,
+  TokenKind.COMMENT,
+  TokenKind.SYMBOL,
+)
+
+
+class RegexTokenizer:
+  """Produces the same tokens as Tokenizer using a single compiled pattern.
+
+  Token contents are sliced straight out of the source instead of being
+  assembled one character at a time. ASCII sources use the pattern that is
+  quicker to build.
+  """
+
+  def __init__(self, source_code):
+    self._source_code = source_code
+    self._source_len = len(source_code)
+    self._pattern = token_pattern(source_code.isascii())
+    self._match = self._pattern.match
+    self.index = 0
+
+  def next_token(self):
+    if self.index >= self._source_len:
+      return None
+    match = self._match(self._source_code, self.index)
+    self.index = match.end()
+    return Token(match.group(), match.lastgroup, match.start())
+
+  def scan(self):
+    # Yields (kind, start, end) for each token.
+    group_kinds = _GROUP_KINDS
+    for match in self._pattern.finditer(self._source_code, self.index):
+      yield group_kinds[match.lastindex], match.start(), match.end()
+    self.index = self._source_len
+
+
+# Character classes of NumpyTokenizer, the classes of identifier characters
+# come first.
+CHAR_OTHER = 0
+CHAR_ALPHA = 1
+CHAR_NUMERIC_ALPHA = 2
+CHAR_DIGIT = 3
+CHAR_UNDERSCORE = 4
+CHAR_SPACE = 5
+CHAR_QUOTE = 6
+CHAR_SLASH = 7
+_LAST_WORD_CLASS = CHAR_UNDERSCORE
+
+
+def _char_class(char):
+  # Follows the checks in Tokenizer.next_token.
+  if char == '\'' or char == '"':
+    return CHAR_QUOTE
+  elif char == '/':
+    return CHAR_SLASH
+  elif char == '_':
+    return CHAR_UNDERSCORE
+  elif char.isalpha():
+    return CHAR_NUMERIC_ALPHA if char.isnumeric() else CHAR_ALPHA
+  elif char.isnumeric():
+    return CHAR_DIGIT
+  elif char.isspace():
+    return CHAR_SPACE
+  return CHAR_OTHER
+
+
+_STRING = re.compile(r"'(?:[^'\\]+|\\[\s\S]?)*'?" r'|"(?:[^"\\]+|\\[\s\S]?)*"?')
+_COMMENT = re.compile(r'//[^\n\r]*[\n\r]?|/\*(?:[\s\S]*?\*/|[\s\S]*)')
 
-def tokenize(source_code):
-  tokenizer = Tokenizer(source_code)
+
+class NumpyTokenizer:
+  """Produces the same tokens as Tokenizer from a vectorized pre-scan.
+
+  Every character is classified in one NumPy pass, and the boundaries of runs
+  of identifier characters and of spaces are found with np.diff. Runs that
+  start an identifier or a space, and other single characters, are tokens as
+  they are. Python only scans from the runs that start a number, a string, a
+  comment or a foreign code block, up to the next run boundary. Only
+  available when NumPy is installed.
+  """
+
+  def __init__(self, source_code):
+    _import_numpy()
+    self._source_code = source_code
+    self._source_len = len(source_code)
+    self._scanner = None
+    self.index = 0
+
+  def next_token(self):
+    if self._scanner is None:
+      self._scanner = self.scan()
+    for kind, start, end in self._scanner:
+      return Token(self._source_code[start:end], kind.name, start)
+    return None
+
+  def _classify(self):
+    # Returns the class of each character as a NumPy array.
+    source_code = self._source_code
+    if source_code.isascii():
+      codes = numpy.frombuffer(source_code.encode('ascii'), numpy.uint8)
+    else:
+      codes = numpy.frombuffer(source_code.encode('utf-32-le', 'surrogatepass'), numpy.uint32)
+    classes = _ascii_char_classes()[numpy.minimum(codes, 127)]
+    non_ascii = codes > 127
+    if non_ascii.any():
+      # Few distinct characters outside of ASCII, classified one at a time.
+      non_ascii_codes = codes[non_ascii]
+      distinct = numpy.unique(non_ascii_codes)
+      distinct_classes = numpy.array([_char_class(chr(code)) for code in distinct.tolist()],
+                                     numpy.uint8)
+      classes[non_ascii] = distinct_classes[numpy.searchsorted(distinct, non_ascii_codes)]
+    return classes
+
+  def _run_starts(self, classes):
+    # Splits the source into runs of identifier characters, runs of spaces and
+    # single other characters, returns the offsets where they start.
+    is_word = classes <= _LAST_WORD_CLASS
+    is_word &= classes != CHAR_OTHER
+    groups = numpy.where(is_word, CHAR_ALPHA, classes)
+    is_single = ~is_word
+    is_single &= classes != CHAR_SPACE
+    boundaries = numpy.empty(len(classes), bool)
+    boundaries[0] = True
+    numpy.not_equal(groups[1:], groups[:-1], out=boundaries[1:])
+    boundaries[1:] |= is_single[1:]
+    return numpy.flatnonzero(boundaries)
+
+  def _number_end(self, index):
+    # Numbers may hold one dot, and so span runs.
+    source_code = self._source_code
+    source_len = self._source_len
+    has_encountered_dot = False
+    index += 1
+    while index < source_len:
+      char = source_code[index]
+      if char.isnumeric():
+        index += 1
+      elif char == '.' and not has_encountered_dot:
+        has_encountered_dot = True
+        index += 1
+      else:
+        break
+    return index
+
+  def _next_token(self, index, char_class, run_end, foreign_code_starts):
+    # Returns the kind and end of the token at index, run_end is the end of
+    # the run holding index.
+    source_code = self._source_code
+    if char_class == CHAR_ALPHA or char_class == CHAR_NUMERIC_ALPHA:
+      if index in foreign_code_starts:
+        return TokenKind.FOREIGN_CODE, find_foreign_code_end(source_code, run_end)
+      return TokenKind.IDENTIFIER, run_end
+    elif char_class == CHAR_SPACE:
+      return TokenKind.SPACE, run_end
+    elif char_class == CHAR_DIGIT:
+      return TokenKind.NUMBER, self._number_end(index)
+    elif char_class == CHAR_QUOTE:
+      return TokenKind.STRING, _STRING.match(source_code, index).end()
+    elif (char_class == CHAR_SLASH and index + 1 < self._source_len and
+          source_code[index + 1] in '*/'):
+      return TokenKind.COMMENT, _COMMENT.match(source_code, index).end()
+    return TokenKind.SYMBOL, index + 1
+
+  def columns(self):
+    """Returns the kinds, starts and ends of all tokens as NumPy arrays."""
+    source_len = self._source_len
+    if source_len == 0:
+      empty = numpy.zeros(0, numpy.int64)
+      return empty.astype(numpy.uint8), empty, empty
+    classes = self._classify()
+    starts = self._run_starts(classes)
+    ends = numpy.append(starts[1:], source_len)
+    run_classes = classes[starts]
+    kinds = _RUN_KINDS[run_classes]
+    # Identifier runs that start a foreign code block need scanning as well.
+    foreign_code_starts = {match.start() for match in
+                           re.finditer(FOREIGN_CODE_BEGIN, self._source_code)}
+    if foreign_code_starts:
+      is_begin_marker = numpy.zeros(source_len, bool)
+      is_begin_marker[list(foreign_code_starts)] = True
+      kinds[is_begin_marker[starts]] = 0
+    irregular = numpy.flatnonzero(kinds == 0).tolist()
+    if not irregular:
+      return kinds, starts, ends
+    keep = numpy.ones(len(starts), bool)
+    # Run starts with the end of the source after the last one.
+    run_starts = starts.tolist()
+    run_starts.append(source_len)
+    scanned_kinds = []
+    scanned_starts = []
+    scanned_ends = []
+    # Everything before position has been scanned.
+    position = 0
+    for run, char_class in zip(irregular, run_classes[irregular].tolist()):
+      index = run_starts[run]
+      if index < position:
+        continue
+      first_run = run
+      while True:
+        kind, end = self._next_token(index, char_class, run_starts[run + 1], foreign_code_starts)
+        scanned_kinds.append(kind)
+        scanned_starts.append(index)
+        scanned_ends.append(end)
+        index = end
+        # Stop at the next run boundary.
+        run += 1
+        if run_starts[run] < index:
+          run = bisect.bisect_right(run_starts, index, run) - 1
+        elif run_starts[run] > index:
+          run -= 1
+        if run_starts[run] == index:
+          break
+        # A number, or a comment closed by a newline, ended inside the run.
+        char_class = int(classes[index])
+      keep[first_run:run] = False
+      position = index
+    kinds = numpy.concatenate((kinds[keep], numpy.array(scanned_kinds, numpy.uint8)))
+    starts = numpy.concatenate((starts[keep], scanned_starts))
+    ends = numpy.concatenate((ends[keep], scanned_ends))
+    order = numpy.argsort(starts, kind='stable')
+    return kinds[order], starts[order], ends[order]
+
+  def scan(self):
+    # Yields (kind, start, end) for each token from index on, which has to be
+    # the start of a token. The text is classified a window at a time, each
+    # twice as long as the one before, so that a caller stopping early, as
+    # IncrementalLexer does, pays for what it read and not for the rest.
+    source_code = self._source_code
+    source_len = self._source_len
+    token_kinds = _TOKEN_KINDS
+    window = _SCAN_WINDOW
+    while self.index < source_len:
+      # No token reaches across a token start, the text before it is left out.
+      base = self.index
+      window_end = base + window
+      kinds, starts, ends = NumpyTokenizer(source_code[base:window_end]).columns()
+      count = len(kinds)
+      if window_end < source_len:
+        # The last token may go on past the window, it is scanned again at the
+        # start of the next one. The others are followed by a token, and the
+        # lexer never looks further than one character past a token.
+        count -= 1
+      window *= 2
+      for kind, start, end in zip(kinds[:count].tolist(), starts[:count].tolist(),
+                                  ends[:count].tolist()):
+        self.index = base + end
+        yield token_kinds[kind], base + start, base + end
+
+  def fill(self, buffer, trivia=None):
+    # Appends all tokens to a TokenBuffer at once, spaces and comments to the
+    # trivia table if there is one.
+    kinds, starts, ends = self.columns()
+    if trivia is not None:
+      is_trivia = kinds == TokenKind.SPACE
+      is_trivia |= kinds == TokenKind.COMMENT
+      is_significant = ~is_trivia
+      # Trivia is keyed by the number of significant tokens before it.
+      keys = numpy.cumsum(is_significant)[is_trivia]
+      _extend_array(trivia.keys, keys)
+      _extend_columns(trivia.tokens, kinds[is_trivia], starts[is_trivia], ends[is_trivia])
+      kinds = kinds[is_significant]
+      starts = starts[is_significant]
+      ends = ends[is_significant]
+    _extend_columns(buffer, kinds, starts, ends)
+    self.index = self._source_len
+    return buffer
+
+
+def _extend_array(column, values):
+  # Appends a NumPy array to an array.array of the same C type.
+  column.frombytes(values.astype(column.typecode).tobytes())
+
+
+def _extend_columns(buffer, kinds, starts, ends):
+  _extend_array(buffer.kinds, kinds)
+  _extend_array(buffer.starts, starts)
+  _extend_array(buffer.ends, ends)
+
+
+# TokenKind members by value.
+_TOKEN_KINDS = (None,) + tuple(TokenKind)
+
+# Characters in the first window NumpyTokenizer.scan classifies.
+_SCAN_WINDOW = 1024
+
+_ascii_classes = None
+
+
+def _ascii_char_classes():
+  # Class lookup table for the ASCII characters, built on first use.
+  global _ascii_classes
+  if _ascii_classes is None:
+    _ascii_classes = numpy.array([_char_class(chr(code)) for code in range(128)], numpy.uint8)
+  return _ascii_classes
+
+
+# Scanning engines that can be selected by name in tokenize().
+ENGINES = {
+  'python': Tokenizer,
+  'regex': RegexTokenizer,
+}
+if importlib.util.find_spec('numpy') is not None:
+  ENGINES['numpy'] = NumpyTokenizer
+
+
+def _import_numpy():
+  # Imports NumPy on first use of the numpy engine.
+  global numpy, _RUN_KINDS
+  if numpy is None:
+    numpy = importlib.import_module('numpy')
+    # Token kinds of runs by the class of their first character, 0 for the
+    # runs NumpyTokenizer scans in Python.
+    _RUN_KINDS = numpy.array((
+      TokenKind.SYMBOL,      # CHAR_OTHER
+      TokenKind.IDENTIFIER,  # CHAR_ALPHA
+      TokenKind.IDENTIFIER,  # CHAR_NUMERIC_ALPHA
+      0,                     # CHAR_DIGIT
+      0,                     # CHAR_UNDERSCORE
+      TokenKind.SPACE,       # CHAR_SPACE
+      0,                     # CHAR_QUOTE
+      0,                     # CHAR_SLASH
+    ), numpy.uint8)
+
+
+def tokenize(source_code, engine='python', trivia=None, symbols=None):
+  # With a TriviaTable, spaces and comments go there instead of into tokens.
+  # With a SymbolTable, token contents are its canonical strings.
+  tokenizer = ENGINES[engine](source_code)
   tokens = []
   current_token = tokenizer.next_token()
   while current_token is not None:
-    tokens.append(current_token)
+    if trivia is not None and current_token.token_type in TRIVIA_TYPES:
+      trivia.add(len(tokens), TokenKind[current_token.token_type],
+                 current_token.start, tokenizer.index)
+    else:
+      if symbols is not None and current_token.token_type in INTERNED_TYPES:
+        current_token.content = symbols.canonical(current_token.content)
+      tokens.append(current_token)
     current_token = tokenizer.next_token()
   return tokens
 
+
+def iter_tokens(fileobj, chunk_size=65536, engine='python'):
+  """Yields the tokens of a text file object while reading it in chunks.
+
+  The tokens are the same as tokenize() returns for the whole content. A token
+  which reaches the end of the text read so far may continue in the next
+  chunk (strings, comments, runs of whitespace), so it is held back and
+  scanned again once more text has been read. Only that pending text is kept
+  in memory between chunks.
+  """
+  pending = ''
+  # Offset of the pending text in the whole source.
+  base = 0
+  read_size = chunk_size
+  while True:
+    chunk = fileobj.read(read_size)
+    at_end = not chunk
+    source_code = pending + chunk
+    source_len = len(source_code)
+    tokenizer = ENGINES[engine](source_code)
+    consumed = 0
+    current_token = tokenizer.next_token()
+    while current_token is not None:
+      if tokenizer.index >= source_len and not at_end:
+        break
+      current_token.start += base
+      yield current_token
+      consumed = tokenizer.index
+      current_token = tokenizer.next_token()
+    if at_end:
+      return
+    pending = source_code[consumed:]
+    base += consumed
+    # Read larger chunks while one token spans many of them, so that
+    # scanning it again stays linear in its length.
+    read_size = max(chunk_size, len(pending))
+
+
+class LineIndex:
+  """Maps offsets in the source code to line and column numbers.
+
+  The start offset of every line is recorded in one pass over the source, and
+  a lookup is a binary search over those starts.
+  """
+
+  def __init__(self, source_code):
+    self.line_starts = array('I' if len(source_code) < 1 << 32 else 'Q', [0])
+    # Also works on bytes and mmap sources, where columns count bytes.
+    newline_char = '\n' if isinstance(source_code, str) else b'\n'
+    newline = source_code.find(newline_char)
+    while newline != -1:
+      self.line_starts.append(newline + 1)
+      newline = source_code.find(newline_char, newline + 1)
+
+  def position(self, offset):
+    # Returns the 1-based (line, column) of an offset.
+    line = bisect.bisect_right(self.line_starts, offset)
+    return line, offset - self.line_starts[line - 1] + 1
+
+
+class SymbolTable:
+  """Canonical strings for token contents, shared by all files of a compilation.
+
+  Each distinct string gets a small int ID that stays the same for the life
+  of the table. The strings are sys.intern'ed, so they are the same objects as
+  equal string constants in the compiler and compare by identity.
+  """
+
+  def __init__(self):
+    self.strings = []
+    self._ids = {}
+
+  def __len__(self):
+    return len(self.strings)
+
+  def __contains__(self, text):
+    return text in self._ids
+
+  def intern(self, text):
+    # Returns the ID of text, adding it if it is new.
+    symbol_id = self._ids.get(text)
+    if symbol_id is None:
+      symbol_id = len(self.strings)
+      text = sys.intern(text)
+      self.strings.append(text)
+      self._ids[text] = symbol_id
+    return symbol_id
+
+  def canonical(self, text):
+    return self.strings[self.intern(text)]
+
+
+class TokenBuffer:
+  """Tokens stored as columns of kinds and offsets into the source code.
+
+  Kinds are TokenKind values, and a token's content is only sliced out of the
+  source when someone asks for it, unless it was interned in a SymbolTable.
+  """
+
+  def __init__(self, source_code):
+    self.source_code = source_code
+    self.kinds = array('B')
+    # Offsets need 64 bits past 4 GB of source.
+    offset_type = 'I' if len(source_code) < 1 << 32 else 'Q'
+    self.starts = array(offset_type)
+    self.ends = array(offset_type)
+    # Set by intern().
+    self.symbols = None
+    self.symbol_ids = None
+
+  def __len__(self):
+    return len(self.kinds)
+
+  def __getitem__(self, index):
+    return Token(self.content(index), self.token_type(index), self.starts[index])
+
+  def append(self, kind, start, end):
+    self.kinds.append(kind)
+    self.starts.append(start)
+    self.ends.append(end)
+
+  def content(self, index):
+    if self.symbol_ids is not None and self.symbol_ids[index] != NO_SYMBOL:
+      return self.symbols.strings[self.symbol_ids[index]]
+    return self.source_code[self.starts[index]:self.ends[index]]
+
+  def symbol(self, index):
+    # Returns the symbol ID of a token, or NO_SYMBOL.
+    if self.symbol_ids is None:
+      return NO_SYMBOL
+    return self.symbol_ids[index]
+
+  def intern(self, symbols):
+    # Interns the contents of identifiers, numbers, strings and symbols.
+    symbol_ids = array('i')
+    symbol_ids_append = symbol_ids.append
+    symbols_intern = symbols.intern
+    interned_kinds = INTERNED_KINDS
+    content = self.content
+    for index, kind in enumerate(self.kinds):
+      if kind in interned_kinds:
+        symbol_ids_append(symbols_intern(content(index)))
+      else:
+        symbol_ids_append(NO_SYMBOL)
+    self.symbols = symbols
+    self.symbol_ids = symbol_ids
+    return self
+
+  def token_type(self, index):
+    return TokenKind(self.kinds[index]).name
+
+  def foreign_code(self, index):
+    # Returns the language, code and code offsets of a FOREIGN_CODE token.
+    language, code_start, code_end = split_foreign_code(
+        self.source_code, self.starts[index], self.ends[index])
+    return language, self.source_code[code_start:code_end], code_start, code_end
+
+
+class TriviaTable:
+  """Spaces and comments set aside from the significant tokens.
+
+  Each trivia token is keyed by the index of the significant token following
+  it, trivia at the end of the source by the number of significant tokens.
+  Together with the significant tokens this keeps the exact layout.
+  """
+
+  def __init__(self, source_code):
+    if isinstance(source_code, str):
+      self.tokens = TokenBuffer(source_code)
+    else:
+      self.tokens = BytesTokenBuffer(source_code)
+    self.keys = array('I')
+
+  def __len__(self):
+    return len(self.keys)
+
+  def add(self, key, kind, start, end):
+    self.keys.append(key)
+    self.tokens.append(kind, start, end)
+
+  def before(self, index):
+    # Returns the trivia tokens preceding the significant token at index.
+    low = bisect.bisect_left(self.keys, index)
+    high = bisect.bisect_right(self.keys, index, low)
+    return [self.tokens[trivia_index] for trivia_index in range(low, high)]
+
+  def merge(self, tokens):
+    """Puts the trivia back between the significant tokens.
+
+    Takes and returns either a list of Token or a TokenBuffer.
+    """
+    keys = self.keys
+    trivia_len = len(keys)
+    trivia_index = 0
+    if isinstance(tokens, TokenBuffer):
+      merged = type(tokens)(tokens.source_code)
+      trivia = self.tokens
+      for index in range(len(tokens) + 1):
+        while trivia_index < trivia_len and keys[trivia_index] == index:
+          merged.append(trivia.kinds[trivia_index], trivia.starts[trivia_index],
+                        trivia.ends[trivia_index])
+          trivia_index += 1
+        if index < len(tokens):
+          merged.append(tokens.kinds[index], tokens.starts[index], tokens.ends[index])
+      return merged
+    merged = []
+    for index in range(len(tokens) + 1):
+      while trivia_index < trivia_len and keys[trivia_index] == index:
+        merged.append(self.tokens[trivia_index])
+        trivia_index += 1
+      if index < len(tokens):
+        merged.append(tokens[index])
+    return merged
+
+
+def _fill_buffer(buffer, scanned_tokens, trivia):
+  # Appends (kind, start, end) tuples to the buffer, or to the trivia table
+  # for spaces and comments when there is one.
+  kinds_append = buffer.kinds.append
+  starts_append = buffer.starts.append
+  ends_append = buffer.ends.append
+  if trivia is None:
+    for kind, start, end in scanned_tokens:
+      kinds_append(kind)
+      starts_append(start)
+      ends_append(end)
+    return buffer
+  trivia_add = trivia.add
+  trivia_kinds = TRIVIA_KINDS
+  kinds = buffer.kinds
+  for kind, start, end in scanned_tokens:
+    if kind in trivia_kinds:
+      trivia_add(len(kinds), kind, start, end)
+    else:
+      kinds_append(kind)
+      starts_append(start)
+      ends_append(end)
+  return buffer
+
+
+def tokenize_buffer(source_code, engine='regex', trivia=None, symbols=None):
+  tokenizer = ENGINES[engine](source_code)
+  if hasattr(tokenizer, 'fill'):
+    # The engine produces whole columns at once.
+    buffer = tokenizer.fill(TokenBuffer(source_code), trivia)
+  else:
+    buffer = _fill_buffer(TokenBuffer(source_code), tokenizer.scan(), trivia)
+  if symbols is not None:
+    buffer.intern(symbols)
+  return buffer
+
+
+class IncrementalLexer:
+  """Keeps the tokens of a source code up to date while it is being edited.
+
+  An edit scans again from the last token which could be affected, and stops
+  as soon as a new token starts where an old one did in the unchanged text
+  after the edit. From there on the old tokens are still right, only their
+  offsets move. That shift is kept as one pending delta for every token at or
+  after a step index, and moving the step to the next edit only touches the
+  tokens in between, so edits close to each other cost the same however
+  large the source is.
+  """
+
+  def __init__(self, source_code, engine='regex'):
+    self.source_code = source_code
+    self._engine = engine
+    buffer = tokenize_buffer(source_code, engine)
+    self._kinds = buffer.kinds
+    # Signed, offsets of tokens after the step are stored minus the delta.
+    self._starts = array('q', buffer.starts)
+    self._step_index = 0
+    self._step_delta = 0
+
+  def __len__(self):
+    return len(self._kinds)
+
+  def kind(self, index):
+    return self._kinds[index]
+
+  def start(self, index):
+    if index >= self._step_index:
+      return self._starts[index] + self._step_delta
+    return self._starts[index]
+
+  def end(self, index):
+    if index + 1 < len(self._kinds):
+      return self.start(index + 1)
+    return len(self.source_code)
+
+  def content(self, index):
+    return self.source_code[self.start(index):self.end(index)]
+
+  def to_buffer(self):
+    buffer = TokenBuffer(self.source_code)
+    for index in range(len(self._kinds)):
+      buffer.append(self._kinds[index], self.start(index), self.end(index))
+    return buffer
+
+  def _first_start_at_or_after(self, offset):
+    low = 0
+    high = len(self._kinds)
+    while low < high:
+      middle = (low + high) // 2
+      if self.start(middle) < offset:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  def _move_step(self, index):
+    delta = self._step_delta
+    step_index = self._step_index
+    if delta and index > step_index:
+      self._starts[step_index:index] = array(
+          'q', [start + delta for start in self._starts[step_index:index]])
+    elif delta and index < step_index:
+      self._starts[index:step_index] = array(
+          'q', [start - delta for start in self._starts[index:step_index]])
+    self._step_index = index
+
+  def edit(self, offset, deleted_length, inserted_text):
+    """Replaces deleted_length characters at offset with inserted_text.
+
+    Returns (first, removed, added): the index of the first changed token,
+    how many old tokens were removed there and how many new ones replaced them.
+    """
+    self.source_code = (self.source_code[:offset] + inserted_text +
+                        self.source_code[offset + deleted_length:])
+    shift = len(inserted_text) - deleted_length
+    # Tokens ending before the edit cannot change, the lexer never looks
+    # further than one character past a token.
+    first = max(self._first_start_at_or_after(offset) - 1, 0)
+    self._move_step(first)
+    old_count = len(self._kinds)
+    if first < old_count:
+      scan_from = self.start(first)
+    else:
+      scan_from = 0
+    # Old tokens starting in the unchanged text after the edit can be reused.
+    unchanged_from = offset + len(inserted_text)
+    old_index = first
+    new_kinds = []
+    new_starts = []
+    tokenizer = ENGINES[self._engine](self.source_code)
+    tokenizer.index = scan_from
+    for kind, start, end in tokenizer.scan():
+      if start >= unchanged_from:
+        old_start = start - shift
+        while old_index < old_count and self.start(old_index) < old_start:
+          old_index += 1
+        if old_index < old_count and self.start(old_index) == old_start:
+          break
+      new_kinds.append(kind)
+      new_starts.append(start)
+    else:
+      old_index = old_count
+    self._kinds[first:old_index] = array('B', new_kinds)
+    self._starts[first:old_index] = array('q', new_starts)
+    self._step_index = first + len(new_kinds)
+    self._step_delta += shift
+    return first, old_index - first, len(new_kinds)
+
+
+# Classes of single bytes, indexed by the byte value. Bytes of multi-byte
+# UTF-8 characters are all NON_ASCII and go through the Unicode rules.
+BYTE_OTHER = 0
+BYTE_ALPHA = 1
+BYTE_DIGIT = 2
+BYTE_SPACE = 3
+BYTE_QUOTE = 4
+BYTE_SLASH = 5
+BYTE_NON_ASCII = 6
+
+
+def _byte_class(byte):
+  char = chr(byte)
+  if byte >= 0x80:
+    return BYTE_NON_ASCII
+  elif char.isalpha():
+    return BYTE_ALPHA
+  elif char.isnumeric():
+    return BYTE_DIGIT
+  elif char.isspace():
+    return BYTE_SPACE
+  elif char == '\'' or char == '"':
+    return BYTE_QUOTE
+  elif char == '/':
+    return BYTE_SLASH
+  return BYTE_OTHER
+
+
+BYTE_CLASSES = bytes(_byte_class(byte) for byte in range(256))
+
+
+def _byte_run(*byte_classes, extra=b''):
+  # Compiles a pattern matching a run of bytes in the given classes.
+  run_bytes = bytes(byte for byte in range(256) if BYTE_CLASSES[byte] in byte_classes) + extra
+  return re.compile(b'[' + b''.join(re.escape(bytes((byte,))) for byte in run_bytes) + b']*')
+
+
+_IDENTIFIER_RUN = _byte_run(BYTE_ALPHA, BYTE_DIGIT, extra=b'_')
+_DIGIT_RUN = _byte_run(BYTE_DIGIT)
+_SPACE_RUN = _byte_run(BYTE_SPACE)
+_BYTE_STRING = re.compile(rb"'(?:[^'\\]+|\\[\s\S]?)*'?" rb'|"(?:[^"\\]+|\\[\s\S]?)*"?')
+_BYTE_FOREIGN_CODE_BEGIN = FOREIGN_CODE_BEGIN.encode('ascii')
+_BYTE_FOREIGN_CODE_END = re.compile(FOREIGN_CODE_END.encode('ascii'))
+_BYTE_COMMENT = re.compile(rb'//[^\n\r]*[\n\r]?|/\*(?:[\s\S]*?\*/|[\s\S]*)')
+
+
+class BytesTokenizer:
+  """Scans UTF-8 encoded bytes, including an mmap of a file, into tokens.
+
+  The first byte of each token is classified through BYTE_CLASSES, and runs
+  of ASCII bytes are matched with patterns built from the same table. Only
+  non-ASCII characters are decoded, one at a time, to apply the Unicode rules
+  Tokenizer uses. Offsets are in bytes.
+  """
+
+  def __init__(self, source_code):
+    self._source_code = source_code
+    self._source_len = len(source_code)
+    self.index = 0
+
+  def _decode_char(self, index):
+    # Decodes the UTF-8 character starting at index, returns it with its length.
+    lead = self._source_code[index]
+    if lead < 0xe0:
+      length = 2
+    elif lead < 0xf0:
+      length = 3
+    else:
+      length = 4
+    try:
+      return str(self._source_code[index:index + length], 'utf-8'), length
+    except UnicodeDecodeError:
+      # Invalid bytes are passed through one at a time as symbols.
+      return '\ufffd', 1
+
+  def _scan_run(self, index, run, accepts):
+    # Extends a token over ASCII bytes matching run and non-ASCII characters
+    # that accepts() returns True for.
+    source_code = self._source_code
+    while True:
+      index = run.match(source_code, index).end()
+      if index >= self._source_len or source_code[index] < 0x80:
+        return index
+      char, length = self._decode_char(index)
+      if not accepts(char):
+        return index
+      index += length
+
+  def _is_word_before(self, index):
+    # Checks whether the character ending at index is an identifier character.
+    source_code = self._source_code
+    byte = source_code[index - 1]
+    if byte < 0x80:
+      return byte == 0x5f or BYTE_CLASSES[byte] in (BYTE_ALPHA, BYTE_DIGIT)
+    lead = index - 1
+    while lead > 0 and index - lead < 4 and source_code[lead] & 0xc0 == 0x80:
+      lead -= 1
+    char, length = self._decode_char(lead)
+    return lead + length == index and char.isalnum()
+
+  def _scan_foreign_code(self, index):
+    # Finds the end marker of a foreign code block whose begin marker ends at index.
+    while True:
+      match = _BYTE_FOREIGN_CODE_END.search(self._source_code, index)
+      if match is None:
+        return self._source_len
+      if match.start() == 0 or not self._is_word_before(match.start()):
+        return self._scan_run(match.end(), _IDENTIFIER_RUN, str.isalnum)
+      index = match.start() + 1
+
+  def _scan_number(self, index):
+    has_encountered_dot = False
+    while True:
+      index = self._scan_run(index, _DIGIT_RUN, str.isnumeric)
+      if (index < self._source_len and self._source_code[index] == 0x2e and
+          not has_encountered_dot):
+        has_encountered_dot = True
+        index += 1
+      else:
+        return index
+
+  def _scan_unicode(self, index):
+    # Tokens starting with a non-ASCII character.
+    char, length = self._decode_char(index)
+    if char.isalpha():
+      return TokenKind.IDENTIFIER, self._scan_run(index + length, _IDENTIFIER_RUN, str.isalnum)
+    elif char.isnumeric():
+      return TokenKind.NUMBER, self._scan_number(index + length)
+    elif char.isspace():
+      return TokenKind.SPACE, self._scan_run(index + length, _SPACE_RUN, str.isspace)
+    return TokenKind.SYMBOL, index + length
+
+  def scan(self):
+    # Yields (kind, start, end) for each token.
+    source_code = self._source_code
+    source_len = self._source_len
+    byte_classes = BYTE_CLASSES
+    index = self.index
+    while index < source_len:
+      byte = source_code[index]
+      byte_class = byte_classes[byte]
+      if byte_class == BYTE_ALPHA:
+        kind = TokenKind.IDENTIFIER
+        end = self._scan_run(index + 1, _IDENTIFIER_RUN, str.isalnum)
+        if (byte == 0x42 and end - index >= len(_BYTE_FOREIGN_CODE_BEGIN) and
+            source_code[index:index + len(_BYTE_FOREIGN_CODE_BEGIN)] == _BYTE_FOREIGN_CODE_BEGIN):
+          kind = TokenKind.FOREIGN_CODE
+          end = self._scan_foreign_code(end)
+      elif byte_class == BYTE_SPACE:
+        kind = TokenKind.SPACE
+        end = self._scan_run(index + 1, _SPACE_RUN, str.isspace)
+      elif byte_class == BYTE_DIGIT:
+        kind = TokenKind.NUMBER
+        end = self._scan_number(index + 1)
+      elif byte_class == BYTE_QUOTE:
+        kind = TokenKind.STRING
+        end = _BYTE_STRING.match(source_code, index).end()
+      elif (byte_class == BYTE_SLASH and index + 1 < source_len and
+            source_code[index + 1] in b'*/'):
+        kind = TokenKind.COMMENT
+        end = _BYTE_COMMENT.match(source_code, index).end()
+      elif byte_class == BYTE_NON_ASCII:
+        kind, end = self._scan_unicode(index)
+      else:
+        kind = TokenKind.SYMBOL
+        end = index + 1
+      yield kind, index, end
+      index = end
+      self.index = index
+
+
+class BytesTokenBuffer(TokenBuffer):
+  """A TokenBuffer over UTF-8 bytes, offsets are in bytes.
+
+  raw() gives a token as a memoryview of the source, content() decodes it.
+  """
+
+  def __init__(self, source_code):
+    TokenBuffer.__init__(self, source_code)
+    self._view = memoryview(source_code)
+
+  def raw(self, index):
+    return self._view[self.starts[index]:self.ends[index]]
+
+  def content(self, index):
+    if self.symbol_ids is not None and self.symbol_ids[index] != NO_SYMBOL:
+      return self.symbols.strings[self.symbol_ids[index]]
+    return str(self._view[self.starts[index]:self.ends[index]], 'utf-8')
+
+  def foreign_code(self, index):
+    content = self.content(index)
+    language, code_start, code_end = split_foreign_code(content)
+    code = content[code_start:code_end]
+    # Back to byte offsets.
+    code_start = self.starts[index] + len(content[:code_start].encode('utf-8'))
+    return language, code, code_start, code_start + len(code.encode('utf-8'))
+
+
+def tokenize_bytes(source_code, trivia=None, symbols=None):
+  """Lexes UTF-8 bytes, a memoryview or an mmap into a BytesTokenBuffer."""
+  buffer = _fill_buffer(BytesTokenBuffer(source_code), BytesTokenizer(source_code).scan(), trivia)
+  if symbols is not None:
+    buffer.intern(symbols)
+  return buffer
+
+
+def map_file(path):
+  # Returns a read-only mmap of a file, or empty bytes for an empty file.
+  with open(path, 'rb') as source_file:
+    if os.fstat(source_file.fileno()).st_size == 0:
+      return b''
+    return mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def tokenize_file(path, symbols=None):
+  """Lexes a UTF-8 source file through an mmap, without reading it into memory.
+
+  The returned buffer keeps the mapping open for as long as it is used. To
+  set trivia aside, lex map_file(path) with tokenize_bytes instead.
+  """
+  return tokenize_bytes(map_file(path), symbols=symbols)
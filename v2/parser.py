@@ -1,5 +1,13 @@
 
+import bisect
+import concurrent.futures
+import gc
+import operator
+import os
+import pickle
+import re
 import sys
+from array import array
 
 import lexer
 
@@ -15,300 +23,1675 @@ import lexer
 # module name - done
 
 
-class Node:
+class SyntaxNode:
+  """Base of the parse tree node classes.
 
-  def __init__(self, node_type, members=None, leaf=False):
+  Subclasses name their fields in __slots__, in the order their constructors
+  take them, and the fields holding child nodes in _children. The start and
+  end fields are offsets in the source code of the node's first and last
+  characters, the end is exclusive.
+
+  node_type and members give the generic view of the tree that Node has,
+  built on demand for the typed nodes, so code can walk any tree without
+  knowing the classes.
+  """
+
+  __slots__ = ()
+  leaf = False
+  _children = ()
+  # Fields holding source offsets, or lists of them.
+  _offsets = ('start', 'end')
+
+  def __reduce__(self):
+    return type(self), tuple(map(self.__getattribute__, self.__slots__))
+
+  def shift(self, offset):
+    # Moves the node and its descendants by offset characters in the source.
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      if node is not self and type(node).shift is not SyntaxNode.shift:
+        # Lazy bodies move without being parsed.
+        node.shift(offset)
+        continue
+      for name in node._offsets:
+        value = getattr(node, name)
+        if isinstance(value, (list, tuple)):
+          setattr(node, name, [item + offset for item in value])
+        elif value is not None:
+          setattr(node, name, value + offset)
+      stack.extend(node.children())
+
+  def walk(self):
+    # Yields the node and its descendants in preorder.
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      yield node
+      stack.extend(reversed(node.children()))
+
+  def children(self):
+    # Child nodes in source order.
+    children = []
+    for name in self._children:
+      child = getattr(self, name)
+      if isinstance(child, list):
+        children.extend(child)
+      elif child is not None:
+        children.append(child)
+    return children
+
+  def print(self, indent_level=0):
+    # Nodes wait on a stack rather than in nested calls, so any depth prints.
+    # The lines print() would write go out to stdout in batches.
+    output_file = sys.stdout
+    lines = []
+    stack = [(self, indent_level)]
+    while stack:
+      node, indent_level = stack.pop()
+      if not isinstance(node, SyntaxNode):
+        output_file.write(''.join(lines))
+        lines.clear()
+        node.print(indent_level)
+        continue
+      lines.append('%s %s :\n' % (' ' * indent_level, node.node_type))
+      if node.leaf:
+        for member in node.members:
+          if node.node_type == 'SPACES':
+            lines.append('%s [ %s ]\n' % (' ' * (indent_level + 2), member))
+          else:
+            lines.append('%s %s\n' % (' ' * (indent_level + 2), member))
+      else:
+        stack.extend((member, indent_level + 2) for member in reversed(node.members))
+      if len(lines) >= 4096:
+        output_file.write(''.join(lines))
+        lines.clear()
+    output_file.write(''.join(lines))
+
+
+class Node(SyntaxNode):
+  __slots__ = ('node_type', 'members', 'leaf', 'start', 'end')
+
+  def __init__(self, node_type, members=None, leaf=False, start=None, end=None):
     self.node_type = node_type
     self.leaf = leaf
     self.members = members or []
+    self.start = start
+    self.end = end
 
-  def print(self, indent_level=0):
-    if self.leaf:
-      print(' ' * indent_level, self.node_type, ':')
-      for member in self.members:
-        if self.node_type == 'SPACES':
-          print(' ' * (indent_level + 2), '[', member, ']')
-        else:
-          print(' ' * (indent_level + 2), member)
+  def children(self):
+    return [] if self.leaf else self.members
+
+
+class Leaf(SyntaxNode):
+  """A token kept in the tree, node_type names its role."""
+
+  __slots__ = ('node_type', 'value', 'start', 'end')
+  leaf = True
+
+  def __init__(self, node_type, value, start=None, end=None):
+    self.node_type = node_type
+    self.value = value
+    self.start = start
+    self.end = end
+
+  def shift(self, offset):
+    if self.start is not None:
+      self.start += offset
+      self.end += offset
+
+  @property
+  def members(self):
+    return [self.value]
+
+
+def _punctuation(node_type, content, start):
+  # Leaf for a symbol or keyword the typed nodes only keep the offset of.
+  return Leaf(node_type, content, start, None if start is None else start + len(content))
+
+
+class StringLiteral(SyntaxNode):
+  """A string literal, value keeps its quotes and escapes."""
+
+  __slots__ = ('value', 'start', 'end')
+  node_type = 'STRING_LITERAL'
+  leaf = True
+  members = Leaf.members
+
+  def __init__(self, value, start=None, end=None):
+    self.value = value
+    self.start = start
+    self.end = end
+
+  def shift(self, offset):
+    if self.start is not None:
+      self.start += offset
+      self.end += offset
+
+
+class NumberLiteral(SyntaxNode):
+  __slots__ = ('value', 'start', 'end')
+  node_type = 'NUMBER_LITERAL'
+  leaf = True
+  members = Leaf.members
+
+  def __init__(self, value, start=None, end=None):
+    self.value = value
+    self.start = start
+    self.end = end
+
+  def shift(self, offset):
+    if self.start is not None:
+      self.start += offset
+      self.end += offset
+
+
+class ModuleSymbols:
+  """The names declared and assigned at the top level of a module.
+
+  functions maps names to their FUNCTION_DECLARATION nodes, variables to
+  their DECLARATION nodes and assignments the targets of assignments to the
+  ASSIGNMENT nodes. The first item with a name keeps it. Items are typed
+  nodes or ArenaNodes.
+  """
+
+  __slots__ = ('functions', 'variables', 'assignments')
+
+  def __init__(self, items=()):
+    self.functions = {}
+    self.variables = {}
+    self.assignments = {}
+    for item in items:
+      self.add(item)
+
+  def add(self, item):
+    node_type = item.node_type
+    if node_type == 'FUNCTION_DECLARATION':
+      self.functions.setdefault(item.name.value, item)
+    elif node_type == 'DECLARATION':
+      self.variables.setdefault(item.name.value, item)
+    elif node_type == 'ASSIGNMENT':
+      self.assignments.setdefault(item.target.value, item)
+
+  def kind(self, name):
+    # 'function', the type of a variable, or None if name is not declared.
+    if name in self.functions:
+      return 'function'
+    declaration = self.variables.get(name)
+    return None if declaration is None else declaration.variable_type.value
+
+
+class Module(SyntaxNode):
+  """The items of a module, and their names in a ModuleSymbols as symbols.
+
+  index is a TreeIndex of the tree when the parser was asked for one. errors
+  holds the ParseErrors the parser collected in diagnostics while building it.
+  """
+
+  __slots__ = ('items', 'start', 'end', 'symbols', 'index', 'errors')
+  node_type = 'MODULE'
+  _children = ('items',)
+
+  def __init__(self, items=None, start=None, end=None, symbols=None, index=None, errors=None):
+    self.items = items or []
+    self.start = start
+    self.end = end
+    self.symbols = ModuleSymbols(self.items) if symbols is None else symbols
+    self.index = index
+    self.errors = [] if errors is None else errors
+
+  @property
+  def members(self):
+    return self.items
+
+
+class Declaration(SyntaxNode):
+  """name: variable_type, both Leaf, marker_start is the offset of the :."""
+
+  __slots__ = ('name', 'variable_type', 'start', 'end', 'marker_start')
+  node_type = 'DECLARATION'
+  _offsets = ('start', 'end', 'marker_start')
+  _children = ('name', 'variable_type')
+
+  def __init__(self, name, variable_type, start=None, end=None, marker_start=None):
+    self.name = name
+    self.variable_type = variable_type
+    self.start = start
+    self.end = end
+    self.marker_start = marker_start
+
+  @property
+  def members(self):
+    return [self.name, _punctuation('DECLARATION_MARKER', ':', self.marker_start),
+            self.variable_type]
+
+
+class FunctionDeclaration(SyntaxNode):
+  """name: function[params][body], with the offsets of the symbols between.
+
+  body is a CodeBlock, a LazyCodeBlock in a lazy parse, or None in an outline.
+  """
+
+  __slots__ = ('name', 'params', 'body', 'start', 'end', 'marker_start', 'keyword_start',
+               'params_open', 'params_close')
+  node_type = 'FUNCTION_DECLARATION'
+  _offsets = ('start', 'end', 'marker_start', 'keyword_start', 'params_open', 'params_close')
+  _children = ('name', 'params', 'body')
+
+  def __init__(self, name, params, body, start=None, end=None, marker_start=None,
+               keyword_start=None, params_open=None, params_close=None):
+    self.name = name
+    self.params = params
+    self.body = body
+    self.start = start
+    self.end = end
+    self.marker_start = marker_start
+    self.keyword_start = keyword_start
+    self.params_open = params_open
+    self.params_close = params_close
+
+  @property
+  def members(self):
+    definition = Node('FUNCTION_DEFINITION', [
+        _punctuation('FUNCTION_KEYWORD', 'function', self.keyword_start),
+        _punctuation('FUNCTION_PARAMS_START', '[', self.params_open),
+        _punctuation('FUNCTION_PARAMS_END', ']', self.params_close),
+      ], start=self.keyword_start, end=self.end)
+    if self.body is not None:
+      definition.members.append(self.body)
+    return [self.name, _punctuation('DECLARATION_MARKER', ':', self.marker_start), definition]
+
+
+class CodeBlock(SyntaxNode):
+  """[statements], close is the offset of the ] or None if it is missing."""
+
+  __slots__ = ('statements', 'start', 'end', 'close')
+  node_type = 'CODE_BLOCK'
+  _offsets = ('start', 'end', 'close')
+  _children = ('statements',)
+
+  def __init__(self, statements, start=None, end=None, close=None):
+    self.statements = statements
+    self.start = start
+    self.end = end
+    self.close = close
+
+  @property
+  def members(self):
+    members = [_punctuation('CODE_BLOCK_START', '[', self.start)]
+    members.extend(self.statements)
+    if self.close is not None:
+      members.append(_punctuation('CODE_BLOCK_END', ']', self.close))
+    return members
+
+
+class LazyCodeBlock(SyntaxNode):
+  """A function body whose statements are parsed on first access.
+
+  It keeps the parser of its module, and the indexes of its [ and ] tokens,
+  until then. Syntax errors in the body come up at that point.
+  """
+
+  __slots__ = ('start', 'end', 'close', '_statements', '_parser', '_open_token', '_close_token',
+               '_offset')
+  node_type = 'CODE_BLOCK'
+  _children = ('statements',)
+  _offsets = ('start', 'end', 'close')
+  members = CodeBlock.members
+
+  def __init__(self, start, end, close, parser, open_token, close_token):
+    self.start = start
+    self.end = end
+    self.close = close
+    self._statements = None
+    self._parser = parser
+    self._open_token = open_token
+    self._close_token = close_token
+    self._offset = 0
+
+  def __reduce__(self):
+    return CodeBlock, (self.statements, self.start, self.end, self.close)
+
+  @property
+  def parsed(self):
+    return self._parser is None
+
+  @property
+  def statements(self):
+    if self._parser is not None:
+      self._statements = self._parser.parse_function_body(self._open_token, self._close_token)
+      self._parser = None
+      if self._offset:
+        for statement in self._statements:
+          statement.shift(self._offset)
+    return self._statements
+
+  def shift(self, offset):
+    self.start += offset
+    self.end += offset
+    self.close += offset
+    if self._parser is None:
+      for statement in self._statements:
+        statement.shift(offset)
     else:
-      print(' ' * indent_level, self.node_type, ':')
-      for member in self.members:
-        member.print(indent_level + 2)
+      self._offset += offset
+
+
+class FunctionCall(SyntaxNode):
+  """callee[args], args_open is the offset of the [."""
+
+  __slots__ = ('callee', 'args', 'start', 'end', 'args_open')
+  node_type = 'FUNCTION_CALL'
+  _offsets = ('start', 'end', 'args_open')
+  _children = ('callee', 'args')
+
+  def __init__(self, callee, args, start=None, end=None, args_open=None):
+    self.callee = callee
+    self.args = args
+    self.start = start
+    self.end = end
+    self.args_open = args_open
+
+  @property
+  def members(self):
+    args_close = None if self.end is None else self.end - 1
+    if self.args:
+      arguments = Node('ARGUMENTS', list(self.args), start=self.args[0].start, end=self.args[-1].end)
+    else:
+      arguments = Node('ARGUMENTS', start=args_close, end=args_close)
+    call_arguments = Node('FUNCTION_CALL_ARGUMENTS', [
+        _punctuation('ARG_LIST_START', '[', self.args_open),
+        arguments,
+        _punctuation('ARG_LIST_END', ']', args_close),
+      ], start=self.args_open, end=self.end)
+    return [self.callee, call_arguments]
+
+
+class IdentifierChain(SyntaxNode):
+  """Identifiers joined by dots, dots holds the offsets of the dots or is None."""
+
+  __slots__ = ('names', 'start', 'end', 'dots')
+  node_type = 'IDENTIFIER_CHAIN'
+  _offsets = ('start', 'end', 'dots')
+  _children = ('names',)
+
+  def __init__(self, names, start=None, end=None, dots=()):
+    self.names = names
+    self.start = start
+    self.end = end
+    self.dots = dots
+
+  @property
+  def members(self):
+    members = [self.names[0]]
+    dots = self.dots
+    if dots is None:
+      dots = [None] * (len(self.names) - 1)
+    for dot, name in zip(dots, self.names[1:]):
+      members.append(_punctuation('MEMBER_DOT_ACCESS', '.', dot))
+      members.append(name)
+    return members
+
+  def text(self):
+    return '.'.join(name.value for name in self.names)
+
+
+class ForeignCodeBlock(SyntaxNode):
+  """Code in another language, kept as it is written."""
+
+  __slots__ = ('language', 'code', 'start', 'end', 'code_start', 'code_end')
+  node_type = 'FOREIGN_CODE_BLOCK'
+  _offsets = ('start', 'end', 'code_start', 'code_end')
+
+  def __init__(self, language, code, start=None, end=None, code_start=None, code_end=None):
+    self.language = language
+    self.code = code
+    self.start = start
+    self.end = end
+    self.code_start = code_start
+    self.code_end = code_end
+
+  @property
+  def members(self):
+    return [Leaf(self.language, self.code, self.code_start, self.code_end)]
+
+
+class Assignment(SyntaxNode):
+  """target = value, value is a literal or None."""
+
+  __slots__ = ('target', 'value', 'start', 'end', 'symbol_start')
+  node_type = 'ASSIGNMENT'
+  _offsets = ('start', 'end', 'symbol_start')
+  _children = ('target', 'value')
+
+  def __init__(self, target, value, start=None, end=None, symbol_start=None):
+    self.target = target
+    self.value = value
+    self.start = start
+    self.end = end
+    self.symbol_start = symbol_start
+
+  @property
+  def members(self):
+    members = [self.target, _punctuation('ASSIGNMENT_SYMBOL', '=', self.symbol_start)]
+    if self.value is not None:
+      members.append(self.value)
+    return members
+
+
+# Token kinds bound once, looking them up on the enum is slow in the hot loop.
+IDENTIFIER = lexer.TokenKind.IDENTIFIER
+NUMBER = lexer.TokenKind.NUMBER
+SPACE = lexer.TokenKind.SPACE
+STRING = lexer.TokenKind.STRING
+COMMENT = lexer.TokenKind.COMMENT
+SYMBOL = lexer.TokenKind.SYMBOL
+FOREIGN_CODE = lexer.TokenKind.FOREIGN_CODE
+TRIVIA = lexer.TRIVIA_KINDS
+_TRIVIA_RUN = re.compile(b'[%s]+' % bytes(TRIVIA))
+_SYMBOL_TOKEN = re.compile(re.escape(bytes((SYMBOL,))))
+_BRACKET = re.compile(r'(?P<OPEN>\[)|\]')
+_BYTE_BRACKET = re.compile(rb'(?P<OPEN>\[)|\]')
+
+
+def _trivia_runs(kinds):
+  # Yields the start and end of each run of spaces and comments in a list.
+  start = None
+  for index, kind in enumerate(kinds):
+    if kind in TRIVIA:
+      if start is None:
+        start = index
+    elif start is not None:
+      yield start, index
+      start = None
+  if start is not None:
+    yield start, len(kinds)
+
+# How the parser treats function bodies, see Parser.
+FUNCTION_BODIES = ('eager', 'lazy', 'outline')
+
+# Languages of foreign code blocks, also used as their node types.
+FOREIGN_LANGUAGES = frozenset(('C', 'PYTHON', 'GO', 'JAVA', 'JS', 'DOTNET'))
+
+
+class NodeBuilder:
+  """Creates the nodes of a parse tree for the parser, as typed node objects.
+
+  Each method takes the fields of the node class of the same name. Arena has
+  the same methods, storing nodes in array columns instead. node() gives the
+  node object of what a method returned.
+  """
+
+  leaf = Leaf
+  string_literal = StringLiteral
+  number_literal = NumberLiteral
+  module = Module
+  declaration = Declaration
+  function_declaration = FunctionDeclaration
+  code_block = CodeBlock
+  function_call = FunctionCall
+  identifier_chain = IdentifierChain
+  foreign_code_block = ForeignCodeBlock
+  assignment = Assignment
+
+  def node(self, node):
+    return node
+
+
+NODE_BUILDER = NodeBuilder()
+
+
+class SharingBuilder(NodeBuilder):
+  """A NodeBuilder that creates one node for all equal statements and their parts.
+
+  Function calls, foreign code blocks, identifier chains, literals and leaves
+  are looked up by their content and children, and equal ones are one shared
+  node, without offsets: their start, end and the other offsets are None.
+  Items, code blocks and the module are still created for each occurrence
+  and keep their offsets. Shared nodes must not be changed, and can be
+  memoized by identity. Pass the same builder for several modules to share
+  nodes between them.
+
+  created counts the nodes the parser asked for and len() the different
+  nodes among them.
+  """
+
+  def __init__(self):
+    self._nodes = {}
+    self.created = 0
+
+  def __len__(self):
+    return len(self._nodes)
+
+  def dedup_ratio(self):
+    # Nodes asked for per node created.
+    return self.created / len(self._nodes) if self._nodes else 1.0
+
+  def _shared(self, key, node_class, *fields):
+    self.created += 1
+    node = self._nodes.get(key)
+    if node is None:
+      node = self._nodes[key] = node_class(*fields)
+    return node
+
+  def leaf(self, node_type, value, start, end):
+    return self._shared((Leaf, node_type, value), Leaf, node_type, value)
+
+  def string_literal(self, value, start, end):
+    return self._shared((StringLiteral, value), StringLiteral, value)
+
+  def number_literal(self, value, start, end):
+    return self._shared((NumberLiteral, value), NumberLiteral, value)
+
+  def function_call(self, callee, args, start, end, args_open):
+    # Children are shared already, keys compare them by identity.
+    return self._shared((FunctionCall, callee, *args), FunctionCall, callee, args)
+
+  def identifier_chain(self, names, start, end, dots):
+    return self._shared((IdentifierChain, *names), IdentifierChain, names, None, None, None)
+
+  def foreign_code_block(self, language, code, start, end, code_start, code_end):
+    return self._shared((ForeignCodeBlock, language, code), ForeignCodeBlock, language, code)
+
+
+class TreeIndex:
+  """Lookups on a tree of typed nodes, instead of walks over all of it.
+
+  postings maps node types to their nodes in source order, calls maps the
+  dotted callee names of FUNCTION_CALL nodes to those calls, and parents
+  maps every node but the module to the node it is a child of.
+  token_span() gives the tokens a node covers.
+
+  parse_source builds one when it is called with index=True, in one walk
+  over the tree it parsed, and the module keeps it as index. Trees parsed
+  without one carry nothing extra.
+  """
+
+  def __init__(self, token_starts=None, source_code=None):
+    # Token starts are read from the source code when they are first needed
+    # if they are not given.
+    self.postings = {}
+    self.parents = {}
+    self.calls = {}
+    self._token_starts = token_starts
+    self._source_code = source_code
+
+  @classmethod
+  def from_tree(cls, module, token_starts=None, source_code=None):
+    # Indexes a tree and attaches the index to its module.
+    index = cls(token_starts, source_code)
+    postings = index.postings
+    parents = index.parents
+    calls = index.calls
+    # Preorder, each node before the nodes after it in the source.
+    stack = [module]
+    while stack:
+      node = stack.pop()
+      node_type = node.node_type
+      nodes = postings.get(node_type)
+      if nodes is None:
+        nodes = postings[node_type] = []
+      nodes.append(node)
+      if node.leaf:
+        continue
+      if node_type == 'FUNCTION_CALL':
+        calls.setdefault(node.callee.text(), []).append(node)
+      children = node.children()
+      parents.update(dict.fromkeys(children, node))
+      children.reverse()
+      stack.extend(children)
+    module.index = index
+    return index
+
+  def nodes(self, node_type):
+    return self.postings.get(node_type, [])
+
+  def function_calls(self, callee):
+    # Calls to a dotted name, like 'os.print'.
+    return self.calls.get(callee, [])
+
+  def parent(self, node):
+    return self.parents.get(node)
+
+  def enclosing(self, node, node_type):
+    # The closest ancestor of node of a type, or None.
+    node = self.parents.get(node)
+    while node is not None and node.node_type != node_type:
+      node = self.parents.get(node)
+    return node
+
+  def token_span(self, node):
+    # Indexes of the first token of the node and of the token after it,
+    # spaces and comments not counted.
+    if self._token_starts is None:
+      tokens = lexer.tokenize_buffer(self._source_code,
+                                     trivia=lexer.TriviaTable(self._source_code))
+      self._token_starts = tokens.starts
+      self._source_code = None
+    starts = self._token_starts
+    return bisect.bisect_left(starts, node.start), bisect.bisect_left(starts, node.end)
+
+# Node types an Arena stores, their index in this tuple is the kind stored.
+# Leaves come after the last node type with children.
+NODE_TYPES = ('MODULE', 'DECLARATION', 'FUNCTION_DECLARATION', 'CODE_BLOCK', 'FUNCTION_CALL',
+              'IDENTIFIER_CHAIN', 'FOREIGN_CODE_BLOCK', 'ASSIGNMENT', 'STRING_LITERAL',
+              'NUMBER_LITERAL', 'IDENTIFIER', 'VARIABLE_TYPE', 'ASSIGNMENT_TARGET',
+              'temp') + tuple(sorted(FOREIGN_LANGUAGES))
+_NODE_KINDS = {node_type: kind for kind, node_type in enumerate(NODE_TYPES)}
+_FIRST_LEAF_KIND = _NODE_KINDS['STRING_LITERAL']
+
+
+class Arena:
+  """A parse tree stored in parallel array columns, one entry per node.
+
+  Each node has a kind, an index into NODE_TYPES, the indexes of its first
+  child and next sibling, -1 when there is none, and the offsets of its span
+  in the source code. Leaf text is the source code in that span. Nodes are
+  numbered in the order the parser completes them, children before their
+  parents, and root is the module.
+
+  Pass an Arena as the builder of the parser to parse straight into it, no
+  object is kept per node. ArenaNode gives a view of one node with the fields
+  of the typed node classes.
+  """
+
+  def __init__(self, source_code):
+    self.source_code = source_code
+    offset_type = 'I' if len(source_code) < 1 << 32 else 'Q'
+    self.kinds = array('B')
+    self.first_child = array('i')
+    self.next_sibling = array('i')
+    self.starts = array(offset_type)
+    self.ends = array(offset_type)
+    self.root = -1
+    self.symbols = None
+
+  def __len__(self):
+    return len(self.kinds)
+
+  def add(self, node_type, children, start, end):
+    # Appends a node whose children were added before it, returns its index.
+    index = len(self.kinds)
+    self.kinds.append(_NODE_KINDS[node_type])
+    self.starts.append(start)
+    self.ends.append(end)
+    self.next_sibling.append(-1)
+    if children:
+      self.first_child.append(children[0])
+      next_sibling = self.next_sibling
+      for child, sibling in zip(children, children[1:]):
+        next_sibling[child] = sibling
+    else:
+      self.first_child.append(-1)
+    return index
+
+  def children(self, index):
+    # Indexes of the children of a node.
+    child = self.first_child[index]
+    next_sibling = self.next_sibling
+    while child != -1:
+      yield child
+      child = next_sibling[child]
+
+  def text(self, index):
+    text = self.source_code[self.starts[index]:self.ends[index]]
+    if not isinstance(text, str):
+      text = str(text, 'utf-8')
+    return text
+
+  def node(self, index):
+    return ArenaNode(self, index)
+
+  def leaf(self, node_type, content, start, end):
+    return self.add(node_type, (), start, end)
+
+  def string_literal(self, value, start, end):
+    return self.add('STRING_LITERAL', (), start, end)
+
+  def number_literal(self, value, start, end):
+    return self.add('NUMBER_LITERAL', (), start, end)
+
+  def module(self, items, start, end, symbols=None):
+    self.root = self.add('MODULE', items, start, end)
+    self.symbols = symbols
+    return self.node(self.root)
+
+  def declaration(self, name, variable_type, start, end, marker_start):
+    return self.add('DECLARATION', (name, variable_type), start, end)
+
+  def function_declaration(self, name, params, body, start, end, marker_start, keyword_start,
+                           params_open, params_close):
+    return self.add('FUNCTION_DECLARATION', [name] + params + [body], start, end)
+
+  def code_block(self, statements, start, end, close):
+    return self.add('CODE_BLOCK', statements, start, end)
+
+  def function_call(self, callee, args, start, end, args_open):
+    return self.add('FUNCTION_CALL', [callee] + args, start, end)
+
+  def identifier_chain(self, names, start, end, dots):
+    return self.add('IDENTIFIER_CHAIN', names, start, end)
+
+  def foreign_code_block(self, language, code, start, end, code_start, code_end):
+    code = self.add(language, (), code_start, code_end)
+    return self.add('FOREIGN_CODE_BLOCK', (code,), start, end)
+
+  def assignment(self, target, value, start, end, symbol_start):
+    children = (target,) if value is None else (target, value)
+    return self.add('ASSIGNMENT', children, start, end)
+
+
+class ArenaNode:
+  """A cursor on one node of an Arena.
+
+  It reads the node's fields from the arena columns on access, under the
+  names the typed node classes use, so the converters walk either tree.
+  """
+
+  __slots__ = ('arena', 'index')
+
+  def __init__(self, arena, index):
+    self.arena = arena
+    self.index = index
+
+  def __eq__(self, other):
+    return (isinstance(other, ArenaNode) and self.arena is other.arena and
+            self.index == other.index)
+
+  def __hash__(self):
+    return hash(self.index)
+
+  @property
+  def node_type(self):
+    return NODE_TYPES[self.arena.kinds[self.index]]
+
+  @property
+  def leaf(self):
+    return self.arena.kinds[self.index] >= _FIRST_LEAF_KIND
+
+  @property
+  def start(self):
+    return self.arena.starts[self.index]
+
+  @property
+  def end(self):
+    return self.arena.ends[self.index]
+
+  def children(self):
+    return list(map(self.arena.node, self.arena.children(self.index)))
+
+  def walk(self):
+    # Yields the node and its descendants in preorder.
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      yield node
+      stack.extend(reversed(node.children()))
+
+  def _child(self, position):
+    return self.children()[position]
+
+  items = statements = names = property(children)
+  callee = name = target = property(lambda self: self.arena.node(self.arena.first_child[self.index]))
+  variable_type = property(lambda self: self._child(1))
+  body = property(lambda self: self._child(-1))
+  args = property(lambda self: self.children()[1:])
+  language = property(lambda self: self.name.node_type)
+  code = property(lambda self: self.name.value)
+
+  @property
+  def symbols(self):
+    # The ModuleSymbols of the module, built on first access when the arena
+    # did not come straight from the parser.
+    if self.arena.symbols is None:
+      self.arena.symbols = ModuleSymbols(self.arena.node(self.arena.root).items)
+    return self.arena.symbols
+
+  @property
+  def value(self):
+    # The text of a leaf, or the value node of an assignment.
+    if self.leaf:
+      return self.arena.text(self.index)
+    children = self.children()
+    return children[1] if len(children) > 1 else None
+
+  def text(self):
+    return '.'.join(name.value for name in self.names)
+
+
+class ParseError(Exception):
+  """A syntax error, at a line and column and an offset in the source code."""
+
+  def __init__(self, message, line, column, offset=None):
+    super().__init__('line %d, column %d: %s' % (line, column, message))
+    self.message = message
+    self.line = line
+    self.column = column
+    self.offset = offset
+
+  def __reduce__(self):
+    return ParseError, (self.message, self.line, self.column, self.offset)
 
 
 class Parser:
 
-  def __init__(self, tokens):
+  def __init__(self, tokens, trivia=None, builder=None, diagnostics=None, bodies='eager'):
+    # Tokens are either a lexer.TokenBuffer or a list of lexer.Token, the
+    # parser reads them by index through token kinds and contents. Spaces and
+    # comments may have been set aside in a lexer.TriviaTable. The builder
+    # creates the nodes, typed node objects unless an Arena is given. Errors
+    # raise ParseError, unless diagnostics is a list to collect them in.
+    # Function bodies are parsed with their functions when bodies is 'eager',
+    # on first access to their statements when 'lazy', and not at all when
+    # 'outline', leaving them None. An Arena has no node for either, it only
+    # takes bodies parsed up front.
+    if bodies not in FUNCTION_BODIES:
+      raise ValueError('bodies must be one of %s' % ', '.join(FUNCTION_BODIES))
+    if bodies != 'eager' and isinstance(builder, Arena):
+      raise ValueError('Lazy and outline bodies are only built as typed nodes')
+    if isinstance(tokens, lexer.TokenBuffer):
+      self._kinds = tokens.kinds
+      self._content = tokens.content
+      self._starts = tokens.starts
+      self._ends = tokens.ends
+      self._foreign_code = tokens.foreign_code
+    else:
+      self._kinds = [lexer.TokenKind[token.token_type] for token in tokens]
+      self._content = [token.content for token in tokens].__getitem__
+      self._starts = []
+      self._ends = []
+      offset = 0
+      for token in tokens:
+        # Tokens built without a start lie end to end, as in the source.
+        if token.start is not None:
+          offset = token.start
+        self._starts.append(offset)
+        offset += len(token.content)
+        self._ends.append(offset)
+      self._foreign_code = None
     self._tokens = tokens
     self._tokens_len = len(tokens)
+    self._trivia = trivia
+    self._build = NODE_BUILDER if builder is None else builder
+    self.diagnostics = diagnostics
+    self._next_significant = self.find_significant_tokens()
+    self._bodies = bodies
+    self._matching_brackets = self.find_matching_brackets() if bodies != 'eager' else None
+    self._line_index = None
     self.index = 0
 
   def current_token(self):
+    # Returns the index of the current token.
     if self.index >= self._tokens_len:
       return None
-    return self._tokens[self.index]
+    return self.index
+
+  def find_significant_tokens(self):
+    # Returns the index of the first token that is not a space or comment at
+    # or after each index, with an extra entry for the end of the tokens. None
+    # when there are no spaces or comments to skip.
+    kinds = self._kinds
+    if SPACE not in kinds and COMMENT not in kinds:
+      return None
+    tokens_len = self._tokens_len
+    offset_type = 'I' if tokens_len < 1 << 32 else 'Q'
+    next_significant = array(offset_type, range(tokens_len + 1))
+    # Runs of spaces and comments jump to the token after them.
+    if isinstance(kinds, array):
+      trivia_runs = ((run.start(), run.end()) for run in _TRIVIA_RUN.finditer(kinds.tobytes()))
+    else:
+      trivia_runs = _trivia_runs(kinds)
+    for start, end in trivia_runs:
+      next_significant[start:end] = array(offset_type, (end,)) * (end - start)
+    return next_significant
+
+  def find_matching_brackets(self):
+    # Returns the index of the matching ] for the token at each index that is
+    # a [, and -1 for all other tokens and the [ that are never closed.
+    matching = array('i', (-1,)) * self._tokens_len
+    kinds = self._kinds
+    if isinstance(kinds, array):
+      symbols = [match.start() for match in _SYMBOL_TOKEN.finditer(kinds.tobytes())]
+    else:
+      symbols = [index for index, kind in enumerate(kinds) if kind == SYMBOL]
+    if len(symbols) < 2:
+      return matching
+    # Symbols are one character, the brackets among them are found with one
+    # search over those characters.
+    if isinstance(self._tokens, lexer.TokenBuffer):
+      source_code = self._tokens.source_code
+      characters = operator.itemgetter(*map(self._starts.__getitem__, symbols))(source_code)
+      if isinstance(source_code, str):
+        characters = ''.join(characters)
+      else:
+        characters = bytes(characters)
+    else:
+      characters = ''.join(map(self._content, symbols))
+    pattern = _BRACKET if isinstance(characters, str) else _BYTE_BRACKET
+    open_brackets = []
+    for match in pattern.finditer(characters):
+      if match.lastgroup == 'OPEN':
+        open_brackets.append(symbols[match.start()])
+      elif open_brackets:
+        matching[open_brackets.pop()] = symbols[match.start()]
+    return matching
 
   def next_token(self, skip_count=1):
-    if self.index + skip_count >= self._tokens_len:
+    index = self.index + skip_count
+    if index >= self._tokens_len:
       return None
-    # Skip spaces when looking ahead to next token.
-    elif self._tokens[self.index + skip_count].token_type == 'SPACE':
-      return self.next_token(skip_count + 1)
-    return self._tokens[self.index + skip_count]
+    # Skip spaces and comments when looking ahead to next token.
+    if self._next_significant is not None:
+      index = self._next_significant[index]
+      if index == self._tokens_len:
+        return None
+    return index
 
-  def process_whitespace(self, parent_node):
-    # TODO: consider removing this in favor of skipping whitespace.
-    current_token = self.current_token()
-    if current_token.token_type == 'SPACE':
-      whitespace_tokens = []
-      whitespace_node = Node('SPACES')
-      whitespace_node.leaf = True
-      # Leave out whitespace from the parse tree.
-      #parent_node.members.append(whitespace_node)
-      while current_token and current_token.token_type == 'SPACE':
-        # Leave out whitespace from the parse tree.
-        #whitespace_node.members.append(current_token.content)
-        self.index += 1
-        current_token = self.current_token()
-
-  def process_identifier_chain(self, parent_node):
+  def leaf(self, node_type, token):
+    # Creates a leaf node holding the content of the token at an index.
+    return self._build.leaf(node_type, self._content(token), self._starts[token], self._ends[token])
+
+  def previous_end(self):
+    # End offset of the last consumed token.
+    return self._ends[self.index - 1]
+
+  def position(self, token):
+    # Returns the (line, column) of the token at an index.
+    if self._line_index is None:
+      if isinstance(self._tokens, lexer.TokenBuffer):
+        source_code = self._tokens.source_code
+      elif self._trivia is not None:
+        # The spaces and comments are not in the tokens, the offsets count them.
+        source_code = self._trivia.tokens.source_code
+      else:
+        source_code = ''.join(token.content for token in self._tokens)
+      self._line_index = lexer.LineIndex(source_code)
+    if token is None:
+      # Past the last token, report the end of the input.
+      return self._line_index.position(self.end_offset())
+    return self._line_index.position(self._starts[token])
+
+  def end_offset(self):
+    # End of the last token that is not a space or comment, or 0.
+    index = self._tokens_len - 1
+    while index >= 0 and self._kinds[index] in TRIVIA:
+      index -= 1
+    return self._ends[index] if index >= 0 else 0
+
+  def error(self, message):
+    token = self.current_token()
+    line, column = self.position(token)
+    offset = self.end_offset() if token is None else self._starts[token]
+    raise ParseError(message, line, column, offset)
+
+  def recover(self, error, start, top_level):
+    # Records the error and skips the rest of the declaration or statement
+    # begun at token start, up to a token at the same bracket depth that can
+    # begin the next one, or to the ] closing the enclosing code block.
+    if self.diagnostics is None:
+      raise error
+    self.diagnostics.append(error)
+    error_index = max(self.index, start + 1)
+    depth = 0
+    index = start
+    while index < self._tokens_len:
+      kind = self._kinds[index]
+      if kind == SYMBOL and self._content(index) == '[':
+        depth += 1
+      elif kind == SYMBOL and self._content(index) == ']':
+        if depth == 0 and not top_level:
+          break
+        depth = max(depth - 1, 0)
+      elif index >= error_index and depth == 0:
+        if top_level:
+          self.index = index
+          next_token = self.next_token()
+          if (kind == IDENTIFIER and
+              (self.matches(next_token, SYMBOL, ':') or self.matches(next_token, SYMBOL, '='))):
+            break
+        elif kind == IDENTIFIER or kind == FOREIGN_CODE:
+          break
+      index += 1
+    self.index = index
+
+  def matches(self, token, kind, content=None):
+    # Checks the kind, and optionally the content, of the token at an index.
+    return (token is not None and self._kinds[token] == kind and
+            (content is None or self._content(token) == content))
+
+  def process_whitespace(self):
+    # Leave out spaces and comments from the parse tree, skipping them in one
+    # step.
+    if self._next_significant is not None and self.index < self._tokens_len:
+      self.index = self._next_significant[self.index]
+
+  def process_identifier_chain(self):
     # Starts with an identifier, possibly followed by a . and another identifier.
     current_token = self.current_token()
-    identifier_chain = Node('IDENTIFIER_CHAIN')
-    if not current_token or not current_token.token_type == 'IDENTIFIER':
-      print('Expected a chain of identifiers to start with an identifier')
-      sys.exit(1)
-    identifier_chain.members.append(Node('IDENTIFIER', [current_token.content], True))
+    if not self.matches(current_token, IDENTIFIER):
+      self.error('Expected a chain of identifiers to start with an identifier')
+    start = self._starts[current_token]
+    names = [self.leaf('IDENTIFIER', current_token)]
+    dots = []
     next_token = self.next_token()
-    while next_token and next_token.matches('SYMBOL', '.'):
-      # Add the . that comes after the identifier.
-      self.index += 1
-      current_token = self.current_token()
-      identifier_chain.members.append(Node('MEMBER_DOT_ACCESS', [current_token.content], True))
+    while self.matches(next_token, SYMBOL, '.'):
+      # Step onto the . that comes after the identifier.
+      self.index = next_token
+      dots.append(self._starts[next_token])
       self.index += 1
+      self.process_whitespace()
       current_token = self.current_token()
-      if not current_token or not current_token.token_type == 'IDENTIFIER':
-        print('Expected a chain of identifiers to have an identifier following a . (dot)')
-        sys.exit(1)
-      identifier_chain.members.append(Node('IDENTIFIER', [current_token.content], True))
+      if not self.matches(current_token, IDENTIFIER):
+        self.error('Expected a chain of identifiers to have an identifier following a . (dot)')
+      names.append(self.leaf('IDENTIFIER', current_token))
       next_token = self.next_token()
     self.index += 1
-    parent_node.members.append(identifier_chain)
+    return self._build.identifier_chain(names, start, self.previous_end(), dots)
 
-  def process_argument_list(self, parent_node):
+  def process_argument_list(self):
     current_token = self.current_token()
-    argument_list = Node('ARGUMENTS')
+    arguments = []
     # TODO: consume tokens until reaching the closing ]
-    if current_token:
-      if current_token.token_type == 'STRING':
-        argument_list.members.append(Node('STRING_LITERAL', [current_token.content], True))
-        self.index += 1
-      elif current_token.token_type == 'IDENTIFIER':
-        self.process_identifier_chain(argument_list)
-        #argument_list.members.append(Node('STRING_LITERAL', [current_token.content], True))
-      # TODO: handle a function call.
-    parent_node.members.append(argument_list)
-
-  def process_function_call(self, parent_node):
+    if self.matches(current_token, STRING):
+      arguments.append(self._build.string_literal(
+          self._content(current_token), self._starts[current_token], self._ends[current_token]))
+      self.index += 1
+    elif self.matches(current_token, IDENTIFIER):
+      arguments.append(self.process_identifier_chain())
+    # TODO: handle a function call.
+    return arguments
+
+  def process_function_call(self, callee, start):
     # Starts with an identifier followed by [.
     current_token = self.current_token()
-    function_call = Node('FUNCTION_CALL_ARGUMENTS')
-    if not current_token or not current_token.matches('SYMBOL', '['):
-      print('Expected a function call to have an opening [ after the identifier')
-      sys.exit(1)
-    function_call.members.append(Node('ARG_LIST_START', [current_token.content], True))
+    if not self.matches(current_token, SYMBOL, '['):
+      self.error('Expected a function call to have an opening [ after the identifier')
+    args_open = self._starts[current_token]
     self.index += 1
-    self.process_whitespace(function_call)
+    self.process_whitespace()
     # After the opening block, get the list of all arguments.
-    self.process_argument_list(function_call)
-    self.process_whitespace(function_call)
+    arguments = self.process_argument_list()
+    self.process_whitespace()
     current_token = self.current_token()
-    if not current_token or not current_token.matches('SYMBOL', ']'):
-      print('Expected a function call to have a closing ] after the function arguments')
-      sys.exit(1)
-    function_call.members.append(Node('ARG_LIST_END', [current_token.content], True))
+    if not self.matches(current_token, SYMBOL, ']'):
+      self.error('Expected a function call to have a closing ] after the function arguments')
     self.index += 1
-    parent_node.members.append(function_call)
+    return self._build.function_call(callee, arguments, start, self.previous_end(), args_open)
 
-  def process_foreign_code_block(self, parent_node):
-    # Current node is the marker for starting the foreign code block.
-    foreign_code_block = Node('FOREIGN_CODE_BLOCK')
+  def process_foreign_code_block(self):
+    # The lexer hands over the whole block, markers included, as one token.
     current_token = self.current_token()
-    source_code_block = Node('temp', [], True)
-    foreign_code_block.members.append(source_code_block)
-    if current_token and current_token.content == 'BEGIN_FOREIGN_CODE_C':
-      source_code_block.node_type = 'C'
-    elif current_token and current_token.content == 'BEGIN_FOREIGN_CODE_PYTHON':
-      source_code_block.node_type = 'PYTHON'
-    elif current_token and current_token.content == 'BEGIN_FOREIGN_CODE_GO':
-      source_code_block.node_type = 'GO'
-    elif current_token and current_token.content == 'BEGIN_FOREIGN_CODE_JAVA':
-      source_code_block.node_type = 'JAVA'
-    elif current_token and current_token.content == 'BEGIN_FOREIGN_CODE_JS':
-      source_code_block.node_type = 'JS'
-    elif current_token and current_token.content == 'BEGIN_FOREIGN_CODE_DOTNET':
-      source_code_block.node_type = 'DOTNET'
+    start = self._starts[current_token]
+    if self._foreign_code is not None:
+      language, code, code_start, code_end = self._foreign_code(current_token)
+    else:
+      content = self._content(current_token)
+      language, code_start, code_end = lexer.split_foreign_code(content)
+      code = content[code_start:code_end]
+      code_end = start + code_end
+      code_start = start + code_start
+    if language not in FOREIGN_LANGUAGES:
+      # Unknown languages keep a placeholder type, no converter emits them.
+      language = 'temp'
     self.index += 1
-    current_token = self.current_token()
-    while current_token and not current_token.content.startswith('END_FOREIGN_CODE_'):
-      source_code_block.members.append(current_token.content)
-      self.index += 1
-      current_token = self.current_token()
-    if current_token and current_token.content.startswith('END_FOREIGN_CODE_'):
-      # We have reached the end of the code block, consume this token and move forward.
-      self.index += 1
-    parent_node.members.append(foreign_code_block)
+    return self._build.foreign_code_block(language, code, start, self._ends[current_token],
+                                          code_start, code_end)
 
-  def process_assignment(self, parent_node):
+  def process_assignment(self):
     current_token = self.current_token()
     # First version: assignment starts with an identifier.
-    assignment = Node('ASSIGNMENT')
-    if not current_token or current_token.token_type != 'IDENTIFIER':
-      print('Expected assignment to start with an identifier')
-      sys.exit(1)
-    assignment.members.append(Node('ASSIGNMENT_TARGET', [current_token.content], True))
+    if not self.matches(current_token, IDENTIFIER):
+      self.error('Expected assignment to start with an identifier')
+    start = self._starts[current_token]
+    target = self.leaf('ASSIGNMENT_TARGET', current_token)
     self.index += 1
-    self.process_whitespace(assignment)
+    self.process_whitespace()
     current_token = self.current_token()
-    if not current_token or not current_token.matches('SYMBOL', '='):
-      print('Expected assignment to have a = after the identifier')
-      sys.exit(1)
-    assignment.members.append(Node('ASSIGNMENT_SYMBOL', [current_token.content], True))
+    if not self.matches(current_token, SYMBOL, '='):
+      self.error('Expected assignment to have a = after the identifier')
+    symbol_start = self._starts[current_token]
+    end = self._ends[current_token]
     self.index += 1
-    self.process_whitespace(assignment)
+    self.process_whitespace()
     current_token = self.current_token()
-    if current_token and current_token.token_type == 'STRING':
-      assignment.members.append(Node('STRING_LITERAL', [current_token.content], True))
-    elif current_token and current_token.token_type == 'NUMBER':
-      assignment.members.append(Node('NUMBER_LITERAL', [current_token.content], True))
+    value = None
+    if self.matches(current_token, STRING):
+      end = self._ends[current_token]
+      value = self._build.string_literal(self._content(current_token), self._starts[current_token],
+                                         end)
+    elif self.matches(current_token, NUMBER):
+      end = self._ends[current_token]
+      value = self._build.number_literal(self._content(current_token), self._starts[current_token],
+                                         end)
     self.index += 1
-    parent_node.members.append(assignment)
+    return self._build.assignment(target, value, start, end, symbol_start)
 
-  def process_code_block(self, parent_node):
+  def process_code_block(self):
     current_token = self.current_token()
     # We expect the code block to start with an opening [.
-    code_block = Node('CODE_BLOCK')
-    if not current_token or not current_token.matches('SYMBOL', '['):
-      print('Expected a [ to begin a code block')
-      sys.exit(1)
-    code_block.members.append(Node('CODE_BLOCK_START', [current_token.content], True))
+    if not self.matches(current_token, SYMBOL, '['):
+      self.error('Expected a [ to begin a code block')
+    start = self._starts[current_token]
+    statements = []
     self.index += 1
-    self.process_whitespace(code_block)
-    current_token = self.current_token()
-    while current_token and current_token.token_type == 'IDENTIFIER':
-      if current_token.content.startswith('BEGIN_FOREIGN_CODE_'):
-        self.process_foreign_code_block(code_block)
-        self.process_whitespace(code_block)
-        current_token = self.current_token()
-      else:
-        sub_node = Node('temp')
-        self.process_whitespace(sub_node)
-        self.process_identifier_chain(sub_node)
-        self.process_whitespace(sub_node)
-        current_token = self.current_token()
-        if current_token and current_token.matches('SYMBOL', '['):
-          # This is a function/method call.
-          self.process_function_call(sub_node)
-          sub_node.node_type = 'FUNCTION_CALL'
-          code_block.members.append(sub_node)
-        self.process_whitespace(sub_node)
-        current_token = self.current_token()
-    self.process_whitespace(code_block)
+    self.process_whitespace()
     current_token = self.current_token()
-    if current_token and current_token.matches('SYMBOL', ']'):
-      code_block.members.append(Node('CODE_BLOCK_END', [current_token.content], True))
+    while self.matches(current_token, IDENTIFIER) or self.matches(current_token, FOREIGN_CODE):
+      statement_start = self.index
+      try:
+        if self.matches(current_token, FOREIGN_CODE):
+          statements.append(self.process_foreign_code_block())
+        else:
+          callee_start = self._starts[current_token]
+          callee = self.process_identifier_chain()
+          self.process_whitespace()
+          current_token = self.current_token()
+          if self.matches(current_token, SYMBOL, '['):
+            # This is a function/method call.
+            statements.append(self.process_function_call(callee, callee_start))
+      except ParseError as error:
+        self.recover(error, statement_start, False)
+      self.process_whitespace()
+      current_token = self.current_token()
+    end = self.previous_end()
+    close = None
+    if self.matches(current_token, SYMBOL, ']'):
+      close = self._starts[current_token]
+      end = self._ends[current_token]
       #self.index += 1
-    parent_node.members.append(code_block)
+    return self._build.code_block(statements, start, end, close)
 
-  def process_function_definition(self, parent_node):
+  def process_function_definition(self, name, start, marker_start):
     current_token = self.current_token()
     # The current token is the identifier 'function' to begin the declaration.
-    function_definition = Node('FUNCTION_DEFINITION')
-    if not current_token or not current_token.matches('IDENTIFIER', 'function'):
-      print('function definition did not begin with keyword function')
-      sys.exit(1)
-    function_definition.members.append(Node('FUNCTION_KEYWORD', [current_token.content], True))
+    if not self.matches(current_token, IDENTIFIER, 'function'):
+      self.error('function definition did not begin with keyword function')
+    keyword_start = self._starts[current_token]
     self.index += 1
-    self.process_whitespace(function_definition)
+    self.process_whitespace()
     current_token = self.current_token()
     # Should be an opening [ for the parameter list.
-    if not current_token or not current_token.matches('SYMBOL', '['):
-      print('Expected a [ after the function keyword in function definition')
-      sys.exit(1)
-    function_definition.members.append(Node('FUNCTION_PARAMS_START', [current_token.content], True))
+    if not self.matches(current_token, SYMBOL, '['):
+      self.error('Expected a [ after the function keyword in function definition')
+    params_open = self._starts[current_token]
     self.index += 1
-    self.process_whitespace(function_definition)
+    self.process_whitespace()
     # TODO: process the list of parameter declarations.
     current_token = self.current_token()
-    if not current_token or not current_token.matches('SYMBOL', ']'):
-      print('Expected a ] after the first [ in a function definition')
-      sys.exit(1)
-    function_definition.members.append(Node('FUNCTION_PARAMS_END', [current_token.content], True))
+    if not self.matches(current_token, SYMBOL, ']'):
+      self.error('Expected a ] after the first [ in a function definition')
+    params_close = self._starts[current_token]
     self.index += 1
-    self.process_whitespace(function_definition)
-    self.process_code_block(function_definition)
+    self.process_whitespace()
+    current_token = self.current_token()
+    close_token = -1
+    if self._matching_brackets is not None and self.matches(current_token, SYMBOL, '['):
+      close_token = self._matching_brackets[current_token]
+    if close_token == -1:
+      body = self.process_code_block()
+    else:
+      # Jump over the body, to parse it on first access or never.
+      body = None
+      if self._bodies == 'lazy':
+        body = LazyCodeBlock(self._starts[current_token], self._ends[close_token],
+                             self._starts[close_token], self, current_token, close_token)
+      self.index = close_token
     current_token = self.current_token()
-    if not current_token or not current_token.matches('SYMBOL', ']'):
-      print('Expected a ] after the first [ in a function definition')
-      sys.exit(1)
-    parent_node.members.append(function_definition)
+    if not self.matches(current_token, SYMBOL, ']'):
+      self.error('Expected a ] after the first [ in a function definition')
     self.index += 1
+    return self._build.function_declaration(name, [], body, start, self.previous_end(),
+                                            marker_start, keyword_start, params_open, params_close)
+
+  def parse_function_body(self, open_token, close_token):
+    # Parses the statements of a body a lazy parse jumped over.
+    self.index = open_token
+    statements = self.process_code_block().statements
+    if self.index != close_token:
+      try:
+        self.error('Expected a ] after the first [ in a function definition')
+      except ParseError as error:
+        if self.diagnostics is None:
+          raise
+        self.diagnostics.append(error)
+    return statements
 
-  def process_declaration(self, parent_node):
+  def process_declaration(self):
     current_token = self.current_token()
-    declaration_tree = Node('DECLARATION')
-    self.process_whitespace(declaration_tree)
-    declaration_tree.members.append(Node('IDENTIFIER', [current_token.content], True))
+    start = self._starts[current_token]
+    name = self.leaf('IDENTIFIER', current_token)
     self.index += 1
-    self.process_whitespace(declaration_tree)
+    self.process_whitespace()
     current_token = self.current_token()
-    if current_token and current_token.matches('SYMBOL', ':'):
-      declaration_tree.members.append(Node('DECLARATION_MARKER', [':'], True))
-    else:
-      print('Expected : after variable name in declaration')
-      sys.exit(1)
+    if not self.matches(current_token, SYMBOL, ':'):
+      self.error('Expected : after variable name in declaration')
+    marker_start = self._starts[current_token]
     self.index += 1
-    self.process_whitespace(declaration_tree)
+    self.process_whitespace()
     current_token = self.current_token()
-    if current_token and current_token.matches('IDENTIFIER', 'function'):
+    if self.matches(current_token, IDENTIFIER, 'function'):
       # This is a function declaration.
-      declaration_tree.node_type = 'FUNCTION_DECLARATION'
-      self.process_function_definition(declaration_tree)
+      return self.process_function_definition(name, start, marker_start)
+    # This is a variable declaration, use this identifier as the type.
+    if not self.matches(current_token, IDENTIFIER):
+      self.error('Expected a type after : in declaration')
+    variable_type = self.leaf('VARIABLE_TYPE', current_token)
+    self.index += 1
+    return self._build.declaration(name, variable_type, start, self.previous_end(), marker_start)
+
+  def module_span(self):
+    # Offsets of the first and last tokens, trivia included.
+    if self._tokens_len:
+      start, end = self._starts[0], self._ends[-1]
     else:
-      # This is a variable declaration, use this identifier as the type.
-      declaration_tree.members.append(Node('VARIABLE_TYPE', [current_token.content], True))
-      self.index += 1
-    parent_node.members.append(declaration_tree)
+      start = end = None
+    if self._trivia:
+      trivia = self._trivia.tokens
+      if start is None or trivia.starts[0] < start:
+        start = trivia.starts[0]
+      if end is None or trivia.ends[-1] > end:
+        end = trivia.ends[-1]
+    return start, end
 
-  def build_parse_tree(self):
-    top_node = Node('MODULE')
-    if not self._tokens or self._tokens_len == 0:
-      return None
-    # Consume any leading whitespace.
-    self.process_whitespace(top_node)
+  def process_top_level_item(self):
     current_token = self.current_token()
-    while current_token and current_token.token_type == 'IDENTIFIER':
-      # This could be a variable/function declaration, an execution statement, etc.
+    # This could be a variable/function declaration, an execution statement, etc.
+    if self.matches(current_token, IDENTIFIER):
       next_token = self.next_token()
-      if next_token and next_token.token_type == 'SYMBOL':
-        # Check the next token for a : which would make this a declaration.
-        if next_token.content == ':':
-          # This is a declaration.
-          self.process_declaration(top_node)
-        elif next_token.content == '=':
-          self.process_assignment(top_node)
-      current_token = self.current_token()
-      if current_token:
-        self.process_whitespace(top_node)
+      # Check the next token for a : which would make this a declaration.
+      if self.matches(next_token, SYMBOL, ':'):
+        # This is a declaration.
+        return self.process_declaration()
+      elif self.matches(next_token, SYMBOL, '='):
+        return self.process_assignment()
+    self.error('Expected a declaration or assignment')
+
+  def iter_items(self, end=None):
+    # Yields the top-level items as they are parsed, skipping the ones with
+    # errors when there are diagnostics. With an end, the tokens from that
+    # index on are only looked at, not parsed.
+    if end is None:
+      end = self._tokens_len
+    # Consume any leading whitespace.
+    self.process_whitespace()
+    current_token = self.current_token()
+    while current_token is not None and current_token < end:
+      item_start = self.index
+      try:
+        item = self.process_top_level_item()
+      except ParseError as error:
+        self.recover(error, item_start, True)
+      else:
+        yield item
+      self.process_whitespace()
       current_token = self.current_token()
-    return top_node
+
+  def build_parse_tree(self):
+    start, end = self.module_span()
+    if start is None:
+      return None
+    items = []
+    symbols = ModuleSymbols()
+    error_count = len(self.diagnostics) if self.diagnostics is not None else 0
+    for item in self.iter_items():
+      items.append(item)
+      symbols.add(self._build.node(item))
+    if self.index < self._tokens_len:
+      end = self.previous_end() if self.index > 0 else start
+    module = self._build.module(items, start, end, symbols)
+    if self.diagnostics is not None and isinstance(module, Module):
+      module.errors = self.diagnostics[error_count:]
+    return module
+
+
+def parse_tokens(tokens, trivia=None, builder=None, diagnostics=None, bodies='eager',
+                 index=False):
+  if index:
+    # Indexing lazy bodies would parse them all.
+    if builder is not None or bodies == 'lazy':
+      raise ValueError('An index is only built for typed nodes and bodies parsed up front')
+  parser = Parser(tokens, trivia, builder, diagnostics, bodies)
+  tree = parser.build_parse_tree()
+  if index and tree is not None:
+    TreeIndex.from_tree(tree, parser._starts)
+  return tree
+
+
+def parse_source(source_code, symbols=None, builder=None, diagnostics=None, bodies='eager',
+                 index=False):
+  # Spaces and comments are set aside by the lexer, the parser never sees them.
+  # Pass the same lexer.SymbolTable for every file of a compilation to share
+  # identifier and literal strings between their trees. Syntax errors raise
+  # ParseError, pass a list as diagnostics to collect them in it instead and
+  # get back the tree of everything that did parse. See Parser for bodies,
+  # and TreeIndex for index.
+  trivia = lexer.TriviaTable(source_code)
+  tokens = lexer.tokenize_buffer(source_code, trivia=trivia, symbols=symbols)
+  return parse_tokens(tokens, trivia, builder, diagnostics, bodies, index)
+
+
+def iter_top_level(tokens, diagnostics=None):
+  """Yields the top-level items of a module as soon as each is complete.
+
+  tokens is any iterable of lexer.Token, spaces and comments included, for
+  example lexer.iter_tokens() of a file. Tokens are only held until the next
+  declaration or assignment outside of brackets begins, then the items
+  before it are parsed and yielded, so a caller that drops each item keeps
+  about one in memory. The items are the ones parse_source puts in the
+  module, and syntax errors are raised or collected in diagnostics the same
+  way.
+  """
+  # Offset of the next token in the stream.
+  offset = 0
+  chunk = []
+  # Index in chunk of an identifier that begins the next item if a : or =
+  # follows it.
+  candidate = None
+  depth = 0
+  previous_symbol = None
+  line, line_start = 1, 0
+  for token in tokens:
+    # Tokens built without a start lie end to end, as in the source. Each
+    # chunk is parsed on its own, so they are given their offset in the stream.
+    if token.start is None:
+      token = lexer.Token(token.content, token.token_type, offset)
+    offset = token.start + len(token.content)
+    token_type = token.token_type
+    if token_type in lexer.TRIVIA_TYPES:
+      chunk.append(token)
+      continue
+    content = token.content
+    chunk.append(token)
+    if candidate is not None:
+      if candidate and token_type == 'SYMBOL' and (content == ':' or content == '='):
+        # The parser sees the beginning of the next item, as it would in the
+        # whole module, but stops there.
+        line, line_start = yield from _parse_stream_chunk(chunk, candidate, line, line_start,
+                                                          diagnostics)
+        del chunk[:candidate]
+      candidate = None
+    # Like the parser, a declaration or assignment takes the token after its
+    # : or = whatever it is.
+    if (token_type == 'IDENTIFIER' and depth == 0 and
+        previous_symbol != ':' and previous_symbol != '='):
+      candidate = len(chunk) - 1
+    if token_type == 'SYMBOL':
+      previous_symbol = content
+      if content == '[':
+        depth += 1
+      elif content == ']':
+        depth = max(depth - 1, 0)
+    else:
+      previous_symbol = None
+  if chunk:
+    yield from _parse_stream_chunk(chunk, len(chunk), line, line_start, diagnostics)
+
+
+def _parse_stream_chunk(tokens, end, line, line_start, diagnostics):
+  # Yields the items in tokens before index end, and returns the line and
+  # line start offset of the token at end.
+  lines = _ChunkLines(tokens, line, line_start)
+  parser = Parser(tokens, diagnostics=diagnostics)
+  parser._line_index = lines
+  yield from parser.iter_items(end)
+  if end < len(tokens):
+    return lines.line_at(tokens[end].start)
+  return line, line_start
+
+
+class _ChunkLines:
+  # Positions of the tokens of a chunk of a stream, whose first token is on
+  # the given line, starting at offset line_start. Offsets are in the whole
+  # stream.
+
+  def __init__(self, tokens, line, line_start):
+    self._text = ''.join([token.content for token in tokens])
+    self._base = tokens[0].start
+    self._line = line
+    self._line_start = line_start
+    self._line_index = None
+
+  def position(self, offset):
+    if self._line_index is None:
+      self._line_index = lexer.LineIndex(self._text)
+    line, column = self._line_index.position(offset - self._base)
+    if line == 1:
+      column = offset - self._line_start + 1
+    return self._line + line - 1, column
+
+  def line_at(self, offset):
+    # The line of an offset and the offset that line starts at.
+    offset -= self._base
+    newlines = self._text.count('\n', 0, offset)
+    if not newlines:
+      return self._line, self._line_start
+    return self._line + newlines, self._base + self._text.rindex('\n', 0, offset) + 1
+
+
+def parse_source_arena(source_code):
+  """Parses into an Arena, returns the ArenaNode of the module or None."""
+  return parse_source(source_code, builder=Arena(source_code))
+
+def reparse(tree, source_code, edit_start, old_end, new_end, symbols=None, diagnostics=None):
+  """Parses source code again after an edit, reusing the unchanged nodes of tree.
+
+  tree is what parse_source returned for the source code before the edit,
+  which replaced the old source from edit_start to old_end with the new
+  source from edit_start to new_end. Top-level items away from the edit are
+  kept, those after it moved by the change in length, and only the items
+  around the edit are parsed again. The result is the tree parse_source
+  would return for the new source code. tree is reused to build it and must
+  not be used afterwards.
+
+  When the edit may change how the source around it is read, for example by
+  opening a string or a comment, or when the items around it do not parse,
+  the whole source is parsed again instead. A TreeIndex of tree is built
+  again over the whole new tree.
+
+  The errors of tree away from the edit are kept, moved like the items, and
+  added to diagnostics. Without diagnostics, a tree with errors is parsed
+  again in full, which raises the first error left.
+  """
+  if tree is None:
+    return parse_source(source_code, symbols, diagnostics=diagnostics)
+  indexed = tree.index is not None
+  if tree.errors and diagnostics is None:
+    return parse_source(source_code, symbols, index=indexed)
+  items = tree.items
+  delta = new_end - old_end
+  # Items keep their tokens if the edit starts past the character after
+  # their end, the lexer looks no further to end a token.
+  first = bisect.bisect_right(items, edit_start, key=_item_end)
+  # An assignment without a value takes the token after it, which may be in
+  # the edit.
+  while first > 0 and items[first - 1].node_type == 'ASSIGNMENT' and items[first - 1].value is None:
+    first -= 1
+  last = bisect.bisect_right(items, old_end, key=_item_start)
+  region_start = items[first - 1].end if first > 0 else 0
+  region_end = items[last].start + delta if last < len(items) else len(source_code)
+  region = source_code[region_start:region_end]
+  trivia = lexer.TriviaTable(region)
+  parser = Parser(lexer.tokenize_buffer(region, trivia=trivia, symbols=symbols), trivia)
+  try:
+    region_tree = parser.build_parse_tree()
+  except ParseError:
+    return parse_source(source_code, symbols, diagnostics=diagnostics, index=indexed)
+  if region_tree is not None and parser.index != parser._tokens_len:
+    return parse_source(source_code, symbols, diagnostics=diagnostics, index=indexed)
+  if 0 < region_end < len(source_code) and not _ends_cleanly(region, parser):
+    # The last token might go on into the items after the region.
+    return parse_source(source_code, symbols, diagnostics=diagnostics, index=indexed)
+  if region_tree is not None:
+    region_tree.shift(region_start)
+    region_items = region_tree.items
+  else:
+    region_items = []
+  suffix = items[last:]
+  errors = _moved_errors(tree.errors, source_code, region_start, region_end - delta,
+                         delta, bool(suffix))
+  if diagnostics is not None:
+    diagnostics.extend(errors)
+  if delta:
+    for item in suffix:
+      item.shift(delta)
+  if first > 0:
+    start = tree.start
+  elif region_tree is not None:
+    start = region_tree.start
+  elif suffix:
+    start = suffix[0].start
+  else:
+    return None
+  if suffix:
+    end = tree.end + delta
+  elif region_tree is not None:
+    end = region_tree.end
+  else:
+    end = region_start
+  tree.items = items[:first] + region_items + suffix
+  tree.start = start
+  tree.end = end
+  tree.symbols = ModuleSymbols(tree.items)
+  tree.errors = errors
+  if indexed:
+    TreeIndex.from_tree(tree, source_code=source_code)
+  return tree
+
+
+def _moved_errors(errors, source_code, region_start, old_region_end, delta, after_region):
+  # The errors before the region parsed again, and those after it moved by
+  # delta. The region parsed without errors, the ones that were in it are gone.
+  moved = [error for error in errors if error.offset < region_start]
+  if after_region:
+    line_index = None
+    for error in errors:
+      if error.offset >= old_region_end:
+        if line_index is None:
+          line_index = lexer.LineIndex(source_code)
+        offset = error.offset + delta
+        line, column = line_index.position(offset)
+        moved.append(ParseError(error.message, line, column, offset))
+  return moved
+
+
+def _item_start(item):
+  return item.start
+
+
+def _item_end(item):
+  # Items ending right before the edit still need the character after them.
+  return item.end + 1
+
+
+def _ends_cleanly(region, parser):
+  # Checks that the region ends with spaces or a line comment and its line
+  # break, that its last token could not go on past it as a string, a block
+  # comment, an identifier or a number would.
+  trivia = parser._trivia
+  if not trivia or trivia.tokens.ends[-1] != len(region):
+    return False
+  last = len(trivia) - 1
+  if trivia.tokens.kinds[last] == SPACE:
+    return True
+  content = trivia.tokens.content(last)
+  return content.startswith('//') and content.endswith(('\n', '\r'))
+
+
+
+# Lexical structure that matters for finding top-level declarations: brackets,
+# and strings, comments and foreign code blocks as the lexer sees them, whose
+# contents are skipped. Then declarations and assignments starting a line.
+_STRUCTURE = re.compile(r"""
+    (?P<OPEN>\[)
+  | (?P<CLOSE>\])
+  | BEGIN_FOREIGN_CODE_\w*(?:[\s\S]*?(?<!\w)END_FOREIGN_CODE_\w*|[\s\S]*)
+  | '(?:[^'\\]+|\\[\s\S]?)*'?
+  | "(?:[^"\\]+|\\[\s\S]?)*"?
+  | //[^\n\r]*
+  | /\*(?:[\s\S]*?\*/|[\s\S]*)
+  | (?P<DECLARATION>^[A-Za-z]\w*[ \t]*[:=])
+""", re.MULTILINE | re.VERBOSE)
+
+
+def find_split_points(source_code, count):
+  """Returns up to count - 1 offsets that split the source into chunks.
+
+  Each offset is the start of a top-level declaration or assignment that
+  begins a line, outside of strings, comments, foreign code and brackets,
+  taken at or after an even share of the source.
+  """
+  split_points = []
+  target = len(source_code) * (len(split_points) + 1) // count
+  depth = 0
+  for match in _STRUCTURE.finditer(source_code):
+    group = match.lastgroup
+    if group == 'OPEN':
+      depth += 1
+    elif group == 'CLOSE':
+      depth -= 1
+    elif group == 'DECLARATION' and depth == 0 and match.start() >= target:
+      split_points.append(match.start())
+      if len(split_points) == count - 1:
+        break
+      target = len(source_code) * (len(split_points) + 1) // count
+  return split_points
+
+
+def _parse_chunk(source_code, base):
+  # Parses one chunk in a worker process. Returns its top-level nodes, moved
+  # to base and pickled, or None if the chunk does not parse into complete
+  # top-level items.
+  trivia = lexer.TriviaTable(source_code)
+  parser = Parser(lexer.tokenize_buffer(source_code, trivia=trivia), trivia)
+  try:
+    tree = parser.build_parse_tree()
+  except ParseError:
+    return None
+  if parser.index != parser._tokens_len:
+    return None
+  tree.shift(base)
+  return pickle.dumps(tree.items, pickle.HIGHEST_PROTOCOL)
 
 
-def parse_tokens(tokens):
-  parser = Parser(tokens)
-  return parser.build_parse_tree()
+def _load_nodes(data):
+  # The trees hold no cycles, collecting garbage while creating that many
+  # objects would only slow this down.
+  gc_was_enabled = gc.isenabled()
+  gc.disable()
+  try:
+    return pickle.loads(data)
+  finally:
+    if gc_was_enabled:
+      gc.enable()
 
 
-def parse_source(source_code):
-  return parse_tokens(lexer.tokenize(source_code))
+def parse_source_parallel(source_code, workers=None, executor=None, min_chunk_size=1 << 20,
+                          diagnostics=None):
+  """Parses a large module in chunks on worker processes.
 
+  The source is split at top-level declarations, see find_split_points, and
+  the nodes from all chunks are put together in source order. The tree is the
+  same as parse_source returns: if any chunk does not parse on its own, the
+  whole source is parsed serially instead, raising or collecting errors in
+  diagnostics as parse_source does. Pass an executor to reuse worker processes
+  across files.
+  """
+  if workers is None:
+    workers = os.cpu_count() or 1
+  count = min(workers, len(source_code) // min_chunk_size)
+  split_points = find_split_points(source_code, count) if count > 1 else []
+  if not split_points:
+    return parse_source(source_code, diagnostics=diagnostics)
+  bounds = [0] + split_points + [len(source_code)]
+  chunks = [source_code[bounds[index]:bounds[index + 1]] for index in range(len(bounds) - 1)]
+  if executor is None:
+    with concurrent.futures.ProcessPoolExecutor(len(chunks)) as chunk_executor:
+      results = list(chunk_executor.map(_parse_chunk, chunks, bounds))
+  else:
+    results = list(executor.map(_parse_chunk, chunks, bounds))
+  if None in results:
+    return parse_source(source_code, diagnostics=diagnostics)
+  items = []
+  for data in results:
+    items.extend(_load_nodes(data))
+  return Module(items, 0, len(source_code))
@@ -0,0 +1,123 @@
+import io
+import os
+import tempfile
+import unittest
+from array import array
+from unittest import mock
+import cache
+import converter
+import parser
+
+
+SOURCE_CODE = """
+moduleName = "cached"
+count = 12
+
+main: function[][
+  os.print["Café\\n"]
+BEGIN_FOREIGN_CODE_PYTHON
+  print('foreign')
+END_FOREIGN_CODE_PYTHON
+  os.print[count]
+]
+"""
+
+
+def arena_tree(node):
+  return (node.node_type, node.start, node.end, node.value if node.leaf else None,
+          tuple(arena_tree(child) for child in node.children()))
+
+
+class TestBinaryFormat(unittest.TestCase):
+  """Writes Arena trees to bytes and reads them back in place."""
+
+  def test_round_trip(self):
+    module = parser.parse_source_arena(SOURCE_CODE)
+    output = io.BytesIO()
+    cache.dump_arena(module.arena, output)
+    view = cache.load_arena(output.getvalue())
+    self.assertEqual(len(module.arena), len(view))
+    self.assertEqual(arena_tree(module), arena_tree(view.node(view.root)))
+
+  def test_large_offsets(self):
+    arena = parser.Arena('x')
+    arena.starts = array('Q', arena.starts)
+    arena.ends = array('Q', arena.ends)
+    arena.module([arena.leaf('IDENTIFIER', 'x', 0, 1)], 0, 1 << 40)
+    output = io.BytesIO()
+    cache.dump_arena(arena, output)
+    view = cache.load_arena(output.getvalue())
+    self.assertEqual([0, 0], list(view.starts))
+    self.assertEqual([1, 1 << 40], list(view.ends))
+
+  def test_not_a_tree(self):
+    output = io.BytesIO()
+    cache.dump_arena(parser.parse_source_arena(SOURCE_CODE).arena, output)
+    for data in (b'', b'something else', output.getvalue()[:-1]):
+      with self.assertRaises(cache.CacheFormatError):
+        cache.load_arena(data)
+
+
+class TestParseCache(unittest.TestCase):
+  """Parses each version of a source once."""
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.cache = cache.ParseCache(self.directory.name)
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def test_skips_parsing_unchanged_source(self):
+    expected = arena_tree(self.cache.parse(SOURCE_CODE))
+    with mock.patch.object(parser.Parser, 'build_parse_tree', side_effect=AssertionError):
+      module = self.cache.parse(SOURCE_CODE)
+    self.assertIsInstance(module.arena, cache.ArenaView)
+    self.assertEqual(expected, arena_tree(module))
+    self.assertEqual(converter.convert(parser.parse_source(SOURCE_CODE), 'python')[0].content,
+                     converter.convert(module, 'python')[0].content)
+
+  def test_changed_source(self):
+    self.cache.parse(SOURCE_CODE)
+    changed = SOURCE_CODE.replace('12', '13')
+    module = self.cache.parse(changed)
+    self.assertIsInstance(module.arena, parser.Arena)
+    self.assertNotIsInstance(module.arena, cache.ArenaView)
+    self.assertEqual('13', module.items[1].value.value)
+    self.assertEqual(2, len(os.listdir(self.directory.name)))
+
+  def test_parse_file(self):
+    with tempfile.NamedTemporaryFile('wb', delete=False) as source_file:
+      source_file.write(SOURCE_CODE.encode('utf-8'))
+    try:
+      expected = arena_tree(self.cache.parse_file(source_file.name))
+      self.assertEqual(expected, arena_tree(self.cache.parse(SOURCE_CODE)))
+      self.assertIsInstance(self.cache.parse_file(source_file.name).arena, cache.ArenaView)
+    finally:
+      os.remove(source_file.name)
+
+  def test_empty_source(self):
+    self.assertIsNone(self.cache.parse(''))
+    self.assertIsNone(self.cache.parse(''))
+
+  def test_damaged_cache_file(self):
+    self.cache.parse(SOURCE_CODE)
+    cache_path = self.cache.path(SOURCE_CODE.encode('utf-8'))
+    with open(cache_path, 'r+b') as cache_file:
+      cache_file.write(b'garbage!')
+    module = self.cache.parse(SOURCE_CODE)
+    self.assertEqual(arena_tree(parser.parse_source_arena(SOURCE_CODE)), arena_tree(module))
+    self.assertIsInstance(self.cache.parse(SOURCE_CODE).arena, cache.ArenaView)
+
+  def test_empty_cache_file(self):
+    cache_path = self.cache.path(SOURCE_CODE.encode('utf-8'))
+    open(cache_path, 'wb').close()
+    with self.assertRaises(cache.CacheFormatError):
+      self.cache.load(cache_path)
+    module = self.cache.parse(SOURCE_CODE)
+    self.assertEqual(arena_tree(parser.parse_source_arena(SOURCE_CODE)), arena_tree(module))
+    self.assertIsInstance(self.cache.parse(SOURCE_CODE).arena, cache.ArenaView)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -3,6 +3,7 @@ import parser
 import converter
 import os
 import subprocess
+import sys
 
 
 HELLO_WORLD_EXAMPLE = """
@@ -41,6 +42,11 @@ END_FOREIGN_CODE_DOTNET
 """
 
 
+def setUpModule():
+  # The tests write the converted code here, to compile and run it.
+  os.makedirs(os.path.join('tests', 'test_output'), exist_ok=True)
+
+
 class TestConvertToC(unittest.TestCase):
   """Convert the headspace code to C."""
 
@@ -256,6 +262,89 @@ class TestConvertToDotNet(unittest.TestCase):
     subprocess.run(['rm', file_path], check=True)
 
 
+class TestConvert(unittest.TestCase):
+
+  def test_invalid_language(self):
+    tree = parser.parse_source(HELLO_WORLD_EXAMPLE)
+    with self.assertRaises(ValueError):
+      converter.convert(tree, 'cobol')
+
+
+class TestModuleSymbols(unittest.TestCase):
+  """Converters find the module name and main function by name."""
+
+  def test_first_item_with_a_name(self):
+    tree = parser.parse_source('moduleName = "first"\nmoduleName = "second"\n' +
+                               HELLO_WORLD_EXAMPLE + 'main: function[][]\n')
+    self.assertEqual('first', converter.find_module_name(tree))
+    self.assertIs(tree.items[3], converter.find_main_function(tree))
+
+  def test_missing_names(self):
+    tree = parser.parse_source('main: int32\nmoduleName = unquoted\n')
+    self.assertIsNone(converter.find_module_name(tree))
+    self.assertIsNone(converter.find_main_function(tree))
+
+
+class TestConvertArena(unittest.TestCase):
+  """Converting a tree stored in an Arena gives the same code."""
+
+  def test_converts_arena_tree(self):
+    for source_code in (HELLO_WORLD_EXAMPLE, FOREIGN_CODE_EXAMPLE):
+      for language in ('c', 'python', 'go', 'javascript', 'java', 'dotnet'):
+        files = converter.convert(parser.parse_source(source_code), language)
+        arena_files = converter.convert(parser.parse_source_arena(source_code), language)
+        self.assertEqual([(source.filename, source.content) for source in files],
+                         [(source.filename, source.content) for source in arena_files])
+
+
+class TestConvertShared(unittest.TestCase):
+  """Converting a tree with shared statements gives the same code."""
+
+  def test_converts_shared_tree(self):
+    source_code = HELLO_WORLD_EXAMPLE.replace(']\n]', ']\n  os.print["Hello World\\n"]\n]')
+    tree = parser.parse_source(source_code, builder=parser.SharingBuilder())
+    statements = tree.items[1].body.statements
+    self.assertIs(statements[0], statements[1])
+    for language in ('c', 'python', 'go', 'javascript', 'java', 'dotnet'):
+      self.assertEqual(converter.convert(parser.parse_source(source_code), language)[0].content,
+                       converter.convert(tree, language)[0].content)
+
+
+class TestNestedCodeBlocks(unittest.TestCase):
+  """Code blocks in code blocks are emitted one level deeper."""
+
+  def nest(self, depth):
+    tree = parser.parse_source(HELLO_WORLD_EXAMPLE)
+    body = tree.items[1].body
+    for _ in range(depth):
+      body.statements.append(parser.CodeBlock(list(body.statements)))
+      body = body.statements[-1]
+    return tree
+
+  def test_nested_block(self):
+    self.assertEqual('#include<stdio.h>\nint main(void) \n{\n'
+                     '  printf("%s", "Hello World\\n");\n'
+                     '\n{\n'
+                     '    printf("%s", "Hello World\\n");\n'
+                     '}\n'
+                     '  return 0;\n'
+                     '}\n',
+                     converter.convert(self.nest(1), 'c')[0].content)
+    self.assertEqual('func main() {\n'
+                     '\tfmt.Print("Hello World\\n"){\n'
+                     '\t\tfmt.Print("Hello World\\n")\n'
+                     '\t}\n'
+                     '\n'
+                     '}\n',
+                     converter.convert(self.nest(1), 'go')[0].content.split('\n\n', 2)[2])
+
+  def test_deeper_than_recursion_limit(self):
+    depth = sys.getrecursionlimit() * 2
+    content = converter.convert(self.nest(depth), 'javascript')[0].content
+    self.assertEqual(depth + 1, content.count('process.stdout.write'))
+    self.assertIn(' ' * (2 * depth + 2) + 'process.stdout.write', content)
+
+
 if __name__ == '__main__':
   unittest.main()
 
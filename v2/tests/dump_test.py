@@ -0,0 +1,152 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+import dump
+import lexer
+import parser
+from tests.parser_test import nested_calls
+
+
+SOURCE_CODE = """
+moduleName = "dumped"
+// A comment.
+main: function[][
+  os.print["Hi \\"there\\"\\n"]
+BEGIN_FOREIGN_CODE_C
+  printf("foreign");
+END_FOREIGN_CODE_C
+]
+"""
+
+
+class CountingFile(io.StringIO):
+
+  def __init__(self):
+    super().__init__()
+    self.writes = 0
+
+  def write(self, text):
+    self.writes += 1
+    return super().write(text)
+
+
+def dumped(tree, format='jsonl'):
+  output = io.StringIO()
+  dump.dump_tree(tree, output, format)
+  return output.getvalue()
+
+
+class TestDumpTree(unittest.TestCase):
+  """Writes parse trees a node at a time."""
+
+  def test_jsonl(self):
+    tree = parser.parse_source(SOURCE_CODE)
+    lines = [json.loads(line) for line in dumped(tree).splitlines()]
+    self.assertEqual({'id': 0, 'parent': -1, 'type': 'MODULE', 'start': 0,
+                      'end': len(SOURCE_CODE)}, lines[0])
+    self.assertEqual([line['id'] for line in lines], list(range(len(lines))))
+    self.assertEqual([node.node_type for node in tree.walk()], [line['type'] for line in lines])
+    call = [line for line in lines if line['type'] == 'FUNCTION_CALL'][0]
+    self.assertEqual(['IDENTIFIER_CHAIN', 'STRING_LITERAL'],
+                     [line['type'] for line in lines if line['parent'] == call['id']])
+    self.assertIn({'id': 11, 'parent': 7, 'type': 'STRING_LITERAL', 'start': 66, 'end': 82,
+                   'value': '"Hi \\"there\\"\\n"'}, lines)
+    foreign = lines[-1]
+    self.assertEqual(('FOREIGN_CODE_BLOCK', 'C', '\n  printf("foreign");\n'),
+                     (foreign['type'], foreign['language'], foreign['value']))
+
+  def test_sexp(self):
+    self.assertEqual(
+        '(MODULE 0 3\n'
+        '  (ASSIGNMENT 0 3\n'
+        '    (ASSIGNMENT_TARGET 0 1 "x")\n'
+        '    (NUMBER_LITERAL 2 3 "1")))\n',
+        dumped(parser.parse_source('x=1'), 'sexp'))
+
+  def test_same_for_all_trees(self):
+    expected = dumped(parser.parse_source(SOURCE_CODE), 'sexp')
+    self.assertEqual(expected, dumped(parser.parse_source_arena(SOURCE_CODE), 'sexp'))
+    self.assertEqual(expected, dumped(parser.parse_source(SOURCE_CODE, bodies='lazy'), 'sexp'))
+
+  def test_missing_offsets(self):
+    tree = parser.parse_source('x=1', builder=parser.SharingBuilder())
+    self.assertIn('(NUMBER_LITERAL nil nil "1")', dumped(tree, 'sexp'))
+    self.assertIn('"start": null, "end": null', dumped(tree))
+
+  def test_deep_tree(self):
+    depth = sys.getrecursionlimit() * 2
+    tree = nested_calls(depth)
+    self.assertEqual(1 + 3 * depth + 1, len(dumped(tree).splitlines()))
+    self.assertTrue(dumped(tree, 'sexp').endswith('"\\"x\\"")' + ')' * (depth + 1) + '\n'))
+
+  def test_buffered_writes(self):
+    output = CountingFile()
+    dump.dump_tree(nested_calls(10000), output)
+    self.assertLess(output.writes, 20)
+
+  def test_unknown_format(self):
+    with self.assertRaises(ValueError):
+      dump.dump_tree(parser.parse_source('x=1'), io.StringIO(), 'xml')
+
+
+class TestDumpTokens(unittest.TestCase):
+  """Writes tokens a line each."""
+
+  def test_formats(self):
+    tokens = lexer.tokenize('x = "a"')
+    output = io.StringIO()
+    dump.dump_tokens(tokens, output)
+    self.assertEqual([{'type': 'IDENTIFIER', 'start': 0, 'content': 'x'},
+                      {'type': 'SPACE', 'start': 1, 'content': ' '},
+                      {'type': 'SYMBOL', 'start': 2, 'content': '='},
+                      {'type': 'SPACE', 'start': 3, 'content': ' '},
+                      {'type': 'STRING', 'start': 4, 'content': '"a"'}],
+                     [json.loads(line) for line in output.getvalue().splitlines()])
+    output = io.StringIO()
+    dump.dump_tokens(iter(tokens), output, 'sexp')
+    self.assertEqual('(IDENTIFIER 0 "x")\n(SPACE 1 " ")\n(SYMBOL 2 "=")\n(SPACE 3 " ")\n'
+                     '(STRING 4 "\\"a\\"")\n', output.getvalue())
+
+
+class TestMain(unittest.TestCase):
+  """Dumps a source file from the command line."""
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.source_path = os.path.join(self.directory.name, 'source.hs')
+    self.output_path = os.path.join(self.directory.name, 'output')
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def run_main(self, source_code, *args):
+    with open(self.source_path, 'w', encoding='utf-8') as source_file:
+      source_file.write(source_code)
+    errors = io.StringIO()
+    with redirect_stderr(errors):
+      status = dump.main([self.source_path, '-o', self.output_path] + list(args))
+    with open(self.output_path, encoding='utf-8') as output_file:
+      return status, output_file.read(), errors.getvalue()
+
+  def test_tree(self):
+    self.assertEqual((0, dumped(parser.parse_source(SOURCE_CODE), 'sexp'), ''),
+                     self.run_main(SOURCE_CODE, '--format', 'sexp'))
+
+  def test_tokens(self):
+    output = io.StringIO()
+    dump.dump_tokens(lexer.tokenize(SOURCE_CODE), output)
+    self.assertEqual((0, output.getvalue(), ''), self.run_main(SOURCE_CODE, '--tokens'))
+
+  def test_syntax_errors(self):
+    status, output, errors = self.run_main('x = \nmain: function[][ os.print[ ]\n')
+    self.assertEqual(1, status)
+    self.assertEqual(3, len(output.splitlines()))
+    self.assertIn('source.hs: line 2, column 5', errors)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,7 +1,45 @@
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
 import unittest
 import lexer
 
 
+ENGINE_SAMPLES = (
+  'simple example',
+  'x y     multi_with_underscore   camelCase\nx1\ta2 \nc',
+  '5 12 98234823 3.14 56.7.8.9 5. 7..',
+  '\'hello\',\'it\\\'s inline\' "double quotes"-"it\'s great" \'to "mix"\'',
+  '/**/ /* */ /******/ /* * /*/x//\n//*single line\n1',
+  'ab,c/d+e;=$f:g.h',
+  '"unterminated \\',
+  '\'unterminated',
+  '/* unterminated',
+  '// unterminated',
+  '/*',
+  '//',
+  '// windows\r\nnext',
+  'caf\u00e9 \u00b2\u00bd x\u00b2 \u4e00\u4e8c 3\u4e00 \u0663\u0664.\u0665 _under \u00a0\u2003',
+  'main: function[][\n  os.print["Hello World\\n"]\n]\n',
+)
+
+FOREIGN_CODE_SAMPLE = '''main: function[][
+BEGIN_FOREIGN_CODE_C
+  int x = 10; /* comment */
+  printf("%i\\n", x);
+END_FOREIGN_CODE_C
+]
+'''
+
+
+def random_source(rng, length):
+  alphabet = 'aZ_09.\'"\\/*\n\r\t []:=\u00e9\u00b2\u4e00\u0663\u00a0'
+  return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
 class TestLexerTokenize(unittest.TestCase):
   """Exercises the tokenizer."""
 
@@ -118,6 +156,453 @@ class TestLexerTokenize(unittest.TestCase):
           ('IDENTIFIER', 'h')
         ), tokens)
 
+  def test_tokenize_comments_at_end_of_input(self):
+    """The last character of an unterminated comment is not repeated."""
+    self.assertTokens((('COMMENT', '/*'),), lexer.tokenize('/*'))
+    self.assertTokens((('COMMENT', '/* open'),), lexer.tokenize('/* open'))
+    self.assertTokens((('COMMENT', '//'),), lexer.tokenize('//'))
+    self.assertTokens((
+          ('IDENTIFIER', 'x'),
+          ('COMMENT', '// trailing'),
+        ), lexer.tokenize('x// trailing'))
+
+
+class TestRegexEngine(unittest.TestCase):
+  """The regex engine produces the same tokens as the Tokenizer."""
+
+  def assertSameTokens(self, source_code):
+    expected = lexer.tokenize(source_code)
+    actual = lexer.tokenize(source_code, engine='regex')
+    self.assertEqual(
+        [(token.token_type, token.content) for token in expected],
+        [(token.token_type, token.content) for token in actual],
+        repr(source_code))
+
+  def test_samples(self):
+    for sample in ENGINE_SAMPLES:
+      self.assertSameTokens(sample)
+
+  def test_empty_source(self):
+    self.assertEqual([], lexer.tokenize('', engine='regex'))
+
+  def test_random_sources(self):
+    rng = random.Random(1234)
+    for _ in range(300):
+      self.assertSameTokens(random_source(rng, rng.randint(1, 60)))
+
+  def test_ascii_sources_skip_the_unicode_classes(self):
+    lexer._token_patterns.clear()
+    self.assertSameTokens(ENGINE_SAMPLES[-1])
+    self.assertNotIn(False, lexer._token_patterns)
+    for sample in ENGINE_SAMPLES:
+      if sample.isascii():
+        self.assertEqual(
+            [match.group() for match in lexer.token_pattern().finditer(sample)],
+            [match.group() for match in lexer.token_pattern(ascii=True).finditer(sample)])
+
+
+@unittest.skipIf('numpy' not in lexer.ENGINES, 'NumPy is not installed')
+class TestNumpyEngine(unittest.TestCase):
+  """The numpy engine produces the same tokens as the Tokenizer."""
+
+  def assertSameTokens(self, source_code):
+    expected = lexer.tokenize(source_code)
+    actual = lexer.tokenize(source_code, engine='numpy')
+    self.assertEqual(
+        [(token.token_type, token.content, token.start) for token in expected],
+        [(token.token_type, token.content, token.start) for token in actual],
+        repr(source_code))
+
+  def test_samples(self):
+    for sample in ENGINE_SAMPLES + (FOREIGN_CODE_SAMPLE, 'x \ud800y'):
+      self.assertSameTokens(sample)
+
+  def test_empty_source(self):
+    self.assertEqual([], lexer.tokenize('', engine='numpy'))
+
+  def test_runs_split_inside(self):
+    self.assertSameTokens('1abc _x 3.14.5x1 2.y // c\n  z "a\\"b"c')
+
+  def test_random_sources(self):
+    rng = random.Random(1357)
+    for _ in range(300):
+      self.assertSameTokens(random_source(rng, rng.randint(1, 60)))
+
+  def test_scan_in_windows(self):
+    rng = random.Random(2468)
+    sources = list(ENGINE_SAMPLES + (FOREIGN_CODE_SAMPLE,))
+    sources += [random_source(rng, rng.randint(1, 60)) for _ in range(100)]
+    window = lexer._SCAN_WINDOW
+    try:
+      for lexer._SCAN_WINDOW in (1, 2, 5):
+        for source_code in sources:
+          expected = list(lexer.RegexTokenizer(source_code).scan())
+          self.assertEqual(expected, list(lexer.NumpyTokenizer(source_code).scan()))
+          # From inside the source, at the start of a token.
+          _, start, _ = expected[len(expected) // 2]
+          tokenizer = lexer.NumpyTokenizer(source_code)
+          tokenizer.index = start
+          self.assertEqual(expected[len(expected) // 2:], list(tokenizer.scan()))
+    finally:
+      lexer._SCAN_WINDOW = window
+
+  def test_imported_on_first_use(self):
+    # Importing NumPy costs more than lexing most sources.
+    imported = subprocess.run(
+        [sys.executable, '-c', 'import sys, lexer; print("numpy" in sys.modules)'],
+        capture_output=True, text=True, check=True).stdout
+    self.assertEqual('False\n', imported)
+
+  def test_token_buffer(self):
+    buffer = lexer.tokenize_buffer(FOREIGN_CODE_SAMPLE, engine='numpy')
+    expected = lexer.tokenize_buffer(FOREIGN_CODE_SAMPLE)
+    self.assertEqual(list(expected.kinds), list(buffer.kinds))
+    self.assertEqual(list(expected.ends), list(buffer.ends))
+
+
+class TestIterTokens(unittest.TestCase):
+  """Streams tokens out of file objects in chunks."""
+
+  def assertSameTokens(self, source_code, chunk_size, engine='python'):
+    expected = lexer.tokenize(source_code)
+    actual = list(lexer.iter_tokens(io.StringIO(source_code), chunk_size, engine))
+    self.assertEqual(
+        [(token.token_type, token.content) for token in expected],
+        [(token.token_type, token.content) for token in actual],
+        repr((source_code, chunk_size, engine)))
+
+  def test_tokens_spanning_chunks(self):
+    for sample in ENGINE_SAMPLES:
+      for chunk_size in (1, 2, 3, 7, 64):
+        self.assertSameTokens(sample, chunk_size)
+        self.assertSameTokens(sample, chunk_size, 'regex')
+
+  def test_long_tokens(self):
+    source_code = 'x' * 500 + ' ' * 500 + '"' + 'y' * 500 + '" /*' + 'z' * 500 + '*/'
+    self.assertSameTokens(source_code, 16)
+
+  def test_empty_file(self):
+    self.assertEqual([], list(lexer.iter_tokens(io.StringIO(''))))
+
+  def test_random_sources(self):
+    rng = random.Random(4321)
+    for _ in range(100):
+      self.assertSameTokens(random_source(rng, rng.randint(1, 60)), rng.randint(1, 8))
+
+
+class TestForeignCode(unittest.TestCase):
+  """Foreign code blocks are lexed as a single token."""
+
+  def test_foreign_code_token(self):
+    sample = 'x BEGIN_FOREIGN_CODE_C\n  char* s = "it\'s";\nEND_FOREIGN_CODE_C y'
+    for engine in lexer.ENGINES:
+      self.assertTokens((
+            ('IDENTIFIER', 'x'),
+            ('SPACE', ' '),
+            ('FOREIGN_CODE', 'BEGIN_FOREIGN_CODE_C\n  char* s = "it\'s";\nEND_FOREIGN_CODE_C'),
+            ('SPACE', ' '),
+            ('IDENTIFIER', 'y'),
+          ), lexer.tokenize(sample, engine))
+
+  def test_end_marker_must_be_a_whole_identifier(self):
+    sample = 'BEGIN_FOREIGN_CODE_GO xEND_FOREIGN_CODE_GO\nEND_FOREIGN_CODE_GO;'
+    for engine in lexer.ENGINES:
+      self.assertTokens((
+            ('FOREIGN_CODE', sample[:-1]),
+            ('SYMBOL', ';'),
+          ), lexer.tokenize(sample, engine))
+
+  def test_unterminated_foreign_code(self):
+    sample = 'BEGIN_FOREIGN_CODE_JS\nconsole.log("x");\n'
+    for engine in lexer.ENGINES:
+      self.assertTokens((('FOREIGN_CODE', sample),), lexer.tokenize(sample, engine))
+
+  def test_split_foreign_code(self):
+    sample = 'x BEGIN_FOREIGN_CODE_PYTHON\n  y = 1\nEND_FOREIGN_CODE_PYTHON'
+    language, code_start, code_end = lexer.split_foreign_code(sample, 2)
+    self.assertEqual('PYTHON', language)
+    self.assertEqual('\n  y = 1\n', sample[code_start:code_end])
+    language, code_start, code_end = lexer.split_foreign_code('BEGIN_FOREIGN_CODE_C int x;')
+    self.assertEqual('C', language)
+    self.assertEqual((20, 27), (code_start, code_end))
+
+  def test_bytes_and_streaming_match(self):
+    sample = FOREIGN_CODE_SAMPLE * 3
+    expected = [(token.token_type, token.content) for token in lexer.tokenize(sample)]
+    buffer = lexer.tokenize_bytes(sample.encode('utf-8'))
+    self.assertEqual(expected, [(token.token_type, token.content) for token in buffer])
+    streamed = lexer.iter_tokens(io.StringIO(sample), 4)
+    self.assertEqual(expected, [(token.token_type, token.content) for token in streamed])
+
+  def assertTokens(self, sequence, tokens):
+    self.assertEqual(list(sequence), [(token.token_type, token.content) for token in tokens])
+
+
+class TestPositions(unittest.TestCase):
+  """Tokens record their start offsets, which map to lines and columns."""
+
+  def test_token_starts(self):
+    for sample in ENGINE_SAMPLES:
+      for engine in lexer.ENGINES:
+        offset = 0
+        for token in lexer.tokenize(sample, engine):
+          self.assertEqual(offset, token.start)
+          offset += len(token.content)
+
+  def test_streamed_token_starts(self):
+    sample = ENGINE_SAMPLES[-1] * 3
+    expected = [token.start for token in lexer.tokenize(sample)]
+    actual = [token.start for token in lexer.iter_tokens(io.StringIO(sample), 5)]
+    self.assertEqual(expected, actual)
+
+  def test_line_index(self):
+    line_index = lexer.LineIndex('ab\ncd\n\nef')
+    self.assertEqual([0, 3, 6, 7], list(line_index.line_starts))
+    self.assertEqual((1, 1), line_index.position(0))
+    self.assertEqual((1, 3), line_index.position(2))
+    self.assertEqual((2, 1), line_index.position(3))
+    self.assertEqual((3, 1), line_index.position(6))
+    self.assertEqual((4, 2), line_index.position(8))
+
+
+class TestTokenBuffer(unittest.TestCase):
+  """Stores tokens as columns of kinds and source offsets."""
+
+  def test_columns(self):
+    buffer = lexer.tokenize_buffer('ab = "x"')
+    self.assertEqual(5, len(buffer))
+    self.assertEqual([
+          lexer.TokenKind.IDENTIFIER,
+          lexer.TokenKind.SPACE,
+          lexer.TokenKind.SYMBOL,
+          lexer.TokenKind.SPACE,
+          lexer.TokenKind.STRING,
+        ], list(buffer.kinds))
+    self.assertEqual([0, 2, 3, 4, 5], list(buffer.starts))
+    self.assertEqual([2, 3, 4, 5, 8], list(buffer.ends))
+    self.assertEqual('"x"', buffer.content(4))
+    self.assertEqual('STRING', buffer.token_type(4))
+
+  def test_matches_token_list(self):
+    for sample in ENGINE_SAMPLES:
+      expected = [(token.token_type, token.content) for token in lexer.tokenize(sample)]
+      for engine in lexer.ENGINES:
+        buffer = lexer.tokenize_buffer(sample, engine)
+        self.assertEqual(expected, [(token.token_type, token.content) for token in buffer])
+
+
+class TestIncrementalLexer(unittest.TestCase):
+  """Updates tokens after edits without lexing the whole source again."""
+
+  def assertSameAsFullLex(self, incremental):
+    expected = lexer.tokenize_buffer(incremental.source_code)
+    actual = incremental.to_buffer()
+    self.assertEqual(list(expected.kinds), list(actual.kinds))
+    self.assertEqual(list(expected.starts), list(actual.starts))
+    self.assertEqual(list(expected.ends), list(actual.ends))
+
+  def test_edit_inside_identifier(self):
+    incremental = lexer.IncrementalLexer('abc def ghi')
+    self.assertEqual((2, 1, 1), incremental.edit(5, 1, 'XYZ'))
+    self.assertEqual('abc dXYZf ghi', incremental.source_code)
+    self.assertEqual('dXYZf', incremental.content(2))
+    self.assertEqual('ghi', incremental.content(4))
+    self.assertSameAsFullLex(incremental)
+
+  def test_opening_and_closing_a_string(self):
+    incremental = lexer.IncrementalLexer('a = b c d')
+    incremental.edit(4, 0, '"')
+    self.assertEqual('"b c d', incremental.content(4))
+    incremental.edit(8, 0, '"')
+    self.assertEqual('"b c"', incremental.content(4))
+    self.assertSameAsFullLex(incremental)
+
+  def test_opening_and_closing_a_comment(self):
+    incremental = lexer.IncrementalLexer('x y z')
+    incremental.edit(1, 0, '/*')
+    self.assertEqual(lexer.TokenKind.COMMENT, incremental.kind(1))
+    self.assertSameAsFullLex(incremental)
+    incremental.edit(6, 0, '*/')
+    self.assertEqual('/* y */', incremental.content(1))
+    self.assertSameAsFullLex(incremental)
+
+  def test_editing_foreign_code(self):
+    source_code = FOREIGN_CODE_SAMPLE
+    incremental = lexer.IncrementalLexer(source_code)
+    offset = source_code.index('int x')
+    incremental.edit(offset, 3, 'long')
+    self.assertSameAsFullLex(incremental)
+    incremental.edit(incremental.source_code.index('END_FOREIGN'), 0, '"')
+    self.assertSameAsFullLex(incremental)
+
+  def test_adding_and_removing_an_end_marker(self):
+    incremental = lexer.IncrementalLexer(FOREIGN_CODE_SAMPLE)
+    offset = incremental.source_code.index('END_FOREIGN')
+    incremental.edit(offset, 1, '')
+    self.assertSameAsFullLex(incremental)
+    incremental.edit(offset, 0, 'E')
+    self.assertSameAsFullLex(incremental)
+    self.assertEqual(lexer.TokenKind.FOREIGN_CODE, incremental.kind(8))
+
+  def test_random_edits(self):
+    rng = random.Random(99)
+    for _ in range(200):
+      incremental = lexer.IncrementalLexer(random_source(rng, rng.randint(0, 40)))
+      for _ in range(5):
+        source_len = len(incremental.source_code)
+        offset = rng.randint(0, source_len)
+        deleted_length = rng.randint(0, min(3, source_len - offset))
+        incremental.edit(offset, deleted_length, random_source(rng, rng.randint(0, 3)))
+        self.assertSameAsFullLex(incremental)
+
+  @unittest.skipIf('numpy' not in lexer.ENGINES, 'NumPy is not installed')
+  def test_numpy_engine(self):
+    incremental = lexer.IncrementalLexer('abc def ghi', 'numpy')
+    incremental.edit(8, 0, 'x')
+    self.assertEqual(['abc', ' ', 'def', ' ', 'xghi'],
+                     [incremental.content(index) for index in range(len(incremental))])
+    self.assertSameAsFullLex(incremental)
+    rng = random.Random(98)
+    for _ in range(50):
+      incremental = lexer.IncrementalLexer(random_source(rng, rng.randint(0, 40)), 'numpy')
+      for _ in range(5):
+        source_len = len(incremental.source_code)
+        offset = rng.randint(0, source_len)
+        deleted_length = rng.randint(0, min(3, source_len - offset))
+        incremental.edit(offset, deleted_length, random_source(rng, rng.randint(0, 3)))
+        self.assertSameAsFullLex(incremental)
+
+
+class TestBytesTokenizer(unittest.TestCase):
+  """Lexes UTF-8 bytes and memory mapped files."""
+
+  def assertSameTokens(self, source_code, buffer):
+    expected = [(token.token_type, token.content) for token in lexer.tokenize(source_code)]
+    actual = [(buffer.token_type(index), buffer.content(index)) for index in range(len(buffer))]
+    self.assertEqual(expected, actual, repr(source_code))
+
+  def test_samples(self):
+    for sample in ENGINE_SAMPLES + ('\U0001f600x a\u00b2b \x1c\x85',):
+      self.assertSameTokens(sample, lexer.tokenize_bytes(sample.encode('utf-8')))
+      self.assertSameTokens(sample, lexer.tokenize_bytes(memoryview(sample.encode('utf-8'))))
+
+  def test_random_sources(self):
+    rng = random.Random(2468)
+    for _ in range(300):
+      sample = random_source(rng, rng.randint(1, 60))
+      self.assertSameTokens(sample, lexer.tokenize_bytes(sample.encode('utf-8')))
+
+  def test_byte_offsets_and_raw_views(self):
+    buffer = lexer.tokenize_bytes('caf\u00e9 = 1'.encode('utf-8'))
+    self.assertEqual([0, 5, 6, 7, 8], list(buffer.starts))
+    raw = buffer.raw(0)
+    self.assertIsInstance(raw, memoryview)
+    self.assertEqual(b'caf\xc3\xa9', raw.tobytes())
+    self.assertEqual('caf\u00e9', buffer.content(0))
+
+  def test_invalid_utf8_is_passed_through(self):
+    buffer = lexer.tokenize_bytes(b'ab\xffcd')
+    self.assertEqual([lexer.TokenKind.IDENTIFIER, lexer.TokenKind.SYMBOL, lexer.TokenKind.IDENTIFIER],
+                     list(buffer.kinds))
+    self.assertEqual(b'\xff', buffer.raw(1).tobytes())
+
+  def test_tokenize_file(self):
+    sample = ENGINE_SAMPLES[-1] + FOREIGN_CODE_SAMPLE
+    with tempfile.NamedTemporaryFile('wb', delete=False) as source_file:
+      source_file.write(sample.encode('utf-8'))
+    try:
+      self.assertSameTokens(sample, lexer.tokenize_file(source_file.name))
+    finally:
+      os.remove(source_file.name)
+
+  def test_tokenize_empty_file(self):
+    with tempfile.NamedTemporaryFile('wb', delete=False) as source_file:
+      pass
+    try:
+      self.assertEqual(0, len(lexer.tokenize_file(source_file.name)))
+    finally:
+      os.remove(source_file.name)
+
+
+class TestTriviaTable(unittest.TestCase):
+  """Sets spaces and comments aside from the significant tokens."""
+
+  def assertSameLayout(self, source_code, tokens, trivia):
+    expected = [(token.token_type, token.content) for token in lexer.tokenize(source_code)]
+    merged = trivia.merge(tokens)
+    if isinstance(merged, lexer.TokenBuffer):
+      merged = [merged[index] for index in range(len(merged))]
+    self.assertEqual(expected, [(token.token_type, token.content) for token in merged])
+
+  def test_significant_tokens(self):
+    source_code = 'x /* a */ = // b\n 1'
+    trivia = lexer.TriviaTable(source_code)
+    buffer = lexer.tokenize_buffer(source_code, trivia=trivia)
+    self.assertEqual(['x', '=', '1'], [buffer.content(index) for index in range(len(buffer))])
+    self.assertEqual([' ', '/* a */', ' '], [token.content for token in trivia.before(1)])
+    self.assertEqual([], trivia.before(0))
+    self.assertEqual(6, len(trivia))
+
+  def test_trailing_trivia(self):
+    source_code = 'x // end'
+    trivia = lexer.TriviaTable(source_code)
+    tokens = lexer.tokenize(source_code, trivia=trivia)
+    self.assertEqual(['x'], [token.content for token in tokens])
+    self.assertEqual([' ', '// end'], [token.content for token in trivia.before(1)])
+
+  def test_merge_restores_layout(self):
+    for sample in ENGINE_SAMPLES + (FOREIGN_CODE_SAMPLE,):
+      trivia = lexer.TriviaTable(sample)
+      self.assertSameLayout(sample, lexer.tokenize(sample, trivia=trivia), trivia)
+      for engine in lexer.ENGINES:
+        trivia = lexer.TriviaTable(sample)
+        self.assertSameLayout(sample, lexer.tokenize_buffer(sample, engine, trivia), trivia)
+
+  def test_bytes(self):
+    sample = ENGINE_SAMPLES[4]
+    encoded = sample.encode('utf-8')
+    trivia = lexer.TriviaTable(encoded)
+    buffer = lexer.tokenize_bytes(encoded, trivia)
+    self.assertIsInstance(trivia.tokens, lexer.BytesTokenBuffer)
+    self.assertSameLayout(sample, buffer, trivia)
+
+
+class TestSymbolTable(unittest.TestCase):
+  """Interns token contents across the files of a compilation."""
+
+  def test_ids_are_stable(self):
+    symbols = lexer.SymbolTable()
+    self.assertEqual(0, symbols.intern('os'))
+    self.assertEqual(1, symbols.intern('print'))
+    self.assertEqual(0, symbols.intern(''.join(['o', 's'])))
+    self.assertEqual(2, len(symbols))
+    self.assertIn('print', symbols)
+    self.assertIs('os', symbols.canonical(''.join(['o', 's'])))
+
+  def test_shared_across_files(self):
+    symbols = lexer.SymbolTable()
+    first = lexer.tokenize_buffer('os.print["x"]', symbols=symbols)
+    second = lexer.tokenize_buffer('x = os.print', symbols=symbols)
+    self.assertIs(first.content(0), second.content(4))
+    self.assertEqual(first.symbol(2), second.symbol(6))
+    self.assertIs(first.content(4), symbols.strings[first.symbol(4)])
+    self.assertEqual(['x', '=', ' '], [second.content(index) for index in (0, 2, 3)])
+    self.assertEqual(lexer.NO_SYMBOL, second.symbol(1))
+
+  def test_token_list_and_bytes(self):
+    symbols = lexer.SymbolTable()
+    tokens = lexer.tokenize('main: function', symbols=symbols)
+    buffer = lexer.tokenize_bytes('function main'.encode('utf-8'), symbols=symbols)
+    self.assertIs(tokens[0].content, buffer.content(2))
+    self.assertIs(tokens[3].content, buffer.content(0))
+    self.assertIs('main', tokens[0].content)
+
+  def test_contents_are_unchanged(self):
+    for sample in ENGINE_SAMPLES + (FOREIGN_CODE_SAMPLE,):
+      buffer = lexer.tokenize_buffer(sample, symbols=lexer.SymbolTable())
+      expected = [token.content for token in lexer.tokenize(sample)]
+      self.assertEqual(expected, [buffer.content(index) for index in range(len(buffer))])
+
 
 if __name__ == '__main__':
   unittest.main()
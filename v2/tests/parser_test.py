@@ -1,4 +1,9 @@
+import contextlib
+import io
+import pickle
+import sys
 import unittest
+import lexer
 import parser
 
 
@@ -43,6 +48,12 @@ class TestParserParse(unittest.TestCase):
     self.assertEqual('VARIABLE_TYPE', tree.members[0].members[2].node_type)
     self.assertEqual('int32', tree.members[0].members[2].members[0])
     
+  def test_parses_tokens_without_offsets(self):
+    tokens = [lexer.Token('x', 'IDENTIFIER'), lexer.Token(':', 'SYMBOL'),
+              lexer.Token(' ', 'SPACE'), lexer.Token('int', 'IDENTIFIER')]
+    tree = parser.parse_tokens(tokens)
+    self.assertEqual(tree_spans(parser.parse_source('x: int')), tree_spans(tree))
+
   def test_parse_hello_world_example(self):
     tree = parser.parse_source(HELLO_WORLD_EXAMPLE)
     #tree.print()
@@ -65,6 +76,26 @@ class TestParserParse(unittest.TestCase):
     self.assertEqual('FOREIGN_CODE_BLOCK', tree.members[0].members[2].members[3].members[1].node_type)
     self.assertEqual('CODE_BLOCK_END', tree.members[0].members[2].members[3].members[2].node_type)
 
+  def test_foreign_code_is_kept_as_written(self):
+    tree = parser.parse_source(FOREIGN_CODE_EXAMPLE)
+    foreign_code_block = tree.members[0].members[2].members[3].members[1]
+    source_code_block = foreign_code_block.members[0]
+    self.assertEqual('C', source_code_block.node_type)
+    code = '\n  int x = 10;\n  printf("Hello World\\n");\n  printf("%i\\n", x);\n  '
+    self.assertEqual([code], source_code_block.members)
+    self.assertEqual(code, FOREIGN_CODE_EXAMPLE[source_code_block.start:source_code_block.end])
+    self.assertTrue(FOREIGN_CODE_EXAMPLE[foreign_code_block.start:].startswith('BEGIN_FOREIGN_CODE_C'))
+    self.assertTrue(FOREIGN_CODE_EXAMPLE[:foreign_code_block.end].endswith('END_FOREIGN_CODE_C'))
+
+  def test_foreign_code_with_unbalanced_quotes(self):
+    source_code = 'main: function[][\nBEGIN_FOREIGN_CODE_C\n  char c = \'"\';\nEND_FOREIGN_CODE_C\n]'
+    for tokens in (lexer.tokenize(source_code), lexer.tokenize_buffer(source_code),
+                   lexer.tokenize_bytes(source_code.encode('utf-8'))):
+      tree = parser.parse_tokens(tokens)
+      code_block = tree.members[0].members[2].members[3]
+      self.assertEqual(['\n  char c = \'"\';\n'], code_block.members[1].members[0].members)
+      self.assertEqual('CODE_BLOCK_END', code_block.members[2].node_type)
+
   def test_assignment_statement(self):
     tree = parser.parse_source('example = "string literal"')
     #tree.print()
@@ -74,6 +105,659 @@ class TestParserParse(unittest.TestCase):
     self.assertEqual('ASSIGNMENT_SYMBOL', tree.members[0].members[1].node_type)
     self.assertEqual('STRING_LITERAL', tree.members[0].members[2].node_type)
 
+  def test_comments_are_skipped(self):
+    source_code = '// Entry point.\nmain: /* no arguments */ function[][\n  os.print["x"] // print\n]\n'
+    tree = parser.parse_source(source_code)
+    without_comments = parser.parse_source('main: function[][\n  os.print["x"]\n]\n')
+    self.assertEqual(tree_structure(without_comments), tree_structure(tree))
+    self.assertEqual((0, len(source_code)), (tree.start, tree.end))
+
+  def test_skips_runs_of_trivia(self):
+    source_code = 'x /* a */ /* b */\n// c\n  :  /**/ int32 // d'
+    for tokens in (lexer.tokenize(source_code), lexer.tokenize_buffer(source_code)):
+      tree = parser.parse_tokens(tokens)
+      self.assertEqual(tree_structure(parser.parse_source('x: int32')), tree_structure(tree))
+      jumps = parser.Parser(tokens).find_significant_tokens()
+      self.assertEqual([0, 8, 8, 8, 8, 8, 8, 8, 8, 12, 12, 12, 12, 15, 15, 15], list(jumps))
+
+  def test_parses_with_and_without_trivia(self):
+    for source_code in (HELLO_WORLD_EXAMPLE, FOREIGN_CODE_EXAMPLE):
+      trivia = lexer.TriviaTable(source_code)
+      tokens = lexer.tokenize_buffer(source_code, trivia=trivia)
+      self.assertEqual(tree_structure(parser.parse_tokens(lexer.tokenize_buffer(source_code))),
+                       tree_structure(parser.parse_tokens(tokens, trivia)))
+
+  def test_shared_symbol_table(self):
+    symbols = lexer.SymbolTable()
+    first = parser.parse_source(HELLO_WORLD_EXAMPLE, symbols)
+    second = parser.parse_source(HELLO_WORLD_EXAMPLE.replace('Hello', 'Goodbye'), symbols)
+    self.assertEqual(tree_structure(parser.parse_source(HELLO_WORLD_EXAMPLE)), tree_structure(first))
+    first_name = first.members[0].members[0].members[0]
+    second_name = second.members[0].members[0].members[0]
+    self.assertIs(first_name, second_name)
+
+  def test_parses_token_buffer_and_token_list(self):
+    for source_code in (HELLO_WORLD_EXAMPLE, FOREIGN_CODE_EXAMPLE, 'x: int32'):
+      from_list = parser.parse_tokens(lexer.tokenize(source_code))
+      from_buffer = parser.parse_tokens(lexer.tokenize_buffer(source_code))
+      self.assertEqual(tree_structure(from_list), tree_structure(from_buffer))
+
+  def test_parses_bytes_token_buffer(self):
+    source_code = HELLO_WORLD_EXAMPLE.replace('Hello World', 'Hell\u00f6 W\u00f6rld')
+    from_text = parser.parse_source(source_code)
+    from_bytes = parser.parse_tokens(lexer.tokenize_bytes(source_code.encode('utf-8')))
+    self.assertEqual(tree_structure(from_text), tree_structure(from_bytes))
+
+  def test_node_spans(self):
+    source_code = 'x: int32\nexample = "text"\n'
+    tree = parser.parse_source(source_code)
+    declaration, assignment = tree.members
+    self.assertEqual('x: int32', source_code[declaration.start:declaration.end])
+    self.assertEqual('int32', source_code[declaration.members[2].start:declaration.members[2].end])
+    self.assertEqual('example = "text"', source_code[assignment.start:assignment.end])
+
+  def test_nested_node_spans(self):
+    tree = parser.parse_source(HELLO_WORLD_EXAMPLE)
+    code_block = tree.members[0].members[2].members[3]
+    function_call = code_block.members[1]
+    self.assertEqual('[\n      os.print["Hello World\\n"]\n    ]',
+                     HELLO_WORLD_EXAMPLE[code_block.start:code_block.end])
+    self.assertEqual('os.print["Hello World\\n"]',
+                     HELLO_WORLD_EXAMPLE[function_call.start:function_call.end])
+    identifier_chain = function_call.members[0]
+    self.assertEqual('os.print', HELLO_WORLD_EXAMPLE[identifier_chain.start:identifier_chain.end])
+
+  def test_error_reports_line_and_column(self):
+    with self.assertRaises(parser.ParseError) as context:
+      parser.parse_source('x: int32\ny = 1\nmain: function x')
+    error = context.exception
+    self.assertEqual(
+        'line 3, column 16: Expected a [ after the function keyword in function definition',
+        str(error))
+    self.assertEqual((3, 16, 30), (error.line, error.column, error.offset))
+
+  def test_error_position_with_trivia_set_aside(self):
+    source_code = 'x: int\n\n\ny = 1\n  z ]'
+    trivia = lexer.TriviaTable(source_code)
+    with self.assertRaises(parser.ParseError) as context:
+      parser.parse_tokens(lexer.tokenize(source_code, trivia=trivia), trivia)
+    self.assertEqual((5, 3), (context.exception.line, context.exception.column))
+
+
+class TestErrorRecovery(unittest.TestCase):
+  """Collects diagnostics and keeps parsing after syntax errors."""
+
+  def test_recovers_at_declarations(self):
+    source_code = 'x: int32\nmain: function x\ny = 1\n] "stray"\nz: int32\n'
+    diagnostics = []
+    tree = parser.parse_source(source_code, diagnostics=diagnostics)
+    self.assertEqual(['x', 'y', 'z'], [item.members[0].members[0] for item in tree.members])
+    self.assertEqual([(2, 16, 'Expected a [ after the function keyword in function definition'),
+                      (4, 1, 'Expected a declaration or assignment')],
+                     [(error.line, error.column, error.message) for error in diagnostics])
+
+  def test_recovers_at_statements(self):
+    source_code = ('main: function[][\n'
+                   '  os.print["a" "b"]\n'
+                   '  os.["c"]\n'
+                   '  os.print["d"]\n'
+                   ']\n'
+                   'after: int32\n')
+    diagnostics = []
+    tree = parser.parse_source(source_code, diagnostics=diagnostics)
+    self.assertEqual([2, 3], [error.line for error in diagnostics])
+    main, after = tree.items
+    self.assertEqual(['"d"'], [call.args[0].value for call in main.body.statements])
+    self.assertEqual('after', after.name.value)
+
+  def test_identifier_without_declaration(self):
+    # Used to loop forever.
+    with self.assertRaises(parser.ParseError):
+      parser.parse_source('x y')
+    diagnostics = []
+    tree = parser.parse_source('x y\nz = 1', diagnostics=diagnostics)
+    self.assertEqual(['z'], [item.target.value for item in tree.items])
+    self.assertEqual(1, len(diagnostics))
+
+  def test_many_files_in_one_process(self):
+    sources = ['x: int32', 'main: function[', 'y = "text"', ']', 'os.print["a"]'] * 20
+    for source_code in sources:
+      diagnostics = []
+      tree = parser.parse_source(source_code, diagnostics=diagnostics)
+      self.assertEqual('MODULE', tree.node_type)
+
+  def test_error_pickles(self):
+    error = parser.ParseError('Expected it', 2, 3, 10)
+    copy = pickle.loads(pickle.dumps(error))
+    self.assertEqual((str(error), 2, 3, 10), (str(copy), copy.line, copy.column, copy.offset))
+
+
+class TestNodeClasses(unittest.TestCase):
+  """Typed nodes name their fields and keep the generic members view."""
+
+  def test_typed_fields(self):
+    tree = parser.parse_source('moduleName = "hello"\nx: int32\n' + HELLO_WORLD_EXAMPLE)
+    assignment, declaration, function = tree.items
+    self.assertIsInstance(assignment, parser.Assignment)
+    self.assertEqual('moduleName', assignment.target.value)
+    self.assertIsInstance(assignment.value, parser.StringLiteral)
+    self.assertEqual('"hello"', assignment.value.value)
+    self.assertIsInstance(declaration, parser.Declaration)
+    self.assertEqual('int32', declaration.variable_type.value)
+    self.assertIsInstance(function, parser.FunctionDeclaration)
+    self.assertEqual('main', function.name.value)
+    function_call, = function.body.statements
+    self.assertIsInstance(function_call, parser.FunctionCall)
+    self.assertEqual('os.print', function_call.callee.text())
+    self.assertEqual(['"Hello World\\n"'], [argument.value for argument in function_call.args])
+
+  def test_nodes_have_slots(self):
+    tree = parser.parse_source(HELLO_WORLD_EXAMPLE + FOREIGN_CODE_EXAMPLE + 'y = 1\n')
+    for node in tree.walk():
+      self.assertFalse(hasattr(node, '__dict__'), node.node_type)
+      self.assertIsInstance(node, parser.SyntaxNode)
+
+  def test_spaces_around_member_dot(self):
+    tree = parser.parse_source('main: function[][ os . print [ "x" ] ]')
+    function_call, = tree.items[0].body.statements
+    self.assertEqual(['os', 'print'], [name.value for name in function_call.callee.names])
+    self.assertEqual(['IDENTIFIER', 'MEMBER_DOT_ACCESS', 'IDENTIFIER'],
+                     [member.node_type for member in function_call.callee.members])
+
+  def test_shift(self):
+    source_code = 'x: int32\n' + FOREIGN_CODE_EXAMPLE
+    moved = parser.parse_source(source_code)
+    moved.shift(5)
+    expected = [(node.node_type, node.start + 5, node.end + 5)
+                for node in parser.parse_source(source_code).walk()]
+    self.assertEqual(expected, [(node.node_type, node.start, node.end) for node in moved.walk()])
+    self.assertEqual(tree_spans(parser.parse_source('     ' + source_code).items[0]),
+                     tree_spans(moved.items[0]))
+
+  def test_deeper_than_recursion_limit(self):
+    depth = sys.getrecursionlimit() * 2
+    tree = nested_calls(depth)
+    tree.shift(5)
+    innermost = list(tree.walk())[-1]
+    self.assertEqual((5, 8), (innermost.start, innermost.end))
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      tree.print()
+    innermost_line, = [line for line in output.getvalue().splitlines() if line.strip() == '"x"']
+    self.assertGreater(len(innermost_line) - len(innermost_line.lstrip()), depth)
+
+
+class TestSharingBuilder(unittest.TestCase):
+  """Creates one node for equal statements and their parts."""
+
+  SOURCE = (HELLO_WORLD_EXAMPLE + 'f: function[][\n  os.print["Hello World\\n"]\n  os.print[x.y]\n' +
+            '  os.print[x.y]\n]\ng: function[][ os.print[x.y] ]\n')
+
+  def test_shares_equal_statements(self):
+    builder = parser.SharingBuilder()
+    tree = parser.parse_source(self.SOURCE, builder=builder)
+    main, f, g = tree.items
+    self.assertIs(main.body.statements[0], f.body.statements[0])
+    self.assertIs(f.body.statements[1], f.body.statements[2])
+    self.assertIs(f.body.statements[1], g.body.statements[0])
+    self.assertIsNot(f.body, g.body)
+    self.assertIsNone(g.body.statements[0].start)
+    self.assertEqual((g.start, g.end), (g.body.start - len('g: function[]'), len(self.SOURCE) - 1))
+    self.assertEqual(tree_structure(parser.parse_source(self.SOURCE)), tree_structure(tree))
+
+  def test_dedup_ratio(self):
+    builder = parser.SharingBuilder()
+    self.assertEqual(1.0, builder.dedup_ratio())
+    parser.parse_source('a = "x"\nb = "x"\n', builder=builder)
+    # Two targets, and one literal for two.
+    self.assertEqual(4, builder.created)
+    self.assertEqual(3, len(builder))
+    self.assertEqual(4 / 3, builder.dedup_ratio())
+
+  def test_shared_across_modules(self):
+    builder = parser.SharingBuilder()
+    first = parser.parse_source(HELLO_WORLD_EXAMPLE, builder=builder)
+    second = parser.parse_source(HELLO_WORLD_EXAMPLE, builder=builder)
+    self.assertIs(first.items[0].body.statements[0], second.items[0].body.statements[0])
+
+  def test_pickle_keeps_sharing(self):
+    tree = pickle.loads(pickle.dumps(parser.parse_source(self.SOURCE,
+                                                         builder=parser.SharingBuilder())))
+    self.assertIs(tree.items[1].body.statements[1], tree.items[2].body.statements[0])
+
+  def test_reparse(self):
+    source_code = self.SOURCE
+    tree = parser.parse_source(source_code, builder=parser.SharingBuilder())
+    statement = tree.items[2].body.statements[0]
+    tree = parser.reparse(tree, '\n' + source_code, 0, 0, 1)
+    self.assertIs(statement, tree.items[2].body.statements[0])
+    self.assertIsNone(statement.start)
+    self.assertEqual(tree_structure(parser.parse_source(source_code)), tree_structure(tree))
+
+
+class TestArena(unittest.TestCase):
+  """Parses straight into array columns."""
+
+  def test_matches_node_tree(self):
+    for source_code in ('x: int32\nexample = "text"\ny = 1\nz =\n', HELLO_WORLD_EXAMPLE,
+                        FOREIGN_CODE_EXAMPLE, '   \n   '):
+      tree = parser.parse_source(source_code)
+      arena_tree = parser.parse_source_arena(source_code)
+      self.assertIsInstance(arena_tree, parser.ArenaNode)
+      self.assertEqual(arena_spans(tree), arena_spans(arena_tree))
+
+  def test_columns(self):
+    source_code = 'x: int32\n'
+    module = parser.parse_source_arena(source_code)
+    arena = module.arena
+    self.assertEqual(4, len(arena))
+    self.assertEqual(3, arena.root)
+    self.assertEqual(['IDENTIFIER', 'VARIABLE_TYPE', 'DECLARATION', 'MODULE'],
+                     [parser.NODE_TYPES[kind] for kind in arena.kinds])
+    self.assertEqual([-1, -1, 0, 2], list(arena.first_child))
+    self.assertEqual([1, -1, -1, -1], list(arena.next_sibling))
+    self.assertEqual([0, 3, 0, 0], list(arena.starts))
+    self.assertEqual([1, 8, 8, 9], list(arena.ends))
+
+  def test_fields(self):
+    module = parser.parse_source_arena('moduleName = "hello"\n' + FOREIGN_CODE_EXAMPLE)
+    assignment, function = module.items
+    self.assertEqual('moduleName', assignment.target.value)
+    self.assertEqual('"hello"', assignment.value.value)
+    self.assertEqual('main', function.name.value)
+    foreign_code_block, = function.body.statements
+    self.assertEqual('C', foreign_code_block.language)
+    self.assertIn('int x = 10;', foreign_code_block.code)
+    self.assertIsNone(parser.parse_source_arena('x =').items[0].value)
+
+  def test_empty_program(self):
+    self.assertIsNone(parser.parse_source_arena(''))
+
+
+class TestReparse(unittest.TestCase):
+  """Parses again after an edit, reusing the items it does not touch."""
+
+  SOURCE = 'moduleName = "m"\nx: int32\n' + HELLO_WORLD_EXAMPLE + 'y = 1\n' + FOREIGN_CODE_EXAMPLE
+
+  def assert_reparses(self, source_code, start, end, replacement):
+    tree = parser.parse_source(source_code)
+    new_source_code = source_code[:start] + replacement + source_code[end:]
+    expected = parser.parse_source(new_source_code)
+    tree = parser.reparse(tree, new_source_code, start, end, start + len(replacement))
+    self.assertEqual(tree_spans(expected), tree_spans(tree))
+    return tree
+
+  def test_edit_in_function_body(self):
+    start = self.SOURCE.index('Hello World')
+    tree = parser.parse_source(self.SOURCE)
+    module_name, x, main, y, foreign_main = tree.items
+    new_source_code = self.SOURCE[:start] + 'Goodbye' + self.SOURCE[start + 5:]
+    tree = parser.reparse(tree, new_source_code, start, start + 5, start + 7)
+    self.assertEqual(tree_spans(parser.parse_source(new_source_code)), tree_spans(tree))
+    # Only the function around the edit was parsed again.
+    self.assertIs(module_name, tree.items[0])
+    self.assertIs(x, tree.items[1])
+    self.assertIsNot(main, tree.items[2])
+    self.assertIs(y, tree.items[3])
+    self.assertIs(foreign_main, tree.items[4])
+
+  def test_insert_and_delete_items(self):
+    start = self.SOURCE.index('y = 1')
+    self.assert_reparses(self.SOURCE, start, start, 'z: int32\n')
+    self.assert_reparses(self.SOURCE, start, start + len('y = 1\n'), '')
+    self.assert_reparses(self.SOURCE, 0, 0, '// Comment.\n')
+    self.assert_reparses(self.SOURCE, len(self.SOURCE), len(self.SOURCE), 'z = "end"')
+
+  def test_edit_next_to_item(self):
+    start = self.SOURCE.index(': int32')
+    self.assert_reparses(self.SOURCE, start, start, 'yz')
+    end = self.SOURCE.index('y = 1') + len('y = 1')
+    self.assert_reparses(self.SOURCE, end, end, '234')
+
+  def test_edit_that_changes_the_rest(self):
+    # Opening a comment or a string swallows the items after the edit.
+    start = self.SOURCE.index('x: int32')
+    tree = self.assert_reparses(self.SOURCE, start, start, '/* ')
+    self.assertEqual(['moduleName'], [item.target.value for item in tree.items])
+    start = self.SOURCE.index('y = 1') + len('y = 1')
+    self.assert_reparses(self.SOURCE, start, start, ' // ')
+
+  def test_edit_that_does_not_parse(self):
+    source_code = 'x: int32\ny = 1\n'
+    tree = parser.parse_source(source_code)
+    with self.assertRaises(parser.ParseError):
+      parser.reparse(tree, 'x: int32\ny = 1]\n', 14, 14, 15)
+    diagnostics = []
+    tree = parser.reparse(parser.parse_source(source_code), 'x: int32\ny = 1]\n', 14, 14, 15,
+                          diagnostics=diagnostics)
+    self.assertEqual(1, len(diagnostics))
+    self.assertEqual(['x', 'y'], [item.members[0].members[0] for item in tree.items])
+
+  def test_errors_away_from_the_edit(self):
+    source_code = 'a: int32\n] junk\nb: int32\nc: int32\n'
+    for start, end, replacement in ((27, 28, 'dd'), (0, 1, 'aa')):
+      new_source_code = source_code[:start] + replacement + source_code[end:]
+      expected = []
+      parser.parse_source(new_source_code, diagnostics=expected)
+      diagnostics = []
+      tree = parser.reparse(parser.parse_source(source_code, diagnostics=[]), new_source_code,
+                            start, end, start + len(replacement), diagnostics=diagnostics)
+      self.assertEqual([(error.message, error.line, error.column, error.offset)
+                        for error in expected],
+                       [(error.message, error.line, error.column, error.offset)
+                        for error in diagnostics])
+      self.assertEqual(diagnostics, tree.errors)
+      # Without diagnostics the error is raised, as parse_source raises it.
+      with self.assertRaises(parser.ParseError):
+        parser.reparse(parser.parse_source(source_code, diagnostics=[]), new_source_code,
+                       start, end, start + len(replacement))
+
+  def test_fixing_an_error(self):
+    source_code = 'a: int32\nb = ]\nc: int32\n'
+    new_source_code = source_code.replace(']', '1')
+    start = source_code.index(']')
+    tree = parser.reparse(parser.parse_source(source_code, diagnostics=[]), new_source_code,
+                          start, start + 1, start + 1)
+    self.assertEqual([], tree.errors)
+    self.assertEqual(tree_spans(parser.parse_source(new_source_code)), tree_spans(tree))
+
+
+class TestParallelParse(unittest.TestCase):
+  """Parses chunks of a module on worker processes."""
+
+  def test_split_points(self):
+    source_code = ('a: int32\n'
+                   'b = "\nc: int32"\n'
+                   '/* d: int32 */ e: function[][\n'
+                   'f: int32\n'
+                   ']\n'
+                   'g = 1\n')
+    # A split point wanted after every character.
+    split_points = parser.find_split_points(source_code, len(source_code))
+    self.assertEqual([source_code.index('b ='), source_code.index('g =')], split_points)
+
+  def test_matches_serial_parse(self):
+    source_code = (HELLO_WORLD_EXAMPLE + FOREIGN_CODE_EXAMPLE + 'x: int32\ny = "text"\n') * 20
+    serial = parser.parse_source(source_code)
+    parallel = parser.parse_source_parallel(source_code, workers=3, min_chunk_size=64)
+    self.assertEqual(tree_spans(serial), tree_spans(parallel))
+
+  def test_chunk_that_does_not_parse_alone(self):
+    # Parsed on its own, the first chunk would end with an assignment
+    # missing its value, which takes the c that follows as a whole.
+    source_code = 'a: int32\n' * 20 + 'x =\nc: int32\n' + 'b: int32\n' * 19
+    self.assertEqual([source_code.index('c:')], parser.find_split_points(source_code, 2))
+    with self.assertRaises(parser.ParseError):
+      parser.parse_source_parallel(source_code, workers=2, min_chunk_size=16)
+    serial_diagnostics = []
+    serial = parser.parse_source(source_code, diagnostics=serial_diagnostics)
+    parallel_diagnostics = []
+    parallel = parser.parse_source_parallel(source_code, workers=2, min_chunk_size=16,
+                                            diagnostics=parallel_diagnostics)
+    self.assertEqual(tree_spans(serial), tree_spans(parallel))
+    self.assertEqual([str(error) for error in serial_diagnostics],
+                     [str(error) for error in parallel_diagnostics])
+    self.assertEqual(1, len(serial_diagnostics))
+
+
+class TestModuleSymbols(unittest.TestCase):
+  """The parser collects top-level names on the module as it goes."""
+
+  SOURCE = TestReparse.SOURCE + 'x: string\nmoduleName = "other"\n'
+
+  def assert_symbols(self, module):
+    symbols = module.symbols
+    self.assertEqual(['main'], list(symbols.functions))
+    self.assertEqual(module.items[2], symbols.functions['main'])
+    self.assertEqual(['x'], list(symbols.variables))
+    self.assertEqual(['moduleName', 'y'], list(symbols.assignments))
+    self.assertEqual('"m"', symbols.assignments['moduleName'].value.value)
+    self.assertEqual('function', symbols.kind('main'))
+    self.assertEqual('int32', symbols.kind('x'))
+    self.assertIsNone(symbols.kind('y'))
+
+  def test_typed_tree(self):
+    self.assert_symbols(parser.parse_source(self.SOURCE))
+    self.assert_symbols(parser.parse_source(self.SOURCE, bodies='outline'))
+    self.assert_symbols(pickle.loads(pickle.dumps(parser.parse_source(self.SOURCE))))
+
+  def test_arena(self):
+    module = parser.parse_source_arena(self.SOURCE)
+    self.assert_symbols(module)
+    module.arena.symbols = None
+    self.assert_symbols(module)
+
+  def test_items_with_errors(self):
+    diagnostics = []
+    module = parser.parse_source('a: int32\nb: ]\nc = 1\n', diagnostics=diagnostics)
+    self.assertEqual(['a'], list(module.symbols.variables))
+    self.assertEqual(['c'], list(module.symbols.assignments))
+
+  def test_reparse(self):
+    tree = parser.parse_source(self.SOURCE)
+    start = self.SOURCE.index('y = 1')
+    new_source_code = self.SOURCE[:start] + 'z' + self.SOURCE[start + 1:]
+    tree = parser.reparse(tree, new_source_code, start, start + 1, start + 1)
+    self.assertEqual(['moduleName', 'z'], list(tree.symbols.assignments))
+
+  def test_parallel_parse(self):
+    source_code = self.SOURCE * 20
+    module = parser.parse_source_parallel(source_code, workers=3, min_chunk_size=64)
+    self.assertIs(module.items[2], module.symbols.functions['main'])
+
+
+class TestTreeIndex(unittest.TestCase):
+  """Answers questions about a tree with lookups instead of walks."""
+
+  SOURCE = TestReparse.SOURCE + 'f: function[][ os.print[x] g[] ]\n'
+
+  def test_postings_in_source_order(self):
+    tree = parser.parse_source(self.SOURCE, index=True)
+    for node_type in ('FUNCTION_CALL', 'IDENTIFIER', 'FUNCTION_DECLARATION', 'STRING_LITERAL'):
+      expected = [node for node in tree.walk() if node.node_type == node_type]
+      self.assertTrue(expected)
+      self.assertEqual(expected, tree.index.nodes(node_type))
+    self.assertEqual([], tree.index.nodes('temp'))
+
+  def test_function_calls(self):
+    index = parser.parse_source(self.SOURCE, index=True).index
+    self.assertEqual(['os.print'] * 2, [call.callee.text()
+                                        for call in index.function_calls('os.print')])
+    self.assertEqual(1, len(index.function_calls('g')))
+    self.assertEqual([], index.function_calls('os'))
+
+  def test_parents(self):
+    tree = parser.parse_source(self.SOURCE, index=True)
+    for node in tree.walk():
+      for child in node.children():
+        self.assertIs(node, tree.index.parent(child))
+    self.assertIsNone(tree.index.parent(tree))
+    call = tree.index.function_calls('g')[0]
+    self.assertIs(tree.items[-1], tree.index.enclosing(call, 'FUNCTION_DECLARATION'))
+    self.assertIsNone(tree.index.enclosing(call, 'ASSIGNMENT'))
+
+  def test_token_spans(self):
+    source_code = 'x: int32\n// Comment.\nf: function[][ g[x] ]\n'
+    tokens = lexer.tokenize_buffer(source_code, trivia=lexer.TriviaTable(source_code))
+    for tree in (parser.parse_source(source_code, index=True),
+                 parser.reparse(parser.parse_source(source_code, index=True), source_code, 0, 0, 0)):
+      call = tree.index.nodes('FUNCTION_CALL')[0]
+      first, end = tree.index.token_span(call)
+      self.assertEqual(['g', '[', 'x', ']'], [tokens.content(index) for index in range(first, end)])
+      self.assertEqual((0, 3), tree.index.token_span(tree.items[0]))
+
+  def test_reparse(self):
+    tree = parser.parse_source(self.SOURCE, index=True)
+    start = self.SOURCE.index('g[]')
+    new_source_code = self.SOURCE[:start] + 'h' + self.SOURCE[start + 1:]
+    tree = parser.reparse(tree, new_source_code, start, start + 1, start + 1)
+    self.assertEqual([], tree.index.function_calls('g'))
+    self.assertEqual(1, len(tree.index.function_calls('h')))
+    tree = parser.reparse(tree, new_source_code + '/* ', len(new_source_code),
+                          len(new_source_code), len(new_source_code) + 3)
+    self.assertEqual(1, len(tree.index.function_calls('h')))
+
+  def test_not_built_unless_asked(self):
+    self.assertIsNone(parser.parse_source(self.SOURCE).index)
+    with self.assertRaises(ValueError):
+      parser.parse_source(self.SOURCE, index=True, bodies='lazy')
+    with self.assertRaises(ValueError):
+      parser.parse_source(self.SOURCE, index=True, builder=parser.Arena(self.SOURCE))
+
+
+class TestIterTopLevel(unittest.TestCase):
+  """Yields top-level items from a stream of tokens as they complete."""
+
+  SOURCE = TestReparse.SOURCE + 'z =\nw: int32 ]\nf: function[][ a: b ]\n// End.'
+
+  def stream(self, source_code, diagnostics=None, chunk_size=7):
+    tokens = lexer.iter_tokens(io.StringIO(source_code), chunk_size)
+    return list(parser.iter_top_level(tokens, diagnostics))
+
+  def test_matches_parse_source(self):
+    expected_diagnostics = []
+    expected = parser.parse_source(self.SOURCE, diagnostics=expected_diagnostics)
+    diagnostics = []
+    items = self.stream(self.SOURCE, diagnostics)
+    self.assertEqual([tree_spans(item) for item in expected.items],
+                     [tree_spans(item) for item in items])
+    self.assertEqual([(str(error), error.offset) for error in expected_diagnostics],
+                     [(str(error), error.offset) for error in diagnostics])
+
+  def test_tokens_without_offsets(self):
+    source_code = 'x: int32\n] junk\ny = 1\nz = 2\n'
+    tokens = [lexer.Token(token.content, token.token_type)
+              for token in lexer.tokenize(source_code)]
+    expected_diagnostics = []
+    expected = parser.parse_tokens(tokens, diagnostics=expected_diagnostics)
+    diagnostics = []
+    items = list(parser.iter_top_level(tokens, diagnostics))
+    self.assertEqual([tree_spans(item) for item in expected.items],
+                     [tree_spans(item) for item in items])
+    self.assertEqual(1, len(diagnostics))
+    self.assertEqual([(str(error), error.offset) for error in expected_diagnostics],
+                     [(str(error), error.offset) for error in diagnostics])
+    self.assertEqual([tree_spans(item) for item in
+                      parser.parse_source(source_code, diagnostics=[]).items],
+                     [tree_spans(item) for item in items])
+
+  def test_yields_before_the_end(self):
+    def tokens():
+      yield from lexer.tokenize('x: int32\ny = 1\nz = 2\n')
+      raise AssertionError('Read past the items')
+    items = parser.iter_top_level(tokens())
+    self.assertEqual('x', next(items).name.value)
+    self.assertEqual('y', next(items).target.value)
+
+  def test_errors(self):
+    for source_code in ('x: int32\n\nmain: function\ny = 1\n', 'x: int32\nmain: function /* */'):
+      with self.assertRaises(parser.ParseError) as expected:
+        parser.parse_source(source_code)
+      with self.assertRaises(parser.ParseError) as error:
+        self.stream(source_code)
+      self.assertEqual(str(expected.exception), str(error.exception))
+      self.assertEqual(expected.exception.offset, error.exception.offset)
+
+  def test_empty(self):
+    self.assertEqual([], self.stream(''))
+    self.assertEqual([], self.stream(' // Nothing.\n'))
+
+
+class TestLazyBodies(unittest.TestCase):
+  """Jumps over function bodies, to parse them on first access or never."""
+
+  SOURCE = TestReparse.SOURCE + 'f: function[][ g["1"] h[x] ]\n'
+
+  def test_matching_brackets(self):
+    source_code = 'f: function[][ a[[1] b[]] ] ] ['
+    tokens = lexer.tokenize_buffer(source_code)
+    for tokens in (tokens, list(tokens), lexer.tokenize_bytes(source_code.encode('utf-8'))):
+      matching = parser.Parser(tokens).find_matching_brackets()
+      pairs = [(tokens[index].start, tokens[matching[index]].start)
+               for index in range(len(tokens)) if matching[index] != -1]
+      self.assertEqual([(11, 12), (13, 26), (16, 24), (17, 19), (22, 23)], pairs)
+
+  def test_lazy_parse_matches_eager_parse(self):
+    expected = tree_spans(parser.parse_source(self.SOURCE))
+    tree = parser.parse_source(self.SOURCE, bodies='lazy')
+    bodies = [item.members[2].members[-1] for item in tree.items
+              if item.node_type == 'FUNCTION_DECLARATION']
+    self.assertTrue(bodies)
+    self.assertFalse(any(body.parsed for body in bodies))
+    self.assertEqual(expected, tree_spans(tree))
+    self.assertTrue(all(body.parsed for body in bodies))
+
+  def test_outline(self):
+    tree = parser.parse_source(self.SOURCE, bodies='outline')
+    functions = [item for item in tree.items if item.node_type == 'FUNCTION_DECLARATION']
+    self.assertEqual(['main', 'main', 'f'], [function.name.value for function in functions])
+    self.assertEqual([None] * 3, [function.body for function in functions])
+    self.assertEqual([function.end for function in parser.parse_source(self.SOURCE).items
+                      if function.node_type == 'FUNCTION_DECLARATION'],
+                     [function.end for function in functions])
+
+  def test_error_in_lazy_body(self):
+    source_code = 'f: function[][ x: ]\ny = 1\n'
+    tree = parser.parse_source(source_code, bodies='lazy')
+    self.assertEqual(['f', 'y'], [item.members[0].value for item in tree.items])
+    with self.assertRaises(parser.ParseError):
+      tree.items[0].body.statements
+    diagnostics = []
+    tree = parser.parse_source(source_code, diagnostics=diagnostics, bodies='lazy')
+    self.assertEqual([], diagnostics)
+    tree.items[0].body.statements
+    self.assertEqual(1, len(diagnostics))
+
+  def test_reparse_around_lazy_body(self):
+    tree = parser.parse_source(self.SOURCE, bodies='lazy')
+    new_source_code = '// Comment.\n' + self.SOURCE
+    tree = parser.reparse(tree, new_source_code, 0, 0, len('// Comment.\n'))
+    self.assertEqual(tree_spans(parser.parse_source(new_source_code)), tree_spans(tree))
+
+  def test_pickles_parsed(self):
+    tree = pickle.loads(pickle.dumps(parser.parse_source(self.SOURCE, bodies='lazy')))
+    self.assertIsInstance(tree.items[-1].body, parser.CodeBlock)
+    self.assertEqual(tree_spans(parser.parse_source(self.SOURCE)), tree_spans(tree))
+
+  def test_invalid_bodies(self):
+    with self.assertRaises(ValueError):
+      parser.parse_source(self.SOURCE, bodies='never')
+
+  def test_arena_takes_only_eager_bodies(self):
+    for bodies in ('lazy', 'outline'):
+      with self.assertRaises(ValueError):
+        parser.parse_source(self.SOURCE, builder=parser.Arena(self.SOURCE), bodies=bodies)
+    tree = parser.parse_source(self.SOURCE, builder=parser.Arena(self.SOURCE), bodies='eager')
+    self.assertEqual('MODULE', tree.node_type)
+
+
+def nested_calls(depth):
+  # f[f[f[..."x"]]], nested depth calls deep.
+  node = parser.StringLiteral('"x"', 0, 3)
+  for _ in range(depth):
+    node = parser.FunctionCall(parser.IdentifierChain([parser.Leaf('IDENTIFIER', 'f')]), [node])
+  return parser.Module([node])
+
+
+def tree_structure(node):
+  if node.leaf:
+    return (node.node_type, tuple(node.members))
+  return (node.node_type, tuple(tree_structure(member) for member in node.members))
+
+
+def tree_spans(node):
+  if node.leaf:
+    return (node.node_type, tuple(node.members), node.start, node.end)
+  return (node.node_type, node.start, node.end, tuple(tree_spans(member) for member in node.members))
+
+
+def arena_spans(node):
+  # Spans of the nodes both an Arena and typed nodes have, with leaf text.
+  if node.leaf:
+    return (node.node_type, node.value, node.start, node.end)
+  children = [] if node.node_type == 'FOREIGN_CODE_BLOCK' else node.children()
+  return (node.node_type, node.start, node.end, tuple(arena_spans(child) for child in children))
+
 
 if __name__ == '__main__':
   unittest.main()
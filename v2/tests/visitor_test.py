@@ -0,0 +1,116 @@
+import sys
+import unittest
+import parser
+import visitor
+from tests.parser_test import nested_calls
+
+
+SOURCE_CODE = """
+moduleName = "visited"
+count: int32
+
+main: function[][
+  os.print["Hello\\n"]
+BEGIN_FOREIGN_CODE_C
+  printf("foreign");
+END_FOREIGN_CODE_C
+  os.print[count]
+]
+"""
+
+
+class NodeTypeCounter(visitor.Visitor):
+
+  def __init__(self):
+    self.counts = {}
+
+  def generic_visit(self, node):
+    self.counts[node.node_type] = self.counts.get(node.node_type, 0) + 1
+    super().generic_visit(node)
+
+
+class CallCollector(visitor.Visitor):
+
+  def visit_function_call(self, node, calls):
+    calls.append(node.callee.text())
+
+
+class StringCounter(visitor.Visitor):
+
+  def __init__(self):
+    self.strings = 0
+
+  def visit_string_literal(self, node):
+    self.strings += 1
+
+
+class Quote(visitor.Transformer):
+
+  def visit_string_literal(self, node):
+    return parser.StringLiteral('"quoted ' + node.value[1:])
+
+
+class RemovePrints(visitor.Transformer):
+
+  def visit_function_call(self, node):
+    return None if node.callee.text() == 'os.print' else node
+
+
+class TestVisitor(unittest.TestCase):
+  """Dispatches on node types through a table per class."""
+
+  def test_generic_visit_walks_the_tree(self):
+    counter = NodeTypeCounter()
+    counter.visit(parser.parse_source(SOURCE_CODE))
+    self.assertEqual(2, counter.counts['FUNCTION_CALL'])
+    self.assertEqual(1, counter.counts['FOREIGN_CODE_BLOCK'])
+    self.assertEqual(1, counter.counts['CODE_BLOCK'])
+
+  def test_methods_by_node_type(self):
+    for tree in (parser.parse_source(SOURCE_CODE), parser.parse_source_arena(SOURCE_CODE),
+                 parser.parse_source(SOURCE_CODE, bodies='lazy')):
+      calls = []
+      CallCollector().visit(tree, calls)
+      self.assertEqual(['os.print', 'os.print'], calls)
+
+  def test_dispatch_table_per_class(self):
+    CallCollector().visit(parser.parse_source(SOURCE_CODE), [])
+    self.assertIs(CallCollector.visit_function_call, CallCollector._methods['FUNCTION_CALL'])
+    self.assertIs(visitor.Visitor.generic_visit, CallCollector._methods['MODULE'])
+    self.assertIs(NodeTypeCounter.generic_visit, NodeTypeCounter._methods['FUNCTION_CALL'])
+
+  def test_method_prefix(self):
+    class Emitter(visitor.Visitor):
+      method_prefix = 'emit_'
+
+      def emit_function_call(self, node):
+        return 'emitted'
+
+    call = parser.parse_source(SOURCE_CODE).items[2].body.statements[0]
+    self.assertEqual('emitted', Emitter().visit(call))
+
+  def test_deeper_than_recursion_limit(self):
+    counter = StringCounter()
+    counter.visit(nested_calls(sys.getrecursionlimit() * 2))
+    self.assertEqual(1, counter.strings)
+
+
+class TestTransformer(unittest.TestCase):
+  """Replaces the nodes visited with what the methods return."""
+
+  def test_removes_nodes(self):
+    tree = RemovePrints().visit(parser.parse_source(SOURCE_CODE))
+    self.assertEqual(['FOREIGN_CODE_BLOCK'],
+                     [statement.node_type for statement in tree.items[2].body.statements])
+
+  def test_lazy_body(self):
+    tree = RemovePrints().visit(parser.parse_source(SOURCE_CODE, bodies='lazy'))
+    self.assertEqual(1, len(tree.items[2].body.statements))
+
+  def test_deeper_than_recursion_limit(self):
+    tree = Quote().visit(nested_calls(sys.getrecursionlimit() * 2))
+    self.assertEqual('"quoted x"', list(tree.walk())[-1].value)
+
+
+if __name__ == '__main__':
+  unittest.main()
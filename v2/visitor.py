@@ -0,0 +1,122 @@
+import functools
+
+import parser
+
+
+def _find_methods(visitor_class):
+  # Maps each node type to the method of a visitor class for it.
+  prefix = visitor_class.method_prefix
+  return {node_type: getattr(visitor_class, prefix + node_type.lower(),
+                             visitor_class.generic_visit)
+          for node_type in parser.NODE_TYPES}
+
+
+# The generic_visit methods of Visitor and Transformer, which walk into the
+# nodes left to them with a stack of their own.
+_WALKING_VISITS = set()
+
+
+def _find_inline(visitor_class):
+  # Node types the generic_visit of a visitor class walks into itself.
+  return frozenset(node_type for node_type, method in visitor_class._methods.items()
+                   if method in _WALKING_VISITS)
+
+
+class Visitor:
+  """Calls the method named after the type of each node it visits.
+
+  visit(node) calls visit_function_call(node) for a FUNCTION_CALL, and so
+  on, passing on any extra arguments and returning what the method returns.
+  Node types without a method go to generic_visit, which visits the children.
+  Subclasses change method_prefix to use other names.
+
+  The methods are found once per class, into a table from node types to
+  methods, and bound to the visitor in dispatch on first use. Loops over many
+  nodes call dispatch[node.node_type](node) directly, which is one dict
+  lookup and one call. Typed nodes and ArenaNodes are visited alike.
+
+  generic_visit keeps the nodes it walks into on a stack of its own, so trees
+  of any depth are visited, as long as the methods of a subclass do not
+  recurse into the children themselves.
+  """
+
+  method_prefix = 'visit_'
+
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+    cls._methods = _find_methods(cls)
+    cls._inline = _find_inline(cls)
+
+  @functools.cached_property
+  def dispatch(self):
+    return {node_type: method.__get__(self) for node_type, method in self._methods.items()}
+
+  def visit(self, node, *args):
+    try:
+      method = self.dispatch[node.node_type]
+    except KeyError:
+      method = self.generic_visit
+    return method(node, *args)
+
+  def generic_visit(self, node, *args):
+    inline = self._inline
+    visit = self.visit
+    # Iterators over the children left to visit, one per level.
+    stack = [iter(node.children())]
+    while stack:
+      for child in stack[-1]:
+        if child.node_type in inline:
+          stack.append(iter(child.children()))
+          break
+        visit(child, *args)
+      else:
+        stack.pop()
+
+
+class Transformer(Visitor):
+  """A Visitor whose methods return the node to put in place of the one visited.
+
+  generic_visit replaces the children of a node with what visiting them
+  returns, leaving out children replaced with None, and returns the node.
+  The tree is changed in place, it must be made of typed nodes.
+  """
+
+  def _replace_children(self, node, args):
+    # Replaces the children of node. Children generic_visit would return
+    # as they are are yielded instead, to be walked into before going on.
+    inline = self._inline
+    visit = self.visit
+    for name in node._children:
+      child = getattr(node, name)
+      if isinstance(child, list):
+        new_children = []
+        for item in child:
+          if item.node_type in inline:
+            yield item
+          else:
+            item = visit(item, *args)
+            if item is None:
+              continue
+          new_children.append(item)
+        child[:] = new_children
+      elif child is not None:
+        if child.node_type in inline:
+          yield child
+        else:
+          setattr(node, name, visit(child, *args))
+
+  def generic_visit(self, node, *args):
+    stack = [self._replace_children(node, args)]
+    while stack:
+      for child in stack[-1]:
+        stack.append(self._replace_children(child, args))
+        break
+      else:
+        stack.pop()
+    return node
+
+
+_WALKING_VISITS.update((Visitor.generic_visit, Transformer.generic_visit))
+Visitor._methods = _find_methods(Visitor)
+Visitor._inline = _find_inline(Visitor)
+Transformer._inline = _find_inline(Transformer)